@@ -0,0 +1,35 @@
+# Gunicorn configuration, driven by environment variables.
+#
+# Default: WSGI with 3 sync workers (one request at a time per worker).
+#
+# ASGI (GUNICORN_WORKER_CLASS=uvicorn_worker.UvicornWorker) gives no
+# concurrency here: the views are synchronous, and under ASGI Django runs them
+# with sync_to_async(thread_sensitive=True), i.e. one request after another on
+# a single thread per worker, plus the event-loop overhead. Measured with
+#
+#   python manage.py loadtest --worker-class <class> --workers 3 --clients 20 \
+#       --duration 20 --database-engine postgresql --database-name <db>
+#
+# (50 households, default mix, 1 CPU, two runs each):
+#
+#   sync                           12.1-12.3 req/s, p50 1065 ms, p95 ~4.7 s
+#   uvicorn_worker.UvicornWorker   10.3-11.0 req/s, p50 1160-1190 ms, p95 ~7.0 s
+#
+# Keep the sync workers and add workers to serve more requests at once.
+#
+# To size a deployment, measure throughput and latency percentiles of a
+# realistic mix of requests with
+#
+#   python manage.py loadtest --workers 3 --worker-class sync --clients 50
+import os
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("GUNICORN_WORKERS", "3"))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
+threads = int(os.getenv("GUNICORN_THREADS", "1"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+
+if "uvicorn" in worker_class.lower():
+    wsgi_app = "spotifyfamily-project.asgi:application"
+else:
+    wsgi_app = "spotifyfamily-project.wsgi:application"
@@ -45,6 +45,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'spotifyfamily.metrics.MetricsMiddleware',
+    'spotifyfamily.routers.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -52,6 +54,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'spotifyfamily.profiling.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'spotifyfamily-project.urls'
@@ -88,8 +91,124 @@ DATABASES = {
     }
 }
 
+# Read replicas: comma separated hosts (PostgreSQL, "host" or "host:port") or
+# database files (SQLite). GET requests read from a healthy replica, see
+# spotifyfamily/routers.py. In tests every replica mirrors the primary.
+REPLICA_DATABASES = []
+for number, replica in enumerate(filter(None, os.getenv("DATABASE_REPLICAS", "").split(",")), start=1):
+    replica_config = {**DATABASES['default'], "TEST": {"MIRROR": "default"}}
+    if replica_config['ENGINE'].endswith("sqlite3"):
+        replica_config['NAME'] = replica.strip()
+    else:
+        host, _, port = replica.strip().partition(":")
+        replica_config['HOST'] = host
+        replica_config['PORT'] = port or replica_config['PORT']
+    DATABASES[f"replica{number}"] = replica_config
+    REPLICA_DATABASES.append(f"replica{number}")
+
+DATABASE_ROUTERS = ['spotifyfamily.routers.ReplicaRouter']
+
+# After a write the same browser keeps reading from the primary for this many
+# seconds (expected replication lag)
+REPLICA_PIN_SECONDS = int(os.getenv("REPLICA_PIN_SECONDS", "5"))
+
+# Seconds before a replica health check is repeated
+REPLICA_HEALTH_TTL = int(os.getenv("REPLICA_HEALTH_TTL", "10"))
+
 AUTH_USER_MODEL = 'spotifyfamily.User'
 
+# Cache backend (see CACHES below). LocMemCache and DummyCache are private
+# to each process: a gunicorn worker doesn't see what the others delete, so
+# a revoked session or a changed user could still be served from it. Sessions
+# and users are cached only with a shared backend (Redis, memcached, ...).
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", 'django.core.cache.backends.locmem.LocMemCache')
+SHARED_CACHE = CACHE_BACKEND not in (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+# The logged in user is read from the cache (see spotifyfamily/authcache.py);
+# ModelBackend stays listed so sessions created before keep working
+AUTHENTICATION_BACKENDS = [
+    'spotifyfamily.authcache.CachedModelBackend',
+    'django.contrib.auth.backends.ModelBackend',
+]
+
+# Seconds a logged in user is kept in the cache (0 = always read from the
+# database, always the case without a shared cache). Bump the version to drop
+# every cached user at once.
+AUTH_USER_CACHE_TIMEOUT = int(os.getenv("AUTH_USER_CACHE_TIMEOUT", "300")) if SHARED_CACHE else 0
+AUTH_USER_CACHE_VERSION = int(os.getenv("AUTH_USER_CACHE_VERSION", "1"))
+
+# Seconds a subscription's price history is kept in the cache. The key holds
+# Subscription.revision, so price changes are seen at once by every process.
+PRICE_SCHEDULE_TIMEOUT = int(os.getenv("PRICE_SCHEDULE_TIMEOUT", "300"))
+
+# Login attempts allowed per client IP and per username: a burst, then a
+# steady number per minute (0 = no limit). Rejected attempts get a 429
+# before the password is hashed.
+# The counters live in the cache: with a shared CACHE_BACKEND (Redis,
+# memcached) the limits hold across all workers. With the default per-process
+# LocMemCache each gunicorn worker counts on its own, so a client gets up to
+# GUNICORN_WORKERS (default 3) times these numbers.
+LOGIN_THROTTLE_IP_BURST = int(os.getenv("LOGIN_THROTTLE_IP_BURST", "20"))
+LOGIN_THROTTLE_IP_PER_MINUTE = float(os.getenv("LOGIN_THROTTLE_IP_PER_MINUTE", "10"))
+LOGIN_THROTTLE_USERNAME_BURST = int(os.getenv("LOGIN_THROTTLE_USERNAME_BURST", "5"))
+LOGIN_THROTTLE_USERNAME_PER_MINUTE = float(os.getenv("LOGIN_THROTTLE_USERNAME_PER_MINUTE", "2"))
+
+# With a shared cache sessions are read from the cache and written through to
+# the database, otherwise they are read from the database
+# https://docs.djangoproject.com/en/5.2/topics/http/sessions/#using-cached-sessions
+SESSION_ENGINE = os.getenv(
+    "SESSION_ENGINE",
+    "django.contrib.sessions.backends.cached_db" if SHARED_CACHE else "django.contrib.sessions.backends.db",
+)
+
+# Where amounts due are computed: "python", "database" (PostgreSQL only,
+# SQLite always falls back to Python) or "ledger" (sum of the Charge rows
+# written by the run_billing command)
+BILLING_BACKEND = os.getenv("BILLING_BACKEND", "python")
+
+# Directory shared by all gunicorn workers where per-process metrics are
+# written (default: <tmp>/spotifyfamily-metrics)
+METRICS_DIR = os.getenv("METRICS_DIR")
+
+# Staff requests with ?profile (or an X-Profile header) are profiled and the
+# result stored here (default: <tmp>/spotifyfamily-profiles), see
+# spotifyfamily/profiling.py. Only the newest PROFILE_RETENTION are kept.
+PROFILE_DIR = os.getenv("PROFILE_DIR")
+PROFILE_RETENTION = int(os.getenv("PROFILE_RETENTION", "50"))
+# Seconds between two stack samples of a profiled request
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.002"))
+
+# Email (overdue reminders)
+# https://docs.djangoproject.com/en/5.2/topics/email/
+
+EMAIL_BACKEND = os.getenv("EMAIL_BACKEND", "django.core.mail.backends.console.EmailBackend")
+EMAIL_HOST = os.getenv("EMAIL_HOST", "localhost")
+EMAIL_PORT = int(os.getenv("EMAIL_PORT", "25"))
+EMAIL_HOST_USER = os.getenv("EMAIL_HOST_USER", "")
+EMAIL_HOST_PASSWORD = os.getenv("EMAIL_HOST_PASSWORD", "")
+EMAIL_USE_TLS = os.getenv("EMAIL_USE_TLS", "0").lower() in ("1", "true", "yes")
+DEFAULT_FROM_EMAIL = os.getenv("DEFAULT_FROM_EMAIL", "webmaster@localhost")
+
+# Maximum number of reminder emails sent per second (0 = no limit)
+REMINDER_RATE = float(os.getenv("REMINDER_RATE", "5"))
+
+# Months of payments kept in the Payment table; older ones are moved to
+# ArchivedPayment by the archive_payments command
+PAYMENT_RETENTION_MONTHS = int(os.getenv("PAYMENT_RETENTION_MONTHS", "24"))
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKEND,
+        'LOCATION': os.getenv("CACHE_LOCATION", ""),
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
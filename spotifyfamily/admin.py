@@ -1,10 +1,199 @@
-from django.contrib import admin
+import io
+
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin
-from .models import User, Subscription, SubscriptionDetail, SubscriptionPrice, Payment
+from django.db import transaction
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path
+from . import rollups
+from .api import add_amounts
+from .forms import PaymentImportForm
+from .models import (
+    ArchivedPayment, OverdueReminder, Payment, PaymentMonthlyRollup, Subscription, SubscriptionDetail, SubscriptionPrice,
+    User,
+)
+from .pagination import EstimatedCountPaginator
+from .payment_import import import_payments
+
+# Numero massimo di righe scartate mostrate nella pagina di importazione
+MAX_REJECTS_SHOWN = 100
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """Changelist senza COUNT(*) esatti sulle tabelle grandi"""
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_per_page = 50
+
+
+class OutstandingBalanceMixin:
+    """Colonna con l'importo dovuto dal membro, calcolata per tutta la pagina in blocco"""
+    balance_detail = None  # Percorso del SubscriptionDetail dalla riga (None = la riga stessa)
+
+    def _detail(self, obj):
+        return getattr(obj, self.balance_detail) if self.balance_detail else obj
+
+    def get_changelist_instance(self, request):
+        changelist = super().get_changelist_instance(request)
+        rows = {}
+        for obj in changelist.result_list:
+            detail = self._detail(obj)
+            rows.setdefault(detail.pk, {
+                "subscription_id": detail.subscription_id,
+                "subscription__renew_period": detail.subscription.renew_period,
+                "last_payment_date": detail.last_payment_date,
+                "credit": detail.credit,
+            })
+        add_amounts(list(rows.values()))
+        for obj in changelist.result_list:
+            obj._outstanding = rows[self._detail(obj).pk]["amount_to_pay"]
+        return changelist
+
+    @admin.display(description="Outstanding (€)")
+    def outstanding(self, obj):
+        return getattr(obj, "_outstanding", None)
+
+
+class PaymentAdmin(OutstandingBalanceMixin, LargeTableAdmin):
+    change_list_template = "admin/spotifyfamily/payment/change_list.html"
+    list_display = ("id", "member", "subscription", "amount", "payment_date", "periods_covered", "outstanding")
+    list_select_related = ("subscription_detail__user", "subscription_detail__subscription")
+    autocomplete_fields = ("subscription_detail",)
+    date_hierarchy = "payment_date"
+    search_fields = ("subscription_detail__user__username",)
+    readonly_fields = ("idempotency_key", "created_at")
+    ordering = ("-payment_date",)
+    balance_detail = "subscription_detail"
+
+    # I totali mensili seguono le modifiche fatte dall'admin
+    def save_model(self, request, obj, form, change):
+        with transaction.atomic():
+            if change:
+                rollups.record([Payment.objects.get(pk=obj.pk)], sign=-1)
+            super().save_model(request, obj, form, change)
+            rollups.record([obj])
+
+    def delete_model(self, request, obj):
+        with transaction.atomic():
+            rollups.record([obj], sign=-1)
+            super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        with transaction.atomic():
+            rollups.record(queryset.only("subscription_detail_id", "payment_date", "amount"), sign=-1)
+            super().delete_queryset(request, queryset)
+
+    @admin.display(description="Member", ordering="subscription_detail__user__username")
+    def member(self, obj):
+        return obj.subscription_detail.user.username
+
+    @admin.display(description="Subscription", ordering="subscription_detail__subscription__name")
+    def subscription(self, obj):
+        return obj.subscription_detail.subscription.name
+
+    def get_urls(self):
+        urls = [
+            path("import/", self.admin_site.admin_view(self.import_view), name="spotifyfamily_payment_import"),
+        ]
+        return urls + super().get_urls()
+
+    def import_view(self, request):
+        """Importa un CSV di pagamenti e mostra le righe scartate"""
+        if not self.has_add_permission(request):
+            return redirect("admin:spotifyfamily_payment_changelist")
+
+        rejects = []
+        result = None
+        form = PaymentImportForm(request.POST or None, request.FILES or None)
+        if request.method == "POST" and form.is_valid():
+            def on_reject(row):
+                if len(rejects) < MAX_REJECTS_SHOWN:
+                    rejects.append(row)
+
+            upload = form.cleaned_data["csv_file"]
+            try:
+                result = import_payments(
+                    io.TextIOWrapper(upload.file, encoding="utf-8-sig", newline=""), on_reject=on_reject,
+                )
+            except (ValueError, UnicodeDecodeError) as e:
+                messages.error(request, f"Import failed: {e}")
+            else:
+                messages.success(request, str(result))
+                if not result.rejected:
+                    return redirect("admin:spotifyfamily_payment_changelist")
+
+        context = {
+            **self.admin_site.each_context(request),
+            "opts": self.model._meta,
+            "title": "Import payments",
+            "form": form,
+            "result": result,
+            "rejects": rejects,
+        }
+        return TemplateResponse(request, "admin/spotifyfamily/payment/import.html", context)
+
+
+class SubscriptionAdmin(admin.ModelAdmin):
+    list_display = ("name", "admin_user", "start_date", "renew_period", "updated_at")
+    list_select_related = ("admin_user",)
+    autocomplete_fields = ("admin_user",)
+    search_fields = ("name",)
+    readonly_fields = ("revision", "updated_at")
+
+
+class SubscriptionDetailAdmin(OutstandingBalanceMixin, LargeTableAdmin):
+    list_display = ("user", "subscription", "last_payment_date", "outstanding")
+    list_select_related = ("user", "subscription")
+    autocomplete_fields = ("user", "subscription")
+    date_hierarchy = "last_payment_date"
+    search_fields = ("user__username", "subscription__name")
+    ordering = ("id",)
+
+    def get_queryset(self, request):
+        # Anche l'autocomplete dei pagamenti mostra __str__ (utente e sottoscrizione)
+        return super().get_queryset(request).select_related("user", "subscription")
+
+
+class SubscriptionPriceAdmin(LargeTableAdmin):
+    list_display = ("subscription", "price", "valid_from", "valid_to")
+    list_select_related = ("subscription",)
+    autocomplete_fields = ("subscription",)
+    date_hierarchy = "valid_from"
+    search_fields = ("subscription__name",)
+
+
+class PaymentMonthlyRollupAdmin(LargeTableAdmin):
+    list_display = ("subscription_detail", "month", "total", "payment_count")
+    list_select_related = ("subscription_detail__user", "subscription_detail__subscription")
+    date_hierarchy = "month"
+    search_fields = ("subscription_detail__user__username",)
+    readonly_fields = ("subscription_detail", "month", "total", "payment_count")
+
+
+class ArchivedPaymentAdmin(LargeTableAdmin):
+    list_display = ("id", "subscription_detail", "amount", "payment_date")
+    list_select_related = ("subscription_detail__user", "subscription_detail__subscription")
+    date_hierarchy = "payment_date"
+    search_fields = ("subscription_detail__user__username",)
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+class OverdueReminderAdmin(LargeTableAdmin):
+    list_display = ("user", "run_date", "amount", "sent_at")
+    list_select_related = ("user",)
+    list_filter = ("run_date",)
+    autocomplete_fields = ("user",)
+
 
 # Register your models here.
 admin.site.register(User, UserAdmin)
-admin.site.register(Subscription)
-admin.site.register(SubscriptionDetail)
-admin.site.register(SubscriptionPrice)
-admin.site.register(Payment)
\ No newline at end of file
+admin.site.register(Subscription, SubscriptionAdmin)
+admin.site.register(SubscriptionDetail, SubscriptionDetailAdmin)
+admin.site.register(SubscriptionPrice, SubscriptionPriceAdmin)
+admin.site.register(Payment, PaymentAdmin)
+admin.site.register(PaymentMonthlyRollup, PaymentMonthlyRollupAdmin)
+admin.site.register(ArchivedPayment, ArchivedPaymentAdmin)
+admin.site.register(OverdueReminder, OverdueReminderAdmin)
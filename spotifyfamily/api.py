@@ -0,0 +1,251 @@
+"""
+API JSON in sola lettura per strumenti interni.
+
+Le liste usano la paginazione keyset: il cursore contiene i valori di
+ordinamento dell'ultima riga restituita, quindi ogni pagina costa una query
+indicizzata indipendentemente da quanto si è andati avanti. Le righe sono
+serializzate direttamente da ``.values()``.
+"""
+import base64
+import json
+from collections import defaultdict
+from datetime import date
+from functools import wraps
+
+from django.db.models import Count, Q
+from django.http import JsonResponse
+from django.views.decorators.http import require_GET
+
+from . import billing, billing_db, forecast as forecasting
+from .models import Subscription, SubscriptionDetail, SubscriptionPrice
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+class ApiError(Exception):
+    pass
+
+
+def staff_required(view):
+    """Come login_required, ma risponde in JSON invece di fare redirect"""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse({"error": "Authentication required."}, status=401)
+        if not request.user.is_staff:
+            return JsonResponse({"error": "Staff access required."}, status=403)
+        try:
+            return view(request, *args, **kwargs)
+        except ApiError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+    return wrapper
+
+
+def encode_cursor(values):
+    raw = json.dumps([v.isoformat() if isinstance(v, date) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor, ordering):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if len(values) != len(ordering):
+            raise ValueError
+        return [date.fromisoformat(v) if isinstance(v, str) else int(v) for v in values]
+    except (ValueError, TypeError):
+        raise ApiError("Invalid cursor.")
+
+
+def _after(ordering, values):
+    """Condizione keyset "riga successiva al cursore" per un ordinamento crescente"""
+    condition = Q()
+    for i in reversed(range(len(ordering))):
+        step = Q(**{f"{ordering[i]}__gt": values[i]})
+        if i < len(ordering) - 1:
+            step |= Q(**{ordering[i]: values[i]}) & condition
+        condition = step
+    return condition
+
+
+def _int_param(request, name, default=None):
+    value = request.GET.get(name)
+    if value in (None, ""):
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ApiError(f"Invalid {name}.")
+
+
+def select_fields(request, available):
+    """Campi richiesti con ?fields=a,b (default: tutti)"""
+    requested = request.GET.get("fields")
+    if not requested:
+        return list(available)
+    fields = [name.strip() for name in requested.split(",") if name.strip()]
+    unknown = [name for name in fields if name not in available]
+    if unknown:
+        raise ApiError(f"Unknown fields: {', '.join(unknown)}.")
+    return fields
+
+
+def keyset_page(request, queryset, available, ordering=("id",), extra=(), computed=()):
+    """
+    Ritorna (righe, campi richiesti, cursore successivo). ``available`` mappa i
+    campi esposti sui lookup di ``.values()``; ``extra`` sono lookup letti
+    comunque, ``computed`` i campi calcolati dopo la query.
+    """
+    limit = min(max(_int_param(request, "limit", DEFAULT_LIMIT), 1), MAX_LIMIT)
+    fields = select_fields(request, available)
+
+    queryset = queryset.order_by(*ordering)
+    cursor = request.GET.get("cursor")
+    if cursor:
+        queryset = queryset.filter(_after(ordering, decode_cursor(cursor, ordering)))
+
+    lookups = [available[name] for name in fields if name not in computed]
+    lookups = list(dict.fromkeys([*lookups, *ordering, *extra]))
+    rows = list(queryset.values(*lookups)[:limit + 1])
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1][name] for name in ordering])
+    return rows, fields, next_cursor
+
+
+def page_response(rows, fields, available, next_cursor):
+    return JsonResponse({
+        "results": [{name: row[available[name]] for name in fields} for row in rows],
+        "next_cursor": next_cursor,
+    })
+
+
+SUBSCRIPTION_FIELDS = {
+    "id": "id",
+    "name": "name",
+    "start_date": "start_date",
+    "renew_period": "renew_period",
+    "admin_user_id": "admin_user_id",
+    "admin_username": "admin_user__username",
+}
+
+MEMBER_FIELDS = {
+    "id": "id",
+    "subscription_id": "subscription_id",
+    "user_id": "user_id",
+    "username": "user__username",
+    "last_payment_date": "last_payment_date",
+}
+
+PRICE_FIELDS = {
+    "id": "id",
+    "subscription_id": "subscription_id",
+    "price": "price",
+    "valid_from": "valid_from",
+    "valid_to": "valid_to",
+}
+
+BALANCE_FIELDS = {
+    **MEMBER_FIELDS,
+    "months_unpaid": "months_unpaid",
+    "amount_to_pay": "amount_to_pay",
+}
+
+
+def _filter_subscription(request, queryset):
+    subscription_id = _int_param(request, "subscription")
+    if subscription_id is not None:
+        queryset = queryset.filter(subscription_id=subscription_id)
+    return queryset
+
+
+@require_GET
+@staff_required
+def subscriptions(request):
+    """Sottoscrizioni ordinate per data di inizio"""
+    rows, fields, next_cursor = keyset_page(
+        request, Subscription.objects.all(), SUBSCRIPTION_FIELDS, ordering=("start_date", "id"),
+    )
+    return page_response(rows, fields, SUBSCRIPTION_FIELDS, next_cursor)
+
+
+@require_GET
+@staff_required
+def members(request):
+    """Membri delle sottoscrizioni (SubscriptionDetail)"""
+    queryset = _filter_subscription(request, SubscriptionDetail.objects.all())
+    rows, fields, next_cursor = keyset_page(request, queryset, MEMBER_FIELDS)
+    return page_response(rows, fields, MEMBER_FIELDS, next_cursor)
+
+
+@require_GET
+@staff_required
+def prices(request):
+    """Storico prezzi"""
+    queryset = _filter_subscription(request, SubscriptionPrice.objects.all())
+    rows, fields, next_cursor = keyset_page(request, queryset, PRICE_FIELDS)
+    return page_response(rows, fields, PRICE_FIELDS, next_cursor)
+
+
+def add_amounts(rows, today=None):
+    """
+    Aggiunge months_unpaid e amount_to_pay alle righe di una pagina, con due
+    query in tutto per prezzi e numero di membri.
+    """
+    today = today or date.today()
+    subscription_ids = {row["subscription_id"] for row in rows}
+    prices_by_subscription = defaultdict(list)
+    for price in SubscriptionPrice.objects.filter(subscription_id__in=subscription_ids):
+        prices_by_subscription[price.subscription_id].append(price)
+    user_counts = dict(
+        SubscriptionDetail.objects.filter(subscription_id__in=subscription_ids)
+        .values_list("subscription_id").annotate(Count("id"))
+    )
+    schedules = {pk: billing.PriceSchedule(prices_by_subscription[pk]) for pk in subscription_ids}
+
+    for row in rows:
+        subscription_id = row["subscription_id"]
+        renew_period = row["subscription__renew_period"]
+        row["months_unpaid"] = billing.count_unpaid_periods(row["last_payment_date"], renew_period, today)
+        row["amount_to_pay"] = billing.amount_to_pay(
+            row["last_payment_date"], renew_period, schedules[subscription_id],
+            user_counts.get(subscription_id, 0), today, row["credit"],
+        )
+
+
+@require_GET
+@staff_required
+def balances(request):
+    """Importi dovuti per ogni membro"""
+    queryset = _filter_subscription(request, SubscriptionDetail.objects.all())
+    if billing_db.is_enabled(queryset):
+        rows, fields, next_cursor = keyset_page(request, billing_db.annotate_amounts(queryset), BALANCE_FIELDS)
+    else:
+        rows, fields, next_cursor = keyset_page(
+            request, queryset, BALANCE_FIELDS,
+            extra=("subscription_id", "last_payment_date", "subscription__renew_period", "credit"),
+            computed=("months_unpaid", "amount_to_pay"),
+        )
+        if {"months_unpaid", "amount_to_pay"} & set(fields):
+            add_amounts(rows)
+    return page_response(rows, fields, BALANCE_FIELDS, next_cursor)
+
+
+@require_GET
+@staff_required
+def forecast(request):
+    """Importi dovuti da ogni membro nei prossimi mesi (?horizons=3,6,12)"""
+    try:
+        horizons = [int(h) for h in request.GET.get("horizons", "").split(",") if h.strip()]
+    except ValueError:
+        raise ApiError("Invalid horizons.")
+    horizons = horizons or forecasting.DEFAULT_HORIZONS
+    if any(h < 1 or h > 120 for h in horizons):
+        raise ApiError("Horizons must be between 1 and 120 months.")
+    subscription_id = _int_param(request, "subscription")
+    result = forecasting.forecast(
+        horizons, subscription_ids=None if subscription_id is None else [subscription_id],
+    )
+    return JsonResponse(result)
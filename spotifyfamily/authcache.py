@@ -0,0 +1,64 @@
+"""
+Utente autenticato letto dalla cache invece che dal database.
+
+Con le sessioni ``cached_db`` (vedi ``SESSION_ENGINE``) e questo backend una
+richiesta autenticata con la cache calda non fa query né per la sessione né
+per l'utente. La voce in cache viene eliminata quando l'utente viene salvato
+(modifica, cambio password, ultimo accesso) o eliminato e al logout (vedi
+``signals.py``); dura al massimo ``AUTH_USER_CACHE_TIMEOUT`` secondi, così
+anche le modifiche fatte con ``QuerySet.update`` (che non inviano segnali)
+arrivano dopo poco.
+La versione nella chiave (``AUTH_USER_CACHE_VERSION``) scarta in blocco le
+voci salvate con una versione precedente del modello.
+
+Serve una cache condivisa (``CACHE_BACKEND``): con la cache in memoria
+locale un processo non vede le invalidazioni degli altri, quindi
+``settings.py`` porta ``AUTH_USER_CACHE_TIMEOUT`` a 0 e il backend legge
+sempre dal database.
+"""
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+
+USER_KEY = "auth-user:{}"
+
+
+def _timeout():
+    return getattr(settings, "AUTH_USER_CACHE_TIMEOUT", 300)
+
+
+def _version():
+    return getattr(settings, "AUTH_USER_CACHE_VERSION", 1)
+
+
+def _key(user_id):
+    return USER_KEY.format(user_id)
+
+
+def invalidate(user_id):
+    cache.delete(_key(user_id), version=_version())
+
+
+class CachedModelBackend(ModelBackend):
+    """ModelBackend con ``get_user`` servito dalla cache"""
+
+    def get_user(self, user_id):
+        if not _timeout():
+            return super().get_user(user_id)
+        user = cache.get(_key(user_id), version=_version())
+        if user is None:
+            user = super().get_user(user_id)
+            if user is not None:
+                cache.set(_key(user_id), user, timeout=_timeout(), version=_version())
+        return user
+
+    async def aget_user(self, user_id):
+        if not _timeout():
+            return await super().aget_user(user_id)
+        user = await cache.aget(_key(user_id), version=_version())
+        if user is None:
+            user = await super().aget_user(user_id)
+            if user is not None:
+                await cache.aset(_key(user_id), user, timeout=_timeout(), version=_version())
+        return user
+
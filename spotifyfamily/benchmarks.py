@@ -0,0 +1,121 @@
+"""
+Benchmark delle viste e dei calcoli di fatturazione su dataset sintetici.
+
+Ogni misura riporta la mediana dei tempi e il numero di query; il confronto
+con una baseline segnala le regressioni di latenza o di query.
+"""
+import statistics
+import time
+from datetime import date
+
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Prefetch
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from . import synthetic, views
+from .models import Subscription, SubscriptionDetail, SubscriptionPrice
+
+
+class _Rollback(Exception):
+    pass
+
+
+def measure(func, repeat, warmup=False):
+    """Mediana in millisecondi e numero di query dell'ultima esecuzione"""
+    if warmup:
+        func()
+    timings = []
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - start) * 1000)
+    return {"median_ms": round(statistics.median(timings), 3), "queries": len(queries)}
+
+
+def _request(path, user):
+    request = RequestFactory().get(path)
+    request.user = user
+    return request
+
+
+def _benchmarks():
+    """Nome -> (funzione, con riscaldamento)"""
+    subscription = Subscription.objects.select_related("admin_user").first()
+    admin = subscription.admin_user
+
+    def index():
+        cache.clear()
+        views.index(_request("/", admin))
+
+    def index_cached():
+        views.index(_request("/", admin))
+
+    def edit_subscription():
+        views.edit_subscription(_request(f"/subscription/{subscription.pk}/edit/", admin), subscription.pk)
+
+    def get_amount_to_pay():
+        for detail in SubscriptionDetail.objects.select_related("subscription"):
+            detail.get_amount_to_pay()
+
+    def calculate_amount_to_pay():
+        details = SubscriptionDetail.objects.select_related("subscription").prefetch_related(
+            Prefetch("subscription__prices", queryset=SubscriptionPrice.objects.order_by("-valid_from")),
+            "subscription__users",
+        )
+        for detail in details:
+            views.calculate_amount_to_pay(
+                detail, detail.subscription.users.count(), list(detail.subscription.prices.all()),
+            )
+
+    return {
+        "index": (index, False),
+        "index_cached": (index_cached, True),
+        "edit_subscription": (edit_subscription, False),
+        "get_amount_to_pay": (get_amount_to_pay, False),
+        "calculate_amount_to_pay": (calculate_amount_to_pay, False),
+    }
+
+
+def run(sizes, members=4, price_changes=3, years=3, seed=0, repeat=5, today=None):
+    """
+    Esegue i benchmark per ogni numero di sottoscrizioni in ``sizes``.
+    Il dataset viene creato in una transazione annullata alla fine.
+    """
+    today = today or date.today()
+    results = {}
+    for size in sizes:
+        try:
+            with transaction.atomic():
+                synthetic.generate(size, members, price_changes, years, seed=seed, today=today, prefix="bench")
+                results[str(size)] = {
+                    name: measure(func, repeat, warmup) for name, (func, warmup) in _benchmarks().items()
+                }
+                raise _Rollback
+        except _Rollback:
+            pass
+        finally:
+            cache.clear()
+    return {
+        "parameters": {
+            "members": members, "price_changes": price_changes, "years": years, "seed": seed, "repeat": repeat,
+        },
+        "sizes": results,
+    }
+
+
+def regressions(results, baseline, latency_tolerance=0.25, query_tolerance=0):
+    """Elenco delle misure peggiorate rispetto alla baseline oltre le tolleranze"""
+    found = []
+    for size, benchmarks in baseline.get("sizes", {}).items():
+        for name, expected in benchmarks.items():
+            actual = results["sizes"].get(size, {}).get(name)
+            if actual is None:
+                continue
+            if actual["queries"] > expected["queries"] + query_tolerance:
+                found.append(f"{name}@{size}: {actual['queries']} queries (baseline {expected['queries']})")
+            if actual["median_ms"] > expected["median_ms"] * (1 + latency_tolerance):
+                found.append(f"{name}@{size}: {actual['median_ms']} ms (baseline {expected['median_ms']} ms)")
+    return found
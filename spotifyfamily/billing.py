@@ -0,0 +1,162 @@
+"""
+Calcolo dei periodi di rinnovo e degli importi dovuti.
+
+Le scadenze seguono la stessa semantica dei vecchi cicli con
+``relativedelta(months=renew_period)`` sommato ripetutamente: il giorno del
+mese viene troncato alla fine del mese e resta troncato per le scadenze
+successive (31/01 -> 28/02 -> 28/03 ...).
+"""
+from bisect import bisect_right
+from calendar import isleap, monthrange
+from datetime import date
+from math import gcd
+
+
+def _month_index(day):
+    return day.year * 12 + day.month - 1
+
+
+def _days_in_month(month_index):
+    year, month = divmod(month_index, 12)
+    return monthrange(year, month + 1)[1]
+
+
+def _from_month_index(month_index, day):
+    year, month = divmod(month_index, 12)
+    return date(year, month + 1, day)
+
+
+def shift_months(day, months):
+    """Equivalente di ``day + relativedelta(months=months)``"""
+    month_index = _month_index(day) + months
+    return _from_month_index(month_index, min(day.day, _days_in_month(month_index)))
+
+
+def _clamped_day(start, renew_period, periods):
+    """Giorno del mese della scadenza n-esima, con il troncamento cumulativo"""
+    day = start.day
+    if day <= 28 or periods <= 0:
+        return day
+
+    base = _month_index(start)
+    # I mesi visitati si ripetono ogni `cycle` periodi
+    cycle = 12 // gcd(renew_period, 12)
+    first_february = None
+    for k in range(1, min(periods, cycle) + 1):
+        month_index = base + k * renew_period
+        if month_index % 12 == 1:
+            first_february = k
+        else:
+            day = min(day, _days_in_month(month_index))
+
+    if first_february is not None and day > 28:
+        # Febbraio: basta trovare un anno non bisestile tra quelli visitati,
+        # il calendario gregoriano si ripete ogni 400 anni
+        first_year = (base + first_february * renew_period) // 12
+        step_years = renew_period * cycle // 12
+        visits = (periods - first_february) // cycle + 1
+        for i in range(min(visits, 400)):
+            day = min(day, 29 if isleap(first_year + i * step_years) else 28)
+            if day == 28:
+                break
+    return day
+
+
+def period_end(last_payment_date, renew_period, period):
+    """Data di scadenza del periodo n-esimo dopo l'ultimo pagamento"""
+    month_index = _month_index(last_payment_date) + period * renew_period
+    return _from_month_index(month_index, _clamped_day(last_payment_date, renew_period, period))
+
+
+def count_unpaid_periods(last_payment_date, renew_period, today=None):
+    """Numero di periodi scaduti (scadenza <= today) dall'ultimo pagamento"""
+    if renew_period < 1:
+        raise ValueError("renew_period must be a positive number of months")
+    today = today or date.today()
+    periods = (_month_index(today) - _month_index(last_payment_date)) // renew_period
+    if periods <= 0:
+        return 0
+    if period_end(last_payment_date, renew_period, periods) > today:
+        periods -= 1
+    return periods
+
+
+def current_cycle_start(start_date, renew_period, today=None):
+    """Inizio del ciclo di rinnovo in corso di una sottoscrizione iniziata il ``start_date``"""
+    today = today or date.today()
+    if today < start_date:
+        return start_date
+    return period_end(start_date, renew_period, count_unpaid_periods(start_date, renew_period, today))
+
+
+def unpaid_periods(last_payment_date, renew_period, today=None):
+    """Genera le coppie (inizio, scadenza) dei periodi non pagati"""
+    today = today or date.today()
+    count = count_unpaid_periods(last_payment_date, renew_period, today)
+    month_index = _month_index(last_payment_date)
+    day = last_payment_date.day
+    for _ in range(count):
+        month_index += renew_period
+        day = min(day, _days_in_month(month_index))
+        end = _from_month_index(month_index, day)
+        yield shift_months(end, -renew_period), end
+
+
+def price_per_user(price, user_count):
+    """Quota per utente di un prezzo, arrotondata al centesimo"""
+    if user_count == 0:
+        return price
+    return round(price / user_count, 2)
+
+
+class PriceSchedule:
+    """
+    Storico prezzi di una sottoscrizione ordinato per ``valid_from``.
+    Il prezzo di un periodo si trova con una ricerca binaria.
+    """
+
+    def __init__(self, prices):
+        self.prices = sorted(prices, key=lambda p: (p.valid_from, getattr(p, "id", None) or 0))
+        self._starts = [p.valid_from for p in self.prices]
+        # Massimo valid_to fino a ogni posizione (None = prezzo aperto)
+        self._reach = []
+        reach = date.min
+        for p in self.prices:
+            reach = date.max if p.valid_to is None else max(reach, p.valid_to)
+            self._reach.append(reach)
+
+    def __len__(self):
+        return len(self.prices)
+
+    def price_for_period(self, period_start, period_end):
+        """
+        Prezzo valido per il periodo: il più recente con valid_from <= scadenza
+        e valid_to nullo o >= inizio periodo.
+        """
+        i = bisect_right(self._starts, period_end)
+        while i > 0 and self._reach[i - 1] >= period_start:
+            i -= 1
+            price = self.prices[i]
+            if price.valid_to is None or price.valid_to >= period_start:
+                return price
+        return None
+
+
+def net_of_credit(amount, credit):
+    """Importo dovuto meno il credito del membro, mai sotto zero"""
+    if not credit:
+        return amount
+    return round(max(amount - float(credit), 0.0), 2)
+
+
+def amount_to_pay(last_payment_date, renew_period, schedule, user_count, today=None, credit=0):
+    """
+    Importo totale dovuto, usando per ogni periodo il prezzo valido in quel
+    periodo, meno il credito lasciato dai pagamenti precedenti.
+    """
+    total_amount = 0.0
+    for start, end in unpaid_periods(last_payment_date, renew_period, today):
+        price = schedule.price_for_period(start, end)
+        if price is not None:
+            total_amount += price_per_user(price.price, user_count)
+    return net_of_credit(round(total_amount, 2), credit)
@@ -0,0 +1,75 @@
+"""
+Calcolo degli importi dovuti direttamente nel database (solo PostgreSQL).
+
+I periodi non pagati sono generati dalla funzione ``spotifyfamily_unpaid_periods``
+(migrazione 0002) e uniti agli intervalli di validità di SubscriptionPrice;
+``spotifyfamily_round_cents`` replica ``round(x, 2)`` di Python.
+Gli arrotondamenti e l'ordine delle somme seguono quelli di ``billing``, così i
+risultati coincidono con il calcolo in Python, che resta il fallback per SQLite.
+"""
+from datetime import date
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import FloatField, IntegerField
+from django.db.models.expressions import RawSQL
+
+from .models import Subscription, SubscriptionDetail, SubscriptionPrice
+
+_DETAIL = f'"{SubscriptionDetail._meta.db_table}"'
+
+_PERIODS = f"""
+spotifyfamily_unpaid_periods(
+    {_DETAIL}."last_payment_date",
+    (SELECT s."renew_period" FROM "{Subscription._meta.db_table}" s WHERE s."id" = {_DETAIL}."subscription_id"),
+    %s
+)
+"""
+
+MONTHS_UNPAID_SQL = f"SELECT COUNT(*) FROM {_PERIODS}"
+
+# Come billing.net_of_credit: il credito del membro si sottrae al totale arrotondato
+AMOUNT_TO_PAY_SQL = f"""
+SELECT spotifyfamily_round_cents(GREATEST(
+    COALESCE(spotifyfamily_round_cents(SUM(x.per_user ORDER BY x.period)), 0)
+    - {_DETAIL}."credit"::double precision,
+    0
+))
+FROM (
+    SELECT u.period,
+           CASE WHEN uc.n = 0 THEN pr."price" ELSE spotifyfamily_round_cents(pr."price" / uc.n) END AS per_user
+    FROM {_PERIODS} AS u
+    CROSS JOIN (
+        SELECT COUNT(*) AS n FROM {_DETAIL} d
+        WHERE d."subscription_id" = {_DETAIL}."subscription_id"
+    ) AS uc
+    CROSS JOIN LATERAL (
+        SELECT p."price" FROM "{SubscriptionPrice._meta.db_table}" p
+        WHERE p."subscription_id" = {_DETAIL}."subscription_id"
+          AND p."valid_from" <= u.period_end
+          AND (p."valid_to" IS NULL OR p."valid_to" >= u.period_start)
+        ORDER BY p."valid_from" DESC, p."id" DESC
+        LIMIT 1
+    ) AS pr
+) AS x
+"""
+
+
+def is_enabled(queryset):
+    """Vero se il calcolo nel database è attivo per il database del queryset"""
+    return (
+        getattr(settings, "BILLING_BACKEND", "python") == "database"
+        and connections[queryset.db].vendor == "postgresql"
+    )
+
+
+def annotate_amounts(queryset, today=None):
+    """
+    Annota un queryset di SubscriptionDetail con ``months_unpaid`` e
+    ``amount_to_pay`` calcolati nel database.
+    """
+    today = today or date.today()
+    return queryset.annotate(
+        months_unpaid=RawSQL(MONTHS_UNPAID_SQL, (today,), output_field=IntegerField()),
+        amount_to_pay=RawSQL(AMOUNT_TO_PAY_SQL, (today,), output_field=FloatField()),
+    )
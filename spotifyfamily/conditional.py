@@ -0,0 +1,93 @@
+"""
+GET condizionali (ETag / Last-Modified) per la home e la pagina di modifica.
+
+I validatori si calcolano con una sola query sulle colonne ``revision`` e
+``updated_at`` di Subscription, prima di qualsiasi calcolo degli importi.
+Gli importi cambiano anche col passare dei giorni, quindi la data fa parte
+dell'ETag e Last-Modified non è mai precedente alla mezzanotte di oggi.
+L'ETag include utente e token CSRF: la pagina contiene entrambi.
+"""
+import hashlib
+from datetime import date, datetime, time, timezone as dt_timezone
+from functools import wraps
+
+from django.db.models import Count, Max, Sum
+from django.middleware.csrf import get_token
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+from .models import Subscription
+
+
+def _has_messages(request):
+    # I messaggi in attesa vanno mostrati: la pagina non può venire dalla cache
+    storage = getattr(request, "_messages", None)
+    return storage is not None and len(storage) > 0
+
+
+def _etag(request, *parts):
+    # get_token crea il segreto CSRF se manca: la risposta imposterà lo stesso cookie
+    get_token(request)
+    raw = "|".join(str(part) for part in (
+        *parts, date.today().isoformat(), request.user.pk, request.META.get("CSRF_COOKIE", ""),
+    ))
+    return '"{}"'.format(hashlib.blake2b(raw.encode(), digest_size=16).hexdigest())
+
+
+def _last_modified(updated_at):
+    midnight = datetime.combine(date.today(), time.min, tzinfo=dt_timezone.utc)
+    return max(updated_at, midnight) if updated_at else midnight
+
+
+def dashboard_validators(request):
+    """(ETag, Last-Modified) della home: cambiano se cambia una qualsiasi sottoscrizione"""
+    summary = Subscription.objects.aggregate(count=Count("id"), revisions=Sum("revision"), updated_at=Max("updated_at"))
+    etag = _etag(request, "home", summary["count"], summary["revisions"] or 0, summary["updated_at"])
+    return etag, _last_modified(summary["updated_at"])
+
+
+def subscription_validators(request, pk):
+    """(ETag, Last-Modified) della pagina di modifica; None se la vista non mostra la pagina"""
+    row = Subscription.objects.filter(pk=pk).values("revision", "updated_at", "admin_user_id").first()
+    if row is None or row["admin_user_id"] != request.user.pk:
+        return None, None
+    return _etag(request, "edit", pk, row["revision"], row["updated_at"]), _last_modified(row["updated_at"])
+
+
+def _validators(validators, request, args, kwargs):
+    if request.method not in ("GET", "HEAD") or _has_messages(request):
+        return None, None
+    return validators(request, *args, **kwargs)
+
+
+def _not_modified(request, etag, last_modified):
+    if etag is None:
+        return None
+    return get_conditional_response(request, etag=etag, last_modified=int(last_modified.timestamp()))
+
+
+def _set_headers(response, etag, last_modified):
+    if etag is None:
+        return response
+    response.headers.setdefault("ETag", etag)
+    response.headers.setdefault("Last-Modified", http_date(last_modified.timestamp()))
+    # Il browser deve sempre rivalidare, e la pagina è personale
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def conditional_page(validators):
+    """
+    Come django.views.decorators.http.condition, con un'unica funzione che
+    ritorna (etag, last_modified).
+    """
+    def decorator(view):
+        @wraps(view)
+        def inner(request, *args, **kwargs):
+            etag, last_modified = _validators(validators, request, args, kwargs)
+            response = _not_modified(request, etag, last_modified)
+            if response is None:
+                response = view(request, *args, **kwargs)
+            return _set_headers(response, etag, last_modified)
+        return inner
+    return decorator
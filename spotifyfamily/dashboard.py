@@ -0,0 +1,117 @@
+"""Costruzione dei dati della home con un numero fisso di query"""
+from collections import defaultdict
+from datetime import date
+
+from . import billing, billing_db, fragments, ledger, routers
+from .models import Subscription, SubscriptionDetail, SubscriptionPrice
+
+
+def payment_row(detail, renew_period, schedule, user_count, today):
+    """Stato dei pagamenti di un utente per la tabella della home"""
+    if hasattr(detail, 'amount_to_pay'):
+        # Importi già calcolati dal database (billing_db o registro degli addebiti)
+        months_count = detail.months_unpaid
+        amount_to_pay = detail.amount_to_pay
+    else:
+        months_count = billing.count_unpaid_periods(detail.last_payment_date, renew_period, today)
+        amount_to_pay = billing.amount_to_pay(
+            detail.last_payment_date, renew_period, schedule, user_count, today, detail.credit
+        )
+    return {
+        'user': detail.user,
+        'last_paid_month': detail.last_payment_date.strftime("%B %Y"),
+        'amount_to_pay': amount_to_pay,
+        'months_unpaid': months_count,
+        'is_overdue': months_count > 0,
+    }
+
+
+def block_querysets(subscriptions, today, load_all=False):
+    """Query dei prezzi e dei dettagli delle sottoscrizioni indicate"""
+    prices = SubscriptionPrice.objects.order_by('-valid_from')
+    details = SubscriptionDetail.objects.select_related('user').order_by('pk')
+    if not load_all:
+        ids = [subscription.id for subscription in subscriptions]
+        prices = prices.filter(subscription_id__in=ids)
+        details = details.filter(subscription_id__in=ids)
+    if billing_db.is_enabled(details):
+        details = billing_db.annotate_amounts(details, today)
+    elif ledger.is_enabled():
+        details = ledger.annotate_amounts(details)
+    return prices, details
+
+
+def build_blocks(subscriptions, today, load_all=False):
+    """
+    Calcola prezzi e stato pagamenti per le sottoscrizioni indicate.
+    Prezzi e dettagli vengono caricati con una query ciascuno e raggruppati in memoria.
+    """
+    prices, details = block_querysets(subscriptions, today, load_all)
+    return assemble_blocks(subscriptions, prices, details, today)
+
+
+def assemble_blocks(subscriptions, prices, details, today):
+    """Raggruppa prezzi e dettagli già caricati nei blocchi per sottoscrizione"""
+    prices_by_subscription = defaultdict(list)
+    for price in prices:
+        prices_by_subscription[price.subscription_id].append(price)
+
+    details_by_subscription = defaultdict(list)
+    for detail in details:
+        details_by_subscription[detail.subscription_id].append(detail)
+
+    blocks = {}
+    for subscription in subscriptions:
+        subscription_prices = prices_by_subscription[subscription.id]
+        subscription_details = details_by_subscription[subscription.id]
+        schedule = billing.PriceSchedule(subscription_prices)
+        blocks[subscription.id] = {
+            'prices': subscription_prices,
+            'user_payments': [
+                payment_row(detail, subscription.renew_period, schedule, len(subscription_details), today)
+                for detail in subscription_details
+            ],
+        }
+    return blocks
+
+
+def _recently_changed(missing):
+    """
+    Con le repliche attive, i blocchi delle sottoscrizioni appena modificate
+    vanno letti dal primario: una replica in ritardo finirebbe in cache sotto
+    la nuova revisione.
+    """
+    return bool(routers.replica_aliases()) and bool(fragments.recently_changed(missing))
+
+
+def _from_primary(missing):
+    return list(Subscription.objects.filter(id__in=[subscription.id for subscription in missing]))
+
+
+def build_subscriptions_data(today=None):
+    """
+    Ritorna i dati di tutte le sottoscrizioni con lo stato dei pagamenti.
+    I blocchi già in cache per la revisione corrente non vengono ricalcolati.
+    """
+    today = today or date.today()
+    subscriptions = list(Subscription.objects.select_related('admin_user').order_by("-start_date"))
+
+    revisions = fragments.get_revisions(subscriptions)
+    blocks = fragments.get_blocks(revisions, today)
+    missing = [subscription for subscription in subscriptions if subscription.id not in blocks]
+    if missing:
+        load_all = len(missing) == len(subscriptions)
+        if _recently_changed(missing):
+            with routers.use_primary():
+                built = build_blocks(_from_primary(missing), today, load_all)
+        else:
+            built = build_blocks(missing, today, load_all)
+        fragments.set_blocks(built, revisions, today)
+        blocks.update(built)
+
+    # Una sottoscrizione appena eliminata può mancare dal primario
+    return [
+        {'subscription': subscription, **blocks[subscription.id]}
+        for subscription in subscriptions
+        if subscription.id in blocks
+    ]
@@ -0,0 +1,200 @@
+"""
+Previsione degli importi dovuti da tutti i membri nei prossimi mesi.
+
+Pagamenti e prezzi vengono caricati una volta sola in array NumPy; le
+scadenze di tutti i membri sono generate in un unico array piatto e il
+prezzo di ogni periodo si trova con una ricerca binaria vettoriale.
+I risultati coincidono con ``billing.amount_to_pay`` calcolato alla data
+di ogni orizzonte, supponendo che nel frattempo nessuno paghi.
+"""
+from collections import namedtuple
+from datetime import date
+
+import numpy as np
+
+from . import billing
+from .models import SubscriptionDetail, SubscriptionPrice
+
+DEFAULT_HORIZONS = (3, 6, 12)
+MONTH_DAYS = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+# Ampiezza delle chiavi (sottoscrizione, data): nessun ordinale supera 2**22
+SPAN = 1 << 22
+
+_Price = namedtuple("_Price", ["id", "price", "valid_from", "valid_to", "index"])
+
+
+def _month_days(month_index):
+    year, month = np.divmod(month_index, 12)
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    return MONTH_DAYS[month] + ((month == 1) & leap)
+
+
+def _ordinal(month_index, day):
+    """Ordinale (come date.toordinal) di un array di (mese, giorno)"""
+    months = (month_index - 1970 * 12).astype("datetime64[M]")
+    days = months.astype("datetime64[D]") + (day - 1)
+    return days.astype(np.int64) + EPOCH_ORDINAL
+
+
+def _dates_to_ordinals(dates, missing=SPAN - 1):
+    return np.array([missing if d is None else d.toordinal() for d in dates], dtype=np.int64)
+
+
+def load(subscription_ids=None):
+    """Membri e prezzi (eventualmente solo delle sottoscrizioni indicate), due query"""
+    details = SubscriptionDetail.objects.all()
+    prices = SubscriptionPrice.objects.all()
+    if subscription_ids is not None:
+        details = details.filter(subscription_id__in=subscription_ids)
+        prices = prices.filter(subscription_id__in=subscription_ids)
+    details = list(details.order_by("subscription_id", "id").values_list(
+        "id", "subscription_id", "user_id", "user__username", "last_payment_date", "subscription__renew_period",
+        "credit",
+    ))
+    prices = list(prices.order_by("subscription_id", "valid_from", "id").values_list(
+        "id", "subscription_id", "price", "valid_from", "valid_to",
+    ))
+    return details, prices
+
+
+def _unpaid_periods(last_payment, renew_period, until):
+    """
+    Tutti i periodi con scadenza <= max(until) di tutti i membri, in un array
+    piatto ordinato per membro. Ritorna (membro, inizio, scadenza) come ordinali.
+    """
+    base = last_payment.astype("datetime64[M]").astype(np.int64) + 1970 * 12
+    first_day = (last_payment - last_payment.astype("datetime64[M]").astype("datetime64[D]")).astype(np.int64) + 1
+
+    until_month = int(np.datetime64(until, "M").astype(np.int64)) + 1970 * 12
+    valid = renew_period >= 1
+    counts = np.where(valid, np.maximum(until_month - base, 0) // np.where(valid, renew_period, 1), 0)
+
+    member = np.repeat(np.arange(len(base)), counts)
+    offsets = np.cumsum(counts) - counts
+    k = np.arange(len(member)) - np.repeat(offsets, counts) + 1
+    renew = renew_period[member]
+    month_index = base[member] + k * renew
+
+    # Troncamento cumulativo del giorno: minimo progressivo dei giorni del mese
+    # per ogni membro. Lo scostamento di 64 per membro impedisce al minimo di
+    # attraversare i confini tra membri.
+    shift = member.astype(np.int64) * 64
+    day = np.minimum.accumulate(_month_days(month_index) - shift) + shift
+    day = np.minimum(day, first_day[member])
+
+    end = _ordinal(month_index, day)
+    start_month = month_index - renew
+    start = _ordinal(start_month, np.minimum(day, _month_days(start_month)))
+    return member, start, end
+
+
+def _period_shares(prices, subscription_of_period, start, end, user_counts):
+    """Quota per utente del prezzo valido in ogni periodo (0 se nessun prezzo)"""
+    if not prices or not len(end):
+        return np.zeros(len(end))
+    price_subscription = np.array([p[1] for p in prices], dtype=np.int64)
+    valid_from = _dates_to_ordinals([p[3] for p in prices])
+    valid_to = _dates_to_ordinals([p[4] for p in prices])
+    shares = np.array([
+        billing.price_per_user(p[2], user_counts.get(p[1], 0)) for p in prices
+    ])
+
+    # Candidato: il prezzo più recente con valid_from <= scadenza
+    keys = price_subscription * SPAN + valid_from
+    candidate = np.searchsorted(keys, subscription_of_period * SPAN + end, side="right") - 1
+    candidate_ok = candidate >= 0
+    candidate = np.maximum(candidate, 0)
+    same_subscription = candidate_ok & (price_subscription[candidate] == subscription_of_period)
+    found = same_subscription & (valid_to[candidate] >= start)
+
+    result = np.where(found, shares[candidate], 0.0)
+
+    # Con uno storico sovrapposto un prezzo precedente può coprire ancora il
+    # periodo: quei casi rari passano per la ricerca di billing.PriceSchedule
+    shift = price_subscription * SPAN
+    reach = np.maximum.accumulate(valid_to + shift) - shift
+    fallback = np.nonzero(same_subscription & ~found & (reach[candidate] >= start))[0]
+    if len(fallback):
+        schedules = {}
+        for i in fallback:
+            subscription_id = int(subscription_of_period[i])
+            if subscription_id not in schedules:
+                schedules[subscription_id] = billing.PriceSchedule([
+                    _Price(p[0], p[2], p[3], p[4], index)
+                    for index, p in enumerate(prices) if p[1] == subscription_id
+                ])
+            price = schedules[subscription_id].price_for_period(
+                date.fromordinal(int(start[i])), date.fromordinal(int(end[i])),
+            )
+            if price is not None:
+                result[i] = shares[price.index]
+    return result
+
+
+def forecast(horizons=DEFAULT_HORIZONS, today=None, subscription_ids=None):
+    """
+    Importo dovuto da ogni membro oggi e alla fine di ogni orizzonte (in mesi),
+    con i totali per sottoscrizione e complessivi.
+    """
+    today = today or date.today()
+    horizons = sorted(set(horizons))
+    dates = {0: today, **{h: billing.shift_months(today, h) for h in horizons}}
+    details, prices = load(subscription_ids)
+
+    subscription_of_member = np.array([d[1] for d in details], dtype=np.int64)
+    last_payment = np.array([d[4] for d in details], dtype="datetime64[D]")
+    renew_period = np.array([d[5] for d in details], dtype=np.int64)
+    counted, user_counts = np.unique(subscription_of_member, return_counts=True)
+    user_counts = dict(zip(counted.tolist(), user_counts.tolist()))
+
+    member, start, end = _unpaid_periods(last_payment, renew_period, max(dates.values()))
+    shares = _period_shares(prices, subscription_of_member[member], start, end, user_counts)
+
+    due = {}
+    for horizon, day in dates.items():
+        # bincount somma nell'ordine dei periodi, come il ciclo di amount_to_pay
+        mask = end <= day.toordinal()
+        amounts = np.bincount(member[mask], weights=shares[mask], minlength=len(details))
+        due[horizon] = [
+            billing.net_of_credit(round(amount, 2), detail[6]) for amount, detail in zip(amounts.tolist(), details)
+        ]
+
+    members = []
+    subscriptions = {}
+    for i, (detail_id, subscription_id, user_id, username, last_payment_date, *_) in enumerate(details):
+        row = {
+            "id": detail_id,
+            "subscription_id": subscription_id,
+            "user_id": user_id,
+            "username": username,
+            "last_payment_date": last_payment_date,
+            "outstanding": due[0][i],
+            "due": {str(h): due[h][i] for h in horizons},
+        }
+        members.append(row)
+        totals = subscriptions.setdefault(subscription_id, {
+            "subscription_id": subscription_id,
+            "members": 0,
+            "outstanding": 0.0,
+            "due": {str(h): 0.0 for h in horizons},
+        })
+        totals["members"] += 1
+        totals["outstanding"] += row["outstanding"]
+        for h in horizons:
+            totals["due"][str(h)] += row["due"][str(h)]
+
+    subscriptions = list(subscriptions.values())
+    for totals in subscriptions:
+        totals["outstanding"] = round(totals["outstanding"], 2)
+        totals["due"] = {h: round(amount, 2) for h, amount in totals["due"].items()}
+    return {
+        "today": today,
+        "horizons": {str(h): dates[h] for h in horizons},
+        "members": members,
+        "subscriptions": subscriptions,
+        "total": {
+            "outstanding": round(sum(t["outstanding"] for t in subscriptions), 2),
+            "due": {str(h): round(sum(t["due"][str(h)] for t in subscriptions), 2) for h in horizons},
+        },
+    }
@@ -0,0 +1,8 @@
+from django import forms
+
+
+class PaymentImportForm(forms.Form):
+    csv_file = forms.FileField(
+        label="CSV file",
+        help_text="Columns: username, subscription (id or name), amount, date (YYYY-MM-DD)",
+    )
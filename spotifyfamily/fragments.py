@@ -0,0 +1,80 @@
+"""
+Cache dei blocchi della home (prezzi e stato pagamenti) per sottoscrizione.
+
+Ogni blocco è salvato sotto una chiave che contiene la revisione della
+sottoscrizione (colonna ``Subscription.revision``, letta insieme alle
+sottoscrizioni) e la data del giorno: le azioni che modificano i dati
+incrementano la revisione nel database, il cambio di data invalida gli importi.
+"""
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Subscription
+
+BLOCK_KEY = "subscription-block:{}:{}:{}"
+BLOCK_TIMEOUT = 60 * 60 * 24
+
+_stats = {"hits": 0, "misses": 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name, value):
+    with _stats_lock:
+        _stats[name] += value
+
+
+def stats():
+    """Contatori di hit/miss del processo corrente"""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _stats_lock:
+        for name in _stats:
+            _stats[name] = 0
+
+
+def get_revisions(subscriptions):
+    """
+    Ritorna {id sottoscrizione: revisione} dalla colonna ``Subscription.revision``
+    delle sottoscrizioni già caricate: tutti i processi vedono la stessa
+    revisione anche con una cache locale al processo.
+    """
+    return {subscription.id: subscription.revision for subscription in subscriptions}
+
+
+def bump_revision(subscription_id):
+    """Invalida i blocchi in cache di una sottoscrizione e registra la modifica nel database"""
+    Subscription.objects.filter(pk=subscription_id).update(revision=F("revision") + 1, updated_at=timezone.now())
+
+
+def recently_changed(subscriptions):
+    """Sottoscrizioni modificate negli ultimi REPLICA_PIN_SECONDS secondi"""
+    since = timezone.now() - timedelta(seconds=settings.REPLICA_PIN_SECONDS)
+    return {subscription.id for subscription in subscriptions if subscription.updated_at >= since}
+
+
+def _block_key(subscription_id, revision, today):
+    return BLOCK_KEY.format(subscription_id, revision, today.isoformat())
+
+
+def get_blocks(revisions, today):
+    """Ritorna i blocchi in cache per le revisioni correnti"""
+    keys = {_block_key(pk, revision, today): pk for pk, revision in revisions.items()}
+    found = cache.get_many(keys)
+    _count("hits", len(found))
+    _count("misses", len(keys) - len(found))
+    return {keys[key]: block for key, block in found.items()}
+
+
+def set_blocks(blocks, revisions, today):
+    cache.set_many(
+        {_block_key(pk, revisions[pk], today): block for pk, block in blocks.items()},
+        timeout=BLOCK_TIMEOUT,
+    )
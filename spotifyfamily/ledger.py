@@ -0,0 +1,200 @@
+"""
+Registro degli addebiti (``Charge``): una riga per membro per periodo di
+rinnovo, alla quota valida in quel periodo.
+
+``run_billing`` è incrementale e idempotente: considera solo i membri con un
+periodo scaduto dopo l'ultimo addebito (o dopo l'ultimo pagamento) e inserisce
+i periodi mancanti con ``bulk_create``. L'importo dovuto diventa la somma
+degli addebiti non ancora coperti da ``last_payment_date``, che i pagamenti
+fanno avanzare: una sola query aggregata, senza ricalcolare i periodi.
+Se un prezzo cambia dopo la generazione vengono ricalcolati solo gli
+addebiti dei periodi interessati (``reprice``); se cambia il numero di
+membri, solo quelli ancora da pagare. Se cambiano durata del rinnovo o data
+di inizio, gli addebiti da pagare vengono rigenerati (``rebill``).
+
+Con ``BILLING_BACKEND = "ledger"`` la home legge gli importi dal registro.
+"""
+from datetime import date
+from itertools import islice
+
+from django.conf import settings
+from django.db.models import Count, F, FloatField, IntegerField, Max, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Cast, Coalesce, Greatest, Round
+
+from . import billing, fragments, prices, reminders
+from .models import Charge, Subscription, SubscriptionDetail
+
+CHUNK_SIZE = 2000
+
+
+def is_enabled():
+    return getattr(settings, "BILLING_BACKEND", "python") == "ledger"
+
+
+def _share(schedule, user_count, start, end):
+    price = schedule.price_for_period(start, end)
+    return billing.price_per_user(price.price, user_count) if price is not None else 0.0
+
+
+def _user_counts(subscription_ids):
+    return dict(
+        SubscriptionDetail.objects.filter(subscription_id__in=subscription_ids)
+        .values_list("subscription_id").annotate(Count("id")).order_by()
+    )
+
+
+def pending_details(today=None, full=False):
+    """
+    Membri con almeno un periodo da addebitare: l'ultimo periodo coperto
+    (addebito o pagamento) è entro la data limite della loro durata di rinnovo.
+    """
+    today = today or date.today()
+    queryset = SubscriptionDetail.objects.filter(subscription__renew_period__gt=0)
+    if not full:
+        queryset = queryset.annotate(
+            anchor=Greatest("last_payment_date", Coalesce(Max("charges__period_end"), "last_payment_date")),
+        )
+        condition = Q(pk__in=[])
+        renew_periods = Subscription.objects.filter(renew_period__gt=0).values_list("renew_period", flat=True)
+        for renew_period in renew_periods.distinct():
+            condition |= Q(
+                subscription__renew_period=renew_period,
+                anchor__lte=reminders.overdue_cutoff(renew_period, today),
+            )
+        queryset = queryset.filter(condition)
+    return queryset.order_by("id").values_list("id", "subscription_id", "last_payment_date", "subscription__renew_period")
+
+
+def _bill_chunk(rows, today):
+    """Allinea gli addebiti da pagare dei membri del blocco; ritorna (creati, eliminati, sottoscrizioni)"""
+    subscription_ids = {row[1] for row in rows}
+    schedules = prices.get_schedules(subscription_ids)
+    user_counts = _user_counts(subscription_ids)
+
+    existing = {}
+    for charge_id, detail_id, period_end in Charge.objects.filter(
+        subscription_detail_id__in=[row[0] for row in rows],
+        period_end__gt=F("subscription_detail__last_payment_date"),
+    ).values_list("id", "subscription_detail_id", "period_end"):
+        existing.setdefault(detail_id, {})[period_end] = charge_id
+
+    new_charges, stale, changed = [], [], set()
+    for detail_id, subscription_id, last_payment_date, renew_period in rows:
+        charged = existing.get(detail_id, {})
+        expected = set()
+        for start, end in billing.unpaid_periods(last_payment_date, renew_period, today):
+            expected.add(end)
+            if end not in charged:
+                new_charges.append(Charge(
+                    subscription_detail_id=detail_id, period_start=start, period_end=end,
+                    amount=_share(schedules[subscription_id], user_counts.get(subscription_id, 0), start, end),
+                ))
+                changed.add(subscription_id)
+        # Addebiti di una sequenza di periodi diversa (ultimo pagamento modificato a mano)
+        outdated = [charge_id for end, charge_id in charged.items() if end not in expected]
+        if outdated:
+            stale.extend(outdated)
+            changed.add(subscription_id)
+
+    if stale:
+        Charge.objects.filter(pk__in=stale).delete()
+    # Due esecuzioni concorrenti non duplicano i periodi
+    Charge.objects.bulk_create(new_charges, batch_size=CHUNK_SIZE, ignore_conflicts=True)
+    return len(new_charges), len(stale), changed
+
+
+def run_billing(today=None, chunk_size=CHUNK_SIZE, full=False):
+    """
+    Genera gli addebiti dei periodi scaduti fino a ``today``. Con ``full``
+    ricontrolla tutti i membri invece dei soli con periodi nuovi.
+    Ritorna {"members": ..., "created": ..., "deleted": ...}.
+    """
+    today = today or date.today()
+    result = {"members": 0, "created": 0, "deleted": 0}
+    changed = set()
+    rows = pending_details(today, full).iterator(chunk_size=chunk_size)
+    while chunk := list(islice(rows, chunk_size)):
+        created, deleted, subscriptions = _bill_chunk(chunk, today)
+        result["members"] += len(chunk)
+        result["created"] += created
+        result["deleted"] += deleted
+        changed |= subscriptions
+    for subscription_id in changed:
+        fragments.bump_revision(subscription_id)
+    return result
+
+
+def rebill(subscription_id, today=None):
+    """
+    Rigenera gli addebiti da pagare di una sottoscrizione dopo un cambio di
+    durata del rinnovo o di data di inizio: quelli della vecchia sequenza di
+    periodi vengono eliminati e quelli nuovi creati. Non fa niente se la
+    sottoscrizione non ha ancora addebiti. Ritorna (creati, eliminati).
+    """
+    if not Charge.objects.filter(subscription_detail__subscription_id=subscription_id).exists():
+        return 0, 0
+    rows = list(
+        SubscriptionDetail.objects.filter(subscription_id=subscription_id).order_by("id")
+        .values_list("id", "subscription_id", "last_payment_date", "subscription__renew_period")
+    )
+    created, deleted, changed = _bill_chunk(rows, today or date.today())
+    if changed:
+        fragments.bump_revision(subscription_id)
+    return created, deleted
+
+
+def reprice(subscription_id, since=None, unpaid_only=False):
+    """
+    Ricalcola gli addebiti di una sottoscrizione con ``period_end >= since``
+    (o solo quelli ancora da pagare); aggiorna solo le righe cambiate.
+    """
+    charges = Charge.objects.filter(subscription_detail__subscription_id=subscription_id)
+    if since is not None:
+        charges = charges.filter(period_end__gte=since)
+    if unpaid_only:
+        charges = charges.filter(period_end__gt=F("subscription_detail__last_payment_date"))
+    charges = list(charges.only("id", "period_start", "period_end", "amount"))
+    if not charges:
+        return 0
+    schedule = prices.get_schedule(subscription_id)
+    user_count = _user_counts([subscription_id]).get(subscription_id, 0)
+    changed = []
+    for charge in charges:
+        amount = _share(schedule, user_count, charge.period_start, charge.period_end)
+        if amount != charge.amount:
+            charge.amount = amount
+            changed.append(charge)
+    Charge.objects.bulk_update(changed, ["amount"], batch_size=CHUNK_SIZE)
+    return len(changed)
+
+
+def _unpaid_charges():
+    return Charge.objects.filter(
+        subscription_detail=OuterRef("pk"), period_end__gt=OuterRef("last_payment_date"),
+    ).order_by().values("subscription_detail")
+
+
+def annotate_amounts(queryset):
+    """
+    Annota un queryset di SubscriptionDetail con ``months_unpaid`` e
+    ``amount_to_pay`` letti dal registro degli addebiti, al netto del credito.
+    """
+    charges = Coalesce(
+        Round(Subquery(_unpaid_charges().annotate(total=Sum("amount")).values("total")), 2),
+        Value(0.0), output_field=FloatField(),
+    )
+    return queryset.annotate(
+        months_unpaid=Coalesce(
+            Subquery(_unpaid_charges().annotate(n=Count("id")).values("n"), output_field=IntegerField()), Value(0),
+        ),
+        amount_to_pay=Round(
+            Greatest(charges - Cast("credit", FloatField()), Value(0.0), output_field=FloatField()), 2,
+        ),
+    )
+
+
+def outstanding(queryset=None):
+    """Totale dovuto dai membri del queryset (tutti se None), con una query"""
+    queryset = SubscriptionDetail.objects.all() if queryset is None else queryset
+    total = annotate_amounts(queryset).aggregate(total=Sum("amount_to_pay"))["total"]
+    return round(total or 0.0, 2)
@@ -0,0 +1,251 @@
+"""
+Strumenti per i test di carico via HTTP contro un server gunicorn reale.
+
+Il server viene avviato in un sottoprocesso con la configurazione di
+``gunicorn.conf.py`` (variabili d'ambiente) e usa lo stesso database del
+processo corrente.
+
+``run_mix`` simula più famiglie in parallelo: ogni client fa login come
+amministratore di una sottoscrizione e poi alterna login, home, pagina di
+modifica e registrazione di pagamenti secondo i pesi indicati, con sessione
+e token CSRF come un browser.
+"""
+import http.cookiejar
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from collections import Counter, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date
+
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.http import HttpRequest
+from django.http.cookie import parse_cookie
+
+from .models import Subscription, SubscriptionDetail
+
+
+def _wait_for_port(port, process, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with code {process.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"gunicorn did not start listening on port {port}")
+
+
+@contextmanager
+def gunicorn(port, workers=1, worker_class="sync", threads=1, env=None):
+    """Avvia gunicorn sulla porta indicata e lo ferma all'uscita"""
+    environment = {
+        **os.environ,
+        "GUNICORN_BIND": f"127.0.0.1:{port}",
+        "GUNICORN_WORKERS": str(workers),
+        "GUNICORN_WORKER_CLASS": worker_class,
+        "GUNICORN_THREADS": str(threads),
+        **(env or {}),
+    }
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py"],
+        cwd=settings.BASE_DIR, env=environment,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        _wait_for_port(port, process)
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def percentile(values, p):
+    """Percentile con interpolazione lineare (values ordinati)"""
+    if not values:
+        return None
+    k = (len(values) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def summarize(latencies, errors, elapsed):
+    """Throughput, percentili di latenza (ms) e tasso di errore"""
+    latencies = sorted(latencies)
+    total = len(latencies) + errors
+    return {
+        "requests": total,
+        "errors": errors,
+        "error_rate": round(errors / total, 4) if total else 0.0,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 2) if latencies else None,
+        **{
+            f"p{p}_ms": round(percentile(latencies, p) * 1000, 2) if latencies else None
+            for p in (50, 95, 99)
+        },
+    }
+
+
+ACTIONS = ("login", "dashboard", "edit", "payment")
+DEFAULT_MIX = {"login": 1, "dashboard": 6, "edit": 2, "payment": 1}
+
+# Amministratore di una sottoscrizione e membri a cui registrare i pagamenti
+Household = namedtuple("Household", ["username", "subscription_id", "member_ids"])
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # Si misura la singola risposta, non anche la pagina a cui rimanda
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class BrowserClient:
+    """Client HTTP con i suoi cookie (sessione e CSRF), come un browser"""
+
+    def __init__(self, base_url, timeout=30.0):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.reset()
+
+    def reset(self):
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cookies), _NoRedirect())
+
+    def csrf_token(self):
+        return next((cookie.value for cookie in self.cookies if cookie.name == settings.CSRF_COOKIE_NAME), "")
+
+    def request(self, path, data=None):
+        """GET (o POST con ``data``); ritorna (latenza in secondi, status o None se la connessione fallisce)"""
+        body = None
+        if data is not None:
+            body = urllib.parse.urlencode({**data, "csrfmiddlewaretoken": self.csrf_token()}).encode()
+        start = time.perf_counter()
+        try:
+            with self.opener.open(urllib.request.Request(self.base_url + path, data=body), timeout=self.timeout) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as error:
+            error.read()
+            status = error.code
+        except (urllib.error.URLError, OSError):
+            status = None
+        return time.perf_counter() - start, status
+
+    def take_messages(self):
+        """
+        Messaggi flash lasciati dalle risposte precedenti (solo quelli nel
+        cookie), tolti dal client come se una pagina li avesse mostrati.
+        """
+        found = []
+        for cookie in list(self.cookies):
+            if cookie.name != CookieStorage.cookie_name:
+                continue
+            self.cookies.clear(cookie.domain, cookie.path, cookie.name)
+            value = parse_cookie(f"{cookie.name}={cookie.value}").get(cookie.name)
+            found += CookieStorage(HttpRequest())._decode(value) or []
+        return found
+
+    def login(self, username, password):
+        """Login completo con una sessione nuova: pagina di login e POST delle credenziali"""
+        self.reset()
+        get_latency, status = self.request("/login/")
+        if status != 200:
+            return get_latency, False
+        post_latency, status = self.request("/login/", {"username": username, "password": password})
+        return get_latency + post_latency, status == 302
+
+
+def households(prefix, limit=None):
+    """Sottoscrizioni i cui amministratori hanno username ``<prefix>-...`` (vedi synthetic.generate)"""
+    subscriptions = list(
+        Subscription.objects.filter(admin_user__username__startswith=f"{prefix}-")
+        .order_by("pk").values_list("pk", "admin_user__username")[:limit]
+    )
+    members = defaultdict(list)
+    for subscription_id, user_id in SubscriptionDetail.objects.filter(
+        subscription_id__in=[pk for pk, _ in subscriptions],
+    ).order_by("pk").values_list("subscription_id", "user_id"):
+        members[subscription_id].append(user_id)
+    return [Household(username, pk, members[pk]) for pk, username in subscriptions if members[pk]]
+
+
+def _action(client, household, password, name, rng):
+    if name == "login":
+        return client.login(household.username, password)
+    if name == "dashboard":
+        latency, status = client.request("/")
+        return latency, status == 200
+    if name == "edit":
+        latency, status = client.request(f"/subscription/{household.subscription_id}/edit/")
+        return latency, status == 200
+    if name == "payment":
+        member_id = rng.choice(household.member_ids)
+        client.take_messages()
+        latency, status = client.request(
+            f"/subscription/{household.subscription_id}/user/{member_id}/payment/",
+            {
+                "amount_paid": f"{rng.uniform(1, 10):.2f}",
+                "payment_date": date.today().isoformat(),
+                "idempotency_key": str(uuid.UUID(int=rng.getrandbits(128))),
+            },
+        )
+        # La vista rimanda alla home anche quando il pagamento fallisce: l'esito è nel messaggio
+        failed = any(message.level == messages.ERROR for message in client.take_messages())
+        return latency, status == 302 and not failed
+    raise ValueError(f"Unknown action: {name}")
+
+
+def run_mix(base_url, households, password, clients, duration, mix=None, seed=0):
+    """
+    ``clients`` famiglie in parallelo per ``duration`` secondi. Ritorna le
+    statistiche per azione e totali (vedi ``summarize``).
+    """
+    mix = mix or DEFAULT_MIX
+    names = [name for name in ACTIONS if mix.get(name)]
+    weights = [mix[name] for name in names]
+    deadline = time.perf_counter() + duration
+
+    def run_client(number):
+        rng = random.Random(seed * 1_000_003 + number)
+        household = households[number % len(households)]
+        client = BrowserClient(base_url)
+        results = [("login", *client.login(household.username, password))]
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights)[0]
+            results.append((name, *_action(client, household, password, name, rng)))
+        return results
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        results = [row for rows in executor.map(run_client, range(clients)) for row in rows]
+    elapsed = time.perf_counter() - start
+
+    latencies, errors = defaultdict(list), Counter()
+    for name, latency, ok in results:
+        for key in (name, "total"):
+            if ok:
+                latencies[key].append(latency)
+            else:
+                errors[key] += 1
+    return {
+        key: summarize(latencies[key], errors[key], elapsed)
+        for key in (*ACTIONS, "total") if key in latencies or key in errors
+    }
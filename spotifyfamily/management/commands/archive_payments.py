@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from spotifyfamily import rollups
+
+
+class Command(BaseCommand):
+    help = (
+        "Sposta in ArchivedPayment i pagamenti più vecchi del periodo di conservazione; "
+        "i totali mensili restano invariati"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--retention-months", type=int, default=settings.PAYMENT_RETENTION_MONTHS,
+            help="Mesi di pagamenti da tenere nella tabella Payment (default: PAYMENT_RETENTION_MONTHS)",
+        )
+        parser.add_argument("--batch-size", type=int, default=rollups.BATCH_SIZE)
+        parser.add_argument("--rebuild-rollups", action="store_true", help="Ricalcola prima tutti i totali mensili")
+
+    def handle(self, *args, **options):
+        if options["retention_months"] < 1 or options["batch_size"] < 1:
+            raise CommandError("--retention-months and --batch-size must be positive.")
+        if options["rebuild_rollups"]:
+            self.stdout.write(f"{rollups.rebuild()} monthly rollups rebuilt")
+        before = rollups.retention_cutoff(options["retention_months"])
+        moved = rollups.archive_payments(before, options["batch_size"])
+        self.stdout.write(f"{moved} payment(s) before {before} archived")
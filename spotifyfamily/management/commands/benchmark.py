@@ -0,0 +1,57 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from spotifyfamily import benchmarks
+
+
+class Command(BaseCommand):
+    help = (
+        "Misura tempi e numero di query di index, edit_subscription e dei calcoli degli importi "
+        "su dataset sintetici (da eseguire su un database di prova)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="10,100", help="Numeri di sottoscrizioni separati da virgola")
+        parser.add_argument("--members", type=int, default=4)
+        parser.add_argument("--price-changes", type=int, default=3)
+        parser.add_argument("--years", type=int, default=3)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--output", help="File JSON dei risultati (default: stdout)")
+        parser.add_argument("--baseline", help="File JSON di una esecuzione precedente da usare come soglia")
+        parser.add_argument("--latency-tolerance", type=float, default=0.25,
+                            help="Peggioramento relativo della latenza ammesso (0.25 = +25%%)")
+        parser.add_argument("--query-tolerance", type=int, default=0,
+                            help="Query in più ammesse rispetto alla baseline")
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options["sizes"].split(",")]
+        except ValueError:
+            raise CommandError("--sizes must be a comma separated list of integers")
+
+        results = benchmarks.run(
+            sizes,
+            members=options["members"],
+            price_changes=options["price_changes"],
+            years=options["years"],
+            seed=options["seed"],
+            repeat=options["repeat"],
+        )
+        output = json.dumps(results, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+        if options["baseline"]:
+            with open(options["baseline"]) as f:
+                baseline = json.load(f)
+            found = benchmarks.regressions(
+                results, baseline, options["latency_tolerance"], options["query_tolerance"],
+            )
+            if found:
+                raise CommandError("Performance regressions:\n" + "\n".join(found))
+            self.stderr.write(self.style.SUCCESS("No regressions against the baseline."))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from spotifyfamily import queryplans
+
+
+class Command(BaseCommand):
+    help = (
+        "Esegue EXPLAIN (ANALYZE su PostgreSQL) sulle query più frequenti e segnala scansioni "
+        "sequenziali e ordinamenti su più righe della soglia"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threshold", type=int, default=10000,
+                            help="Righe oltre le quali una scansione o un ordinamento viene segnalato")
+        parser.add_argument("--no-analyze", action="store_true",
+                            help="Solo il piano stimato, senza eseguire le query")
+        parser.add_argument("--plans", action="store_true", help="Stampa anche i piani completi")
+        parser.add_argument("--fail", action="store_true",
+                            help="Esce con errore se ci sono segnalazioni (per la CI)")
+
+    def handle(self, *args, **options):
+        results = queryplans.audit(options["threshold"], analyze=not options["no_analyze"])
+        found = []
+        for name, (plan, findings) in results.items():
+            status = self.style.WARNING("FLAGGED") if findings else self.style.SUCCESS("ok")
+            self.stdout.write(f"{name}: {status}")
+            for finding in findings:
+                self.stdout.write(f"  {finding.detail}")
+            if options["plans"]:
+                for line in plan.splitlines():
+                    self.stdout.write(f"    {line}")
+            found.extend(findings)
+
+        if found and options["fail"]:
+            raise CommandError(
+                f"{len(found)} sequential scans or sorts above {options['threshold']} rows:\n"
+                + "\n".join(str(finding) for finding in found)
+            )
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from spotifyfamily import exports
+
+
+class Command(BaseCommand):
+    help = "Esporta il registro dei pagamenti in CSV o JSON Lines"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--format", choices=sorted(exports.FORMATS), default="csv")
+        parser.add_argument("--subscription", type=int, help="Id della sottoscrizione")
+        parser.add_argument("--user", type=int, help="Id dell'utente")
+        parser.add_argument("--from", dest="date_from", help="Data iniziale (YYYY-MM-DD)")
+        parser.add_argument("--to", dest="date_to", help="Data finale (YYYY-MM-DD)")
+        parser.add_argument("--chunk-size", type=int, default=exports.CHUNK_SIZE)
+        parser.add_argument("--output", help="File di destinazione (default: stdout)")
+
+    def handle(self, *args, **options):
+        try:
+            querysets = exports.export_querysets(
+                subscription=options["subscription"],
+                user=options["user"],
+                date_from=exports.parse_date(options["date_from"]),
+                date_to=exports.parse_date(options["date_to"]),
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        lines = exports.export_lines(querysets, options["format"], options["chunk_size"])
+        if options["output"]:
+            with open(options["output"], "w", newline="") as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending="")
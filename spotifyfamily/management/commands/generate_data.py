@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from spotifyfamily import synthetic
+
+
+class Command(BaseCommand):
+    help = "Genera un dataset sintetico riproducibile (sottoscrizioni, membri, prezzi e pagamenti)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--subscriptions", type=int, default=100)
+        parser.add_argument("--members", type=int, default=5, help="Membri per sottoscrizione")
+        parser.add_argument("--price-changes", type=int, default=3, help="Cambi di prezzo per sottoscrizione")
+        parser.add_argument("--years", type=int, default=3, help="Anni di storico pagamenti")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--password", help="Password di tutti gli utenti generati (default: inutilizzabile)")
+        parser.add_argument("--prefix", default="synthetic", help="Prefisso di username e nomi")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            counts = synthetic.generate(
+                options["subscriptions"],
+                options["members"],
+                options["price_changes"],
+                options["years"],
+                seed=options["seed"],
+                password=options["password"],
+                prefix=options["prefix"],
+            )
+        self.stdout.write(self.style.SUCCESS(
+            ", ".join(f"{count} {name}" for name, count in counts.items())
+        ))
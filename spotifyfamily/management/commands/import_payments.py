@@ -0,0 +1,28 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from spotifyfamily.payment_import import import_payments, reject_writer
+
+
+class Command(BaseCommand):
+    help = "Importa i pagamenti da un CSV (username,subscription,amount,date)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("csv_file", help="Percorso del CSV, '-' per lo standard input")
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--rejects", help="File in cui scrivere le righe scartate (default: stderr)")
+
+    def handle(self, *args, **options):
+        source = sys.stdin if options["csv_file"] == "-" else open(options["csv_file"], newline="", encoding="utf-8-sig")
+        rejects = open(options["rejects"], "w", newline="") if options["rejects"] else self.stderr
+        try:
+            result = import_payments(source, batch_size=options["batch_size"], on_reject=reject_writer(rejects))
+        except ValueError as e:
+            raise CommandError(str(e))
+        finally:
+            if source is not sys.stdin:
+                source.close()
+            if options["rejects"]:
+                rejects.close()
+        self.stdout.write(self.style.SUCCESS(str(result)))
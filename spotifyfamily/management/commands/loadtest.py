@@ -0,0 +1,158 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from spotifyfamily import load, synthetic
+from spotifyfamily.models import User
+
+ENGINES = ("sqlite3", "postgresql")
+
+
+def parse_mix(value):
+    """"login=1,dashboard=6" -> {"login": 1, "dashboard": 6}"""
+    mix = {}
+    for part in filter(None, value.split(",")):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in load.ACTIONS:
+            raise CommandError(f"Unknown action {name!r} (choose from {', '.join(load.ACTIONS)}).")
+        try:
+            mix[name] = float(weight)
+        except ValueError:
+            raise CommandError(f"Invalid weight for {name!r}: {weight!r}.")
+    if not any(weight > 0 for weight in mix.values()):
+        raise CommandError("The mix needs at least one action with a positive weight.")
+    return mix
+
+
+class Command(BaseCommand):
+    help = (
+        "Test di carico end-to-end: prepara i dati, avvia gunicorn in locale e simula famiglie concorrenti "
+        "(login, home, pagina di modifica, pagamenti); riporta throughput, p50/p95/p99 ed errori per azione. "
+        "Senza --database-name usa un database SQLite temporaneo"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=3)
+        parser.add_argument("--worker-class", default="sync", help="es. sync, gthread, uvicorn_worker.UvicornWorker")
+        parser.add_argument("--threads", type=int, default=1)
+        parser.add_argument("--database-engine", choices=ENGINES, help="Default: sqlite3")
+        parser.add_argument(
+            "--database-name",
+            help="Database da migrare e popolare con gli utenti di prova (default: un file SQLite temporaneo)",
+        )
+        parser.add_argument("--clients", type=int, default=20, help="Famiglie simulate in parallelo")
+        parser.add_argument("--duration", type=float, default=30.0, help="Secondi di carico")
+        parser.add_argument(
+            "--mix", default=",".join(f"{name}={weight}" for name, weight in load.DEFAULT_MIX.items()),
+            help="Pesi delle azioni",
+        )
+        parser.add_argument("--households", type=int, default=50, help="Sottoscrizioni create e usate dai client")
+        parser.add_argument("--members", type=int, default=5, help="Membri per sottoscrizione")
+        parser.add_argument("--prefix", default="loadtest", help="Prefisso degli utenti generati")
+        parser.add_argument("--password", default="loadtest", help="Password degli utenti generati")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--keep-login-throttle", action="store_true",
+            help="Lascia attivo il limite ai login (tutti i client arrivano dallo stesso IP)",
+        )
+        parser.add_argument("--port", type=int, default=8765)
+
+    def handle(self, *args, **options):
+        if not options["database_name"]:
+            return self._run_on_temporary_database(options)
+        if self._needs_other_database(options):
+            return self._rerun(options)
+        mix = parse_mix(options["mix"])
+
+        call_command("migrate", interactive=False, verbosity=0)
+        if not User.objects.filter(username__startswith=f"{options['prefix']}-").exists():
+            with transaction.atomic():
+                synthetic.generate(
+                    options["households"], options["members"], price_changes=3, years=2, seed=options["seed"],
+                    password=options["password"], prefix=options["prefix"],
+                )
+        households = load.households(options["prefix"], limit=options["households"])
+        if not households:
+            raise CommandError(f"No subscriptions administered by {options['prefix']}-* users.")
+
+        database = connection.settings_dict
+        env = {
+            "DATABASE_ENGINE": database["ENGINE"].rpartition(".")[2],
+            # gunicorn parte dalla cartella del progetto: il file SQLite va indicato per intero
+            "DATABASE_NAME": os.path.abspath(database["NAME"]) if connection.vendor == "sqlite" else str(database["NAME"]),
+        }
+        if not options["keep_login_throttle"]:
+            env.update(LOGIN_THROTTLE_IP_BURST="0", LOGIN_THROTTLE_USERNAME_BURST="0")
+
+        with load.gunicorn(
+            options["port"], workers=options["workers"], worker_class=options["worker_class"],
+            threads=options["threads"], env=env,
+        ) as base_url:
+            results = load.run_mix(
+                base_url, households, options["password"], options["clients"], options["duration"],
+                mix=mix, seed=options["seed"],
+            )
+        report = {
+            "config": {
+                "workers": options["workers"],
+                "worker_class": options["worker_class"],
+                "threads": options["threads"],
+                "database": connection.vendor,
+                "clients": options["clients"],
+                "duration_s": options["duration"],
+                "households": len(households),
+                "mix": mix,
+            },
+            "results": results,
+        }
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def _needs_other_database(self, options):
+        database = connection.settings_dict
+        engine, name = options["database_engine"], options["database_name"]
+        return bool(
+            (engine and not database["ENGINE"].endswith(f".{engine}"))
+            or (name and str(database["NAME"]) != name)
+        )
+
+    def _run_on_temporary_database(self, options):
+        # Gli utenti di prova hanno una password nota: mai nel database configurato se non richiesto
+        if options["database_engine"] not in (None, "sqlite3"):
+            raise CommandError("--database-name is required with --database-engine postgresql.")
+        directory = tempfile.mkdtemp(prefix="spotifyfamily-loadtest-")
+        try:
+            self._rerun({
+                **options, "database_engine": "sqlite3", "database_name": os.path.join(directory, "db.sqlite3"),
+            })
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def _rerun(self, options):
+        # Il database si sceglie con le variabili d'ambiente lette da settings.py
+        env = {**os.environ}
+        if options["database_engine"]:
+            env["DATABASE_ENGINE"] = options["database_engine"]
+        if options["database_name"]:
+            env["DATABASE_NAME"] = options["database_name"]
+        argv = [sys.executable, os.path.join(settings.BASE_DIR, "manage.py"), "loadtest"]
+        for name in (
+            "workers", "worker_class", "threads", "database_engine", "database_name", "clients", "duration", "mix",
+            "households", "members", "prefix", "password", "seed", "port",
+        ):
+            if options[name] is not None:
+                argv += ["--" + name.replace("_", "-"), str(options[name])]
+        if options["keep_login_throttle"]:
+            argv.append("--keep-login-throttle")
+        result = subprocess.run(argv, env=env, capture_output=True, text=True)
+        if result.returncode:
+            raise CommandError(result.stderr.strip() or f"loadtest exited with code {result.returncode}")
+        self.stdout.write(result.stdout, ending="")
@@ -0,0 +1,30 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from spotifyfamily import exports, ledger
+
+
+class Command(BaseCommand):
+    help = (
+        "Genera gli addebiti (Charge) dei periodi scaduti dall'ultima esecuzione; "
+        "si può rilanciare senza creare duplicati"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--date", help="Data di riferimento (YYYY-MM-DD, default: oggi)")
+        parser.add_argument("--chunk-size", type=int, default=ledger.CHUNK_SIZE)
+        parser.add_argument(
+            "--full", action="store_true",
+            help="Ricontrolla tutti i membri (dopo modifiche manuali a last_payment_date)",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            today = exports.parse_date(options["date"])
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be positive.")
+        result = ledger.run_billing(today, options["chunk_size"], options["full"])
+        self.stdout.write(json.dumps(result))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from spotifyfamily import exports, reminders
+
+
+class Command(BaseCommand):
+    help = (
+        "Mette in coda e invia i promemoria di pagamento ai membri in ritardo "
+        "(uno per utente al giorno; si può rilanciare dopo un'interruzione)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--date", help="Data di riferimento (YYYY-MM-DD, default: oggi)")
+        parser.add_argument("--chunk-size", type=int, default=reminders.CHUNK_SIZE)
+        parser.add_argument("--workers", type=int, default=0, help="Processi per il calcolo degli importi (0 = nessun pool)")
+        parser.add_argument("--rate", type=float, help="Email al secondo (default: REMINDER_RATE)")
+        parser.add_argument("--queue-only", action="store_true", help="Mette in coda senza inviare")
+
+    def handle(self, *args, **options):
+        try:
+            today = exports.parse_date(options["date"])
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options["chunk_size"] < 1 or options["workers"] < 0:
+            raise CommandError("--chunk-size must be positive and --workers non-negative.")
+
+        queued = reminders.queue_reminders(today, options["chunk_size"], options["workers"])
+        self.stdout.write(f"{queued} reminder(s) queued")
+        if not options["queue_only"]:
+            sent = reminders.send_pending(today, options["rate"])
+            self.stdout.write(f"{sent} reminder(s) sent")
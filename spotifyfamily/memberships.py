@@ -0,0 +1,63 @@
+"""Aggiunta e rimozione dei membri di una sottoscrizione in blocco"""
+from datetime import date
+
+from django.db import transaction
+
+from . import billing, fragments, ledger
+from .models import Subscription, SubscriptionDetail, User
+
+SEARCH_LIMIT = 10
+
+
+def search_users(prefix, exclude_subscription=None, limit=SEARCH_LIMIT):
+    """Utenti il cui username inizia con ``prefix`` (ricerca su indice)"""
+    if not prefix:
+        return []
+    queryset = User.objects.filter(username__startswith=prefix)
+    if exclude_subscription is not None:
+        queryset = queryset.exclude(subscriptiondetail__subscription_id=exclude_subscription)
+    return list(queryset.order_by("username").values("id", "username")[:limit])
+
+
+@transaction.atomic
+def update_members(subscription, add=(), remove=(), today=None):
+    """
+    Aggiunge e rimuove membri in un'unica transazione. I nuovi membri partono
+    dall'inizio del ciclo di rinnovo in corso. L'amministratore non può essere
+    rimosso. Ritorna (aggiunti, rimossi).
+    """
+    today = today or date.today()
+    # Blocca la sottoscrizione: modifiche concorrenti ai membri vengono serializzate
+    Subscription.objects.select_for_update().filter(pk=subscription.pk).first()
+
+    remove = {int(pk) for pk in remove} - {subscription.admin_user_id}
+    add = {int(pk) for pk in add} - remove
+
+    removed = 0
+    if remove:
+        removed = SubscriptionDetail.objects.filter(subscription=subscription, user_id__in=remove).delete()[1].get(
+            SubscriptionDetail._meta.label, 0,
+        )
+
+    added = 0
+    if add:
+        existing = set(
+            SubscriptionDetail.objects.filter(subscription=subscription, user_id__in=add).values_list("user_id", flat=True)
+        )
+        new_ids = set(User.objects.filter(pk__in=add - existing).values_list("pk", flat=True))
+        last_payment_date = billing.current_cycle_start(subscription.start_date, subscription.renew_period, today)
+        SubscriptionDetail.objects.bulk_create(
+            [
+                SubscriptionDetail(subscription=subscription, user_id=pk, last_payment_date=last_payment_date)
+                for pk in sorted(new_ids)
+            ],
+            ignore_conflicts=True,
+        )
+        added = len(new_ids)
+
+    if added:
+        # bulk_create non invia post_save: le quote da pagare cambiano col numero di membri
+        ledger.reprice(subscription.pk, unpaid_only=True)
+    if added or removed:
+        fragments.bump_revision(subscription.pk)
+    return added, removed
@@ -0,0 +1,310 @@
+"""
+Metriche per vista: numero di richieste, istogrammi di latenza e di query,
+tempo speso nel database. Esposte in formato testo Prometheus.
+
+Ogni processo (worker gunicorn) accumula le metriche in memoria e le scrive
+periodicamente in un proprio file JSON dentro ``METRICS_DIR``; l'endpoint
+somma i file di tutti i processi, quindi i valori sono aggregati tra i worker.
+I file dei processi terminati vengono sommati in ``metrics-retired.json`` ed
+eliminati, così i totali non calano e i file non crescono a ogni riavvio.
+"""
+import contextvars
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse
+
+from . import fragments
+
+try:
+    import fcntl
+except ImportError:  # Windows: niente lock tra processi
+    fcntl = None
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+FLUSH_INTERVAL = 1.0
+SNAPSHOT_NAME = re.compile(r"metrics-(\d+)-\d+\.json")
+RETIRED_NAME = "metrics-retired.json"
+
+
+def metrics_dir():
+    return getattr(settings, "METRICS_DIR", None) or os.path.join(tempfile.gettempdir(), "spotifyfamily-metrics")
+
+
+def _empty_view():
+    return {
+        "requests": {},
+        "latency_buckets": [0] * len(LATENCY_BUCKETS),
+        "latency_sum": 0.0,
+        "query_buckets": [0] * len(QUERY_BUCKETS),
+        "queries_sum": 0,
+        "db_time_sum": 0.0,
+        "count": 0,
+    }
+
+
+def _observe(buckets, bounds, value):
+    for i, bound in enumerate(bounds):
+        if value <= bound:
+            buckets[i] += 1
+
+
+class Registry:
+    """Metriche del processo corrente"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+        self.counters = {}
+        # pid e istante di avvio: un nuovo processo con lo stesso pid non
+        # sovrascrive i totali di uno terminato
+        self.process_id = f"{os.getpid()}-{time.time_ns()}"
+        self.last_flush = 0.0
+
+    def observe(self, view, status, latency, queries, db_time):
+        with self.lock:
+            data = self.views.setdefault(view, _empty_view())
+            data["requests"][str(status)] = data["requests"].get(str(status), 0) + 1
+            data["count"] += 1
+            _observe(data["latency_buckets"], LATENCY_BUCKETS, latency)
+            data["latency_sum"] += latency
+            _observe(data["query_buckets"], QUERY_BUCKETS, queries)
+            data["queries_sum"] += queries
+            data["db_time_sum"] += db_time
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            for name, value in fragments.stats().items():
+                counters[f"fragment_cache_{name}"] = value
+            return {"views": json.loads(json.dumps(self.views)), "counters": counters}
+
+    def flush(self, force=False):
+        """Scrive lo snapshot del processo nel file condiviso (al massimo una volta al secondo)"""
+        now = time.monotonic()
+        if not force and now - self.last_flush < FLUSH_INTERVAL:
+            return
+        self.last_flush = now
+        directory = metrics_dir()
+        os.makedirs(directory, exist_ok=True)
+        _write(os.path.join(directory, f"metrics-{self.process_id}.json"), self.snapshot())
+
+
+registry = Registry()
+
+
+def inc(name, value=1):
+    """Incrementa un contatore generico (esposto come spotifyfamily_<name>_total)"""
+    registry.inc(name, value)
+
+
+def _write(path, data):
+    # Scrittura atomica: chi legge vede il file vecchio o quello nuovo
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _add(views, counters, snapshot):
+    for counter, value in snapshot["counters"].items():
+        counters[counter] = counters.get(counter, 0) + value
+    for view, data in snapshot["views"].items():
+        total = views.setdefault(view, _empty_view())
+        for status, count in data["requests"].items():
+            total["requests"][status] = total["requests"].get(status, 0) + count
+        for key in ("latency_buckets", "query_buckets"):
+            total[key] = [a + b for a, b in zip(total[key], data[key])]
+        for key in ("latency_sum", "queries_sum", "db_time_sum", "count"):
+            total[key] += data[key]
+
+
+def _retire(directory, names):
+    """Somma gli snapshot dei processi terminati in RETIRED_NAME ed elimina i loro file"""
+    dead = [name for name in names if not _alive(int(SNAPSHOT_NAME.fullmatch(name).group(1)))]
+    if not dead:
+        return names
+    retired = _read(os.path.join(directory, RETIRED_NAME)) or {"views": {}, "counters": {}}
+    for name in dead:
+        snapshot = _read(os.path.join(directory, name))
+        if snapshot is not None:
+            _add(retired["views"], retired["counters"], snapshot)
+    _write(os.path.join(directory, RETIRED_NAME), retired)
+    for name in dead:
+        os.remove(os.path.join(directory, name))
+    return [name for name in names if name not in dead]
+
+
+def collect():
+    """Somma gli snapshot di tutti i processi, compresi quelli terminati"""
+    registry.flush(force=True)
+    views, counters = {}, {}
+    directory = metrics_dir()
+    with open(os.path.join(directory, ".lock"), "a") as lock:
+        # Un solo processo alla volta sposta gli snapshot in RETIRED_NAME
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        names = _retire(directory, [name for name in os.listdir(directory) if SNAPSHOT_NAME.fullmatch(name)])
+        for name in [RETIRED_NAME, *names]:
+            snapshot = _read(os.path.join(directory, name))
+            if snapshot is not None:
+                _add(views, counters, snapshot)
+    return views, counters
+
+
+def _histogram(lines, name, view, bounds, buckets, total, count):
+    for bound, value in zip(bounds, buckets):
+        lines.append(f'{name}_bucket{{view="{view}",le="{bound}"}} {value}')
+    lines.append(f'{name}_bucket{{view="{view}",le="+Inf"}} {count}')
+    lines.append(f'{name}_sum{{view="{view}"}} {total}')
+    lines.append(f'{name}_count{{view="{view}"}} {count}')
+
+
+def render(views, counters):
+    """Formato di esposizione testuale di Prometheus"""
+    lines = [
+        "# HELP spotifyfamily_requests_total Requests handled, by view and status code.",
+        "# TYPE spotifyfamily_requests_total counter",
+    ]
+    for view, data in sorted(views.items()):
+        for status, count in sorted(data["requests"].items()):
+            lines.append(f'spotifyfamily_requests_total{{view="{view}",status="{status}"}} {count}')
+
+    lines += [
+        "# HELP spotifyfamily_request_duration_seconds Request latency, by view.",
+        "# TYPE spotifyfamily_request_duration_seconds histogram",
+    ]
+    for view, data in sorted(views.items()):
+        _histogram(lines, "spotifyfamily_request_duration_seconds", view, LATENCY_BUCKETS,
+                   data["latency_buckets"], data["latency_sum"], data["count"])
+
+    lines += [
+        "# HELP spotifyfamily_db_queries SQL queries per request, by view.",
+        "# TYPE spotifyfamily_db_queries histogram",
+    ]
+    for view, data in sorted(views.items()):
+        _histogram(lines, "spotifyfamily_db_queries", view, QUERY_BUCKETS,
+                   data["query_buckets"], data["queries_sum"], data["count"])
+
+    lines += [
+        "# HELP spotifyfamily_db_duration_seconds_total Time spent executing SQL, by view.",
+        "# TYPE spotifyfamily_db_duration_seconds_total counter",
+    ]
+    for view, data in sorted(views.items()):
+        lines.append(f'spotifyfamily_db_duration_seconds_total{{view="{view}"}} {data["db_time_sum"]}')
+
+    for name, value in sorted(counters.items()):
+        lines.append(f"# TYPE spotifyfamily_{name}_total counter")
+        lines.append(f"spotifyfamily_{name}_total {value}")
+    return "\n".join(lines) + "\n"
+
+
+class QueryCounter:
+    """Numero di query e tempo speso nel database da una richiesta"""
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+
+
+# Contatore della richiesta corrente: le variabili di contesto seguono la
+# richiesta anche nei thread usati dall'ORM asincrono (sync_to_async)
+_current_counter = contextvars.ContextVar("query_counter", default=None)
+
+
+def _count_query(execute, sql, params, many, context):
+    counter = _current_counter.get()
+    if counter is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        counter.time += time.perf_counter() - start
+        counter.count += 1
+
+
+def _install(connection, **kwargs):
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+connection_created.connect(_install)
+
+
+class MetricsMiddleware:
+    """
+    Registra latenza, numero di query e tempo DB di ogni richiesta, per nome
+    della URL. Funziona sia sotto WSGI sia sotto ASGI senza adattamenti.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _start(self):
+        for connection in connections.all(initialized_only=True):
+            _install(connection)
+        return _current_counter.set(QueryCounter()), time.perf_counter()
+
+    def _finish(self, request, response, token, start):
+        latency = time.perf_counter() - start
+        counter = _current_counter.get()
+        _current_counter.reset(token)
+        match = getattr(request, "resolver_match", None)
+        view = match.view_name if match else "unmatched"
+        registry.observe(view, response.status_code, latency, counter.count, counter.time)
+        registry.flush()
+        return response
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token, start = self._start()
+        return self._finish(request, self.get_response(request), token, start)
+
+    async def __acall__(self, request):
+        token, start = self._start()
+        return self._finish(request, await self.get_response(request), token, start)
+
+
+@staff_member_required
+def metrics_view(request):
+    views, counters = collect()
+    return HttpResponse(render(views, counters), content_type="text/plain; version=0.0.4; charset=utf-8")
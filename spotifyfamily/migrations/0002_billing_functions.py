@@ -0,0 +1,83 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:52
+
+from django.db import migrations
+
+# Periodi non pagati con la stessa semantica di billing.unpaid_periods:
+# il giorno della scadenza resta troncato dopo un mese più corto.
+CREATE_UNPAID_PERIODS = """
+CREATE OR REPLACE FUNCTION spotifyfamily_unpaid_periods(last_payment date, renew integer, today date)
+RETURNS TABLE (period integer, period_start date, period_end date)
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT p.period, (p.period_end - make_interval(months => renew))::date, p.period_end
+    FROM (
+        SELECT g.period,
+               m.month_start + LEAST(
+                   EXTRACT(DAY FROM last_payment)::integer,
+                   MIN(m.month_days) OVER (ORDER BY g.period)
+               ) - 1 AS period_end
+        FROM generate_series(1, GREATEST(
+            ((EXTRACT(YEAR FROM today)::integer - EXTRACT(YEAR FROM last_payment)::integer) * 12
+             + EXTRACT(MONTH FROM today)::integer - EXTRACT(MONTH FROM last_payment)::integer) / renew,
+            0
+        )) AS g(period)
+        CROSS JOIN LATERAL (
+            SELECT s.month_start::date AS month_start,
+                   EXTRACT(DAY FROM s.month_start + interval '1 month' - interval '1 day')::integer AS month_days
+            FROM (SELECT date_trunc('month', last_payment) + make_interval(months => g.period * renew) AS month_start) AS s
+        ) AS m
+    ) AS p
+    WHERE p.period_end <= today
+$$;
+"""
+
+# round(x, 2) di Python: arrotondamento al centesimo "half even" sul valore
+# binario esatto del double. La parte frazionaria moltiplicata per 2^62 è un
+# intero esatto, quindi il confronto con la metà avviene senza errori.
+CREATE_ROUND_CENTS = """
+CREATE OR REPLACE FUNCTION spotifyfamily_round_cents(x double precision)
+RETURNS double precision
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT sign(x) * ((
+        r.cents + CASE
+            WHEN 2 * r.remainder > 4611686018427387904 THEN 1
+            WHEN 2 * r.remainder < 4611686018427387904 THEN 0
+            ELSE mod(r.cents, 2)
+        END
+    )::double precision / 100)
+    FROM (
+        SELECT f.whole * 100 + div(f.scaled * 100, 4611686018427387904) AS cents,
+               mod(f.scaled * 100, 4611686018427387904) AS remainder
+        FROM (
+            SELECT floor(abs(x))::numeric AS whole,
+                   ((abs(x) - floor(abs(x))) * 4611686018427387904::double precision)::bigint::numeric AS scaled
+        ) AS f
+    ) AS r
+$$;
+"""
+
+DROP_FUNCTIONS = """
+DROP FUNCTION IF EXISTS spotifyfamily_unpaid_periods(date, integer, date);
+DROP FUNCTION IF EXISTS spotifyfamily_round_cents(double precision);
+"""
+
+
+def create_functions(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(CREATE_UNPAID_PERIODS)
+        schema_editor.execute(CREATE_ROUND_CENTS)
+
+
+def drop_functions(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(DROP_FUNCTIONS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotifyfamily', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_functions, drop_functions),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:48
+
+from django.db import migrations, models
+
+# Su PostgreSQL gli intervalli [valid_from, valid_to) di una sottoscrizione
+# non possono sovrapporsi; valid_to nullo è un intervallo aperto.
+# L'uguaglianza sulla sottoscrizione è espressa come range di un solo valore,
+# così non serve l'estensione btree_gist.
+ADD_EXCLUSION = """
+ALTER TABLE spotifyfamily_subscriptionprice
+    ADD CONSTRAINT spotifyfamily_price_no_overlap
+    EXCLUDE USING gist (
+        int8range(subscription_id, subscription_id, '[]') WITH &&,
+        daterange(valid_from, valid_to, '[)') WITH &&
+    );
+"""
+
+DROP_EXCLUSION = """
+ALTER TABLE spotifyfamily_subscriptionprice DROP CONSTRAINT IF EXISTS spotifyfamily_price_no_overlap;
+"""
+
+
+def repair_intervals(apps, schema_editor):
+    """
+    Prepara i dati esistenti ai vincoli: ogni prezzo termina al più tardi
+    quando inizia il successivo della stessa sottoscrizione (come sceglieva il
+    vecchio calcolo, che usava il prezzo iniziato per ultimo), così restano un
+    solo prezzo aperto e nessuna sovrapposizione; un valid_to precedente a
+    valid_from diventa un intervallo vuoto.
+    """
+    SubscriptionPrice = apps.get_model("spotifyfamily", "SubscriptionPrice")
+    prices = SubscriptionPrice.objects.using(schema_editor.connection.alias)
+    changed = {}
+    previous = None
+    for price in prices.order_by("subscription_id", "valid_from", "id").iterator():
+        if price.valid_to is not None and price.valid_to < price.valid_from:
+            price.valid_to = price.valid_from
+            changed[price.pk] = price
+        if previous is not None and previous.subscription_id == price.subscription_id:
+            if previous.valid_to is None or previous.valid_to > price.valid_from:
+                previous.valid_to = price.valid_from
+                changed[previous.pk] = previous
+        previous = price
+    prices.bulk_update(changed.values(), ["valid_to"], batch_size=1000)
+
+
+def add_exclusion(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(ADD_EXCLUSION)
+
+
+def drop_exclusion(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(DROP_EXCLUSION)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotifyfamily', '0002_billing_functions'),
+    ]
+
+    operations = [
+        migrations.RunPython(repair_intervals, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='subscriptionprice',
+            constraint=models.CheckConstraint(condition=models.Q(('valid_to__isnull', True), ('valid_to__gte', models.F('valid_from')), _connector='OR'), name='price_valid_range'),
+        ),
+        migrations.AddConstraint(
+            model_name='subscriptionprice',
+            constraint=models.UniqueConstraint(condition=models.Q(('valid_to__isnull', True)), fields=('subscription',), name='one_open_price_per_subscription'),
+        ),
+        migrations.RunPython(add_exclusion, drop_exclusion),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotifyfamily', '0003_price_intervals'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['payment_date'], name='payment_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(fields=['start_date', 'id'], name='subscription_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subscriptiondetail',
+            index=models.Index(fields=['subscription', 'last_payment_date'], name='detail_subscription_paid_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subscriptiondetail',
+            index=models.Index(fields=['last_payment_date'], name='detail_last_payment_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subscriptionprice',
+            index=models.Index(fields=['subscription', '-valid_from'], name='price_subscription_from_idx'),
+        ),
+    ]
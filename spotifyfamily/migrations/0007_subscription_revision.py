@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotifyfamily', '0006_payment_idempotency'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscription',
+            name='revision',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='subscription',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
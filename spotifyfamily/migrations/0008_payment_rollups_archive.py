@@ -0,0 +1,68 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:47
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncMonth
+
+
+def backfill_rollups(apps, schema_editor):
+    """Totali mensili dei pagamenti già registrati"""
+    Payment = apps.get_model("spotifyfamily", "Payment")
+    PaymentMonthlyRollup = apps.get_model("spotifyfamily", "PaymentMonthlyRollup")
+    rows = (
+        Payment.objects.using(schema_editor.connection.alias)
+        .annotate(month=TruncMonth("payment_date"))
+        .values_list("subscription_detail_id", "month")
+        .annotate(total=Sum("amount"), payment_count=Count("id"))
+        .order_by()
+    )
+    PaymentMonthlyRollup.objects.using(schema_editor.connection.alias).bulk_create(
+        [
+            PaymentMonthlyRollup(subscription_detail_id=detail_id, month=month, total=round(total, 2), payment_count=count)
+            for detail_id, month, total, count in rows.iterator()
+        ],
+        batch_size=5000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotifyfamily', '0007_subscription_revision'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='payment',
+            options={},
+        ),
+        migrations.CreateModel(
+            name='ArchivedPayment',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('amount', models.FloatField()),
+                ('payment_date', models.DateField()),
+                ('periods_covered', models.PositiveIntegerField(default=0)),
+                ('subscription_detail', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_payments', to='spotifyfamily.subscriptiondetail')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['subscription_detail', 'payment_date'], name='archived_detail_date_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='PaymentMonthlyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('total', models.FloatField(default=0)),
+                ('payment_count', models.IntegerField(default=0)),
+                ('subscription_detail', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='monthly_rollups', to='spotifyfamily.subscriptiondetail')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['month'], name='rollup_month_idx')],
+                'constraints': [models.UniqueConstraint(fields=('subscription_detail', 'month'), name='one_rollup_per_member_month')],
+            },
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotifyfamily', '0008_payment_rollups_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Charge',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period_start', models.DateField()),
+                ('period_end', models.DateField()),
+                ('amount', models.FloatField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('subscription_detail', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='charges', to='spotifyfamily.subscriptiondetail')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('subscription_detail', 'period_end'), name='one_charge_per_member_period')],
+            },
+        ),
+    ]
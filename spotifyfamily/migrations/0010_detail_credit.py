@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotifyfamily', '0009_charge_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscriptiondetail',
+            name='credit',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+    ]
@@ -1,8 +1,8 @@
+from django.core.exceptions import ValidationError
 from django.db import models
-from django.db.models import Q
+from django.db.models import F, Q
 from django.contrib.auth.models import AbstractUser
-from dateutil.relativedelta import relativedelta
-from datetime import date
+from . import billing
 
 # Create your models here.
 class Subscription(models.Model):
@@ -11,6 +11,16 @@ class Subscription(models.Model):
     users = models.ManyToManyField("User", through="SubscriptionDetail")
     admin_user = models.ForeignKey("User", on_delete=models.CASCADE, related_name="admin_subscriptions")
     renew_period = models.IntegerField(default=1)  # in months
+    # Incrementati da fragments.bump_revision a ogni modifica di sottoscrizione,
+    # prezzi, membri o pagamenti: sono i validatori ETag/Last-Modified delle pagine
+    revision = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        indexes = [
+            # Home (start_date decrescente) e API (keyset su start_date, id)
+            models.Index(fields=["start_date", "id"], name="subscription_start_idx"),
+        ]
     
     def __str__(self):
         return f"{self.name} - from {self.start_date}"
@@ -35,6 +45,33 @@ class SubscriptionPrice(models.Model):
     valid_from = models.DateField()
     valid_to = models.DateField(blank=True, null=True)
     
+    class Meta:
+        indexes = [
+            # Prezzi di una sottoscrizione dal più recente (storico e ricerca del prezzo)
+            models.Index(fields=["subscription", "-valid_from"], name="price_subscription_from_idx"),
+        ]
+        constraints = [
+            # one_open_price_per_subscription è anche l'indice parziale per il
+            # prezzo corrente (valid_to IS NULL)
+            models.CheckConstraint(
+                condition=Q(valid_to__isnull=True) | Q(valid_to__gte=F("valid_from")),
+                name="price_valid_range",
+            ),
+            models.UniqueConstraint(
+                fields=["subscription"],
+                condition=Q(valid_to__isnull=True),
+                name="one_open_price_per_subscription",
+            ),
+        ]
+    
+    def clean(self):
+        """Impedisce sovrapposizioni con gli altri prezzi della sottoscrizione"""
+        from .prices import overlapping
+
+        if self.subscription_id and self.valid_from:
+            if overlapping(self.subscription_id, self.valid_from, self.valid_to, exclude=self.pk).exists():
+                raise ValidationError("This price period overlaps another price of the subscription.")
+    
     def get_price_per_user(self, user_count):
         """Calcola il prezzo per utente per questo prezzo specifico"""
         if user_count == 0:
@@ -48,6 +85,8 @@ class SubscriptionDetail(models.Model):
     last_payment_date = models.DateField()
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     subscription = models.ForeignKey(Subscription, on_delete=models.CASCADE)
+    # Parte dei pagamenti che non bastava a coprire un periodo intero
+    credit = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     
     class Meta:
         constraints = [
@@ -55,6 +94,15 @@ class SubscriptionDetail(models.Model):
                 fields=["user", "subscription"], name="unique_user_subscription"
             )
         ]
+        indexes = [
+            # Membri di una sottoscrizione per data dell'ultimo pagamento
+            models.Index(fields=["subscription", "last_payment_date"], name="detail_subscription_paid_idx"),
+            # Membri in ritardo su tutte le sottoscrizioni
+            models.Index(fields=["last_payment_date"], name="detail_last_payment_idx"),
+        ]
+    
+    def __str__(self):
+        return f"{self.user.username} - {self.subscription.name}"
     
     def get_last_paid_month(self):
         """Ritorna l'ultimo mese pagato in formato leggibile"""
@@ -62,46 +110,20 @@ class SubscriptionDetail(models.Model):
     
     def get_months_unpaid(self):
         """Calcola quanti periodi di rinnovo sono passati dall'ultimo pagamento"""
-        today = date.today()
-        next_payment_date = self.last_payment_date + relativedelta(months=self.subscription.renew_period)
-        
-        months_count = 0
-        while next_payment_date <= today:
-            months_count += 1
-            next_payment_date += relativedelta(months=self.subscription.renew_period)
-        
-        return months_count
+        return billing.count_unpaid_periods(self.last_payment_date, self.subscription.renew_period)
     
     def get_amount_to_pay(self):
         """
         Calcola l'importo totale da pagare considerando lo storico dei prezzi.
         Per ogni periodo non pagato, usa il prezzo valido in quel periodo.
         """
-        today = date.today()
-        next_payment_date = self.last_payment_date + relativedelta(months=self.subscription.renew_period)
-        
-        total_amount = 0.0
+        from .prices import get_schedule
+
+        schedule = get_schedule(self.subscription_id, self.subscription.revision)
         user_count = self.subscription.users.count()
-        
-        # Per ogni periodo non pagato
-        while next_payment_date <= today:
-            # Trova il prezzo valido per questo periodo
-            # Il prezzo è valido se valid_from <= periodo e (valid_to è null o valid_to >= periodo)
-            period_start = next_payment_date - relativedelta(months=self.subscription.renew_period)
-            
-            price_obj = self.subscription.prices.filter(
-                valid_from__lte=next_payment_date
-            ).filter(
-                models.Q(valid_to__isnull=True) | models.Q(valid_to__gte=period_start)
-            ).order_by('-valid_from').first()
-            
-            if price_obj:
-                period_price = price_obj.get_price_per_user(user_count)
-                total_amount += period_price
-            
-            next_payment_date += relativedelta(months=self.subscription.renew_period)
-        
-        return round(total_amount, 2)
+        return billing.amount_to_pay(
+            self.last_payment_date, self.subscription.renew_period, schedule, user_count, credit=self.credit
+        )
     
     def is_payment_overdue(self):
         """Verifica se ci sono pagamenti non effettuati"""
@@ -113,9 +135,104 @@ class Payment(models.Model):
     amount = models.FloatField()  # Importo pagato in EUR
     payment_date = models.DateField()  # Data del pagamento
     created_at = models.DateTimeField(auto_now_add=True)  # Quando è stato registrato
+    # Chiave inviata dal form: un doppio invio non crea un secondo pagamento
+    idempotency_key = models.CharField(max_length=64, unique=True, null=True, blank=True)
+    periods_covered = models.PositiveIntegerField(default=0)  # Periodi pagati da questo importo
     
     class Meta:
-        ordering = ['-payment_date']
+        # Nessun ordinamento di default: chi ha bisogno di un ordine lo chiede
+        # (payment_date_idx copre l'ordinamento per data)
+        indexes = [
+            # Export e liste filtrate per intervallo di date
+            models.Index(fields=["payment_date"], name="payment_date_idx"),
+        ]
     
     def __str__(self):
         return f"{self.subscription_detail.user.username} - €{self.amount} - {self.payment_date}"
+
+
+class PaymentMonthlyRollup(models.Model):
+    """
+    Totale pagato da un membro in un mese (``month`` = primo giorno del mese),
+    compresi i pagamenti archiviati. Aggiornato da ``rollups.record``.
+    """
+    subscription_detail = models.ForeignKey(SubscriptionDetail, on_delete=models.CASCADE, related_name="monthly_rollups")
+    month = models.DateField()
+    total = models.FloatField(default=0)
+    # Non Positive: l'upsert che sottrae inserisce valori negativi prima del conflitto
+    payment_count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["subscription_detail", "month"], name="one_rollup_per_member_month"),
+        ]
+        indexes = [
+            # Totali di un periodo su tutti i membri
+            models.Index(fields=["month"], name="rollup_month_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.subscription_detail_id} - {self.month:%Y-%m} - €{self.total}"
+
+
+class ArchivedPayment(models.Model):
+    """Pagamento spostato fuori da Payment dopo il periodo di conservazione (stesso id)"""
+    id = models.BigIntegerField(primary_key=True)
+    subscription_detail = models.ForeignKey(SubscriptionDetail, on_delete=models.CASCADE, related_name="archived_payments")
+    amount = models.FloatField()
+    payment_date = models.DateField()
+    periods_covered = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["subscription_detail", "payment_date"], name="archived_detail_date_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.subscription_detail_id} - €{self.amount} - {self.payment_date}"
+
+
+class OverdueReminder(models.Model):
+    """
+    Promemoria di pagamento in coda (outbox): al massimo uno per utente per
+    giorno di esecuzione, ``sent_at`` nullo finché non viene inviato.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="overdue_reminders")
+    run_date = models.DateField()
+    amount = models.FloatField()  # Totale dovuto in EUR
+    lines = models.JSONField(default=list)  # Dettaglio per sottoscrizione
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "run_date"], name="one_reminder_per_user_per_day"),
+        ]
+        indexes = [
+            # Coda dei promemoria da inviare
+            models.Index(fields=["run_date", "id"], condition=Q(sent_at__isnull=True), name="reminder_pending_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} - €{self.amount} - {self.run_date}"
+
+
+class Charge(models.Model):
+    """
+    Quota addebitata a un membro per un periodo di rinnovo, al prezzo valido
+    in quel periodo. Generata da ``ledger.run_billing``; i periodi con
+    ``period_end`` successivo a ``last_payment_date`` sono quelli da pagare.
+    """
+    subscription_detail = models.ForeignKey(SubscriptionDetail, on_delete=models.CASCADE, related_name="charges")
+    period_start = models.DateField()
+    period_end = models.DateField()
+    amount = models.FloatField()  # Quota per utente in EUR (0 se il periodo non ha prezzo)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["subscription_detail", "period_end"], name="one_charge_per_member_period"),
+        ]
+
+    def __str__(self):
+        return f"{self.subscription_detail_id} - {self.period_end} - €{self.amount}"
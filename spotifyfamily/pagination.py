@@ -0,0 +1,41 @@
+"""
+Paginatore per le tabelle grandi nell'admin.
+
+Su PostgreSQL il conteggio di una tabella intera senza filtri usa la stima
+delle statistiche (``pg_class.reltuples``) invece di un COUNT(*) esatto, che
+su tabelle grandi legge tutte le righe. Sotto la soglia, con filtri attivi o
+su altri database il conteggio resta esatto.
+"""
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+ESTIMATE_THRESHOLD = 100_000
+
+
+def estimated_count(queryset):
+    """Numero di righe stimato della tabella del queryset, o None se non disponibile"""
+    connection = connections[queryset.db]
+    if connection.vendor != "postgresql":
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)",
+            [connection.ops.quote_name(queryset.model._meta.db_table)],
+        )
+        row = cursor.fetchone()
+    # -1: tabella mai analizzata
+    return row[0] if row and row[0] >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    threshold = ESTIMATE_THRESHOLD
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if hasattr(queryset, "query") and not queryset.query.where and not queryset.query.distinct:
+            estimate = estimated_count(queryset)
+            if estimate is not None and estimate > self.threshold:
+                return estimate
+        return super().count
@@ -0,0 +1,205 @@
+"""
+Importazione massiva dei pagamenti da un CSV di estratto conto.
+
+Il file viene letto riga per riga: in memoria restano solo le tabelle di
+lookup dei SubscriptionDetail e dei prezzi e il batch corrente di Payment.
+Prima di scrivere un batch vengono bloccati (in ordine di pk) solo i membri
+che compaiono nel batch e non ancora bloccati: i pagamenti degli altri
+membri possono essere registrati durante l'importazione. Due importazioni
+che toccano gli stessi membri in batch diversi possono comunque bloccarsi a
+vicenda: il database ne annulla una (deadlock) e il file va reimportato.
+Ogni pagamento viene ripartito sui periodi con ``payments.allocate``, come
+in ``payments.register_payment``: ``last_payment_date`` avanza dei periodi
+coperti e quello che avanza resta come credito del membro.
+"""
+import csv
+from collections import Counter, defaultdict
+from datetime import date
+
+from django.db import transaction
+
+from . import billing, fragments, payments, prices, rollups
+from .models import Payment, SubscriptionDetail, SubscriptionPrice
+
+FIELDS = ["username", "subscription", "amount", "date"]
+REJECT_FIELDS = ["line", *FIELDS, "reason"]
+
+
+class ImportResult:
+    def __init__(self):
+        self.created = 0
+        self.rejected = 0
+        self.updated_details = 0
+
+    def __str__(self):
+        return (
+            f"{self.created} payments imported, {self.rejected} rows rejected, "
+            f"{self.updated_details} members updated"
+        )
+
+
+class PaymentLookup:
+    """Tabelle di lookup caricate una sola volta per l'intera importazione"""
+
+    def __init__(self):
+        self.details = {}
+        self.balances = {}
+        self.updated = set()
+        self.subscription_of = {}
+        self.subscriptions_by_name = defaultdict(set)
+        self.renew_periods = {}
+        self.user_counts = Counter()
+        rows = SubscriptionDetail.objects.values_list(
+            "id", "user__username", "subscription_id", "subscription__name", "subscription__renew_period",
+        )
+        for detail_id, username, subscription_id, subscription_name, renew_period in rows.iterator():
+            self.details[(username, subscription_id)] = detail_id
+            self.subscription_of[detail_id] = subscription_id
+            self.subscriptions_by_name[subscription_name].add(subscription_id)
+            self.renew_periods[subscription_id] = renew_period
+            self.user_counts[subscription_id] += 1
+
+        intervals = defaultdict(list)
+        for row in SubscriptionPrice.objects.values_list("subscription_id", "id", "price", "valid_from", "valid_to"):
+            intervals[row[0]].append(prices.PriceInterval(*row[1:]))
+        self.schedules = {pk: billing.PriceSchedule(rows) for pk, rows in intervals.items()}
+
+    def lock(self, detail_ids):
+        """
+        Lock sui membri non ancora bloccati, come in register_payment, e
+        lettura del loro saldo; ritorna gli id dei membri disponibili.
+        """
+        new_ids = set(detail_ids) - self.balances.keys()
+        if new_ids:
+            rows = SubscriptionDetail.objects.select_for_update().filter(pk__in=sorted(new_ids)).order_by("pk")
+            for detail_id, last_payment_date, credit in rows.values_list("id", "last_payment_date", "credit"):
+                self.balances[detail_id] = (last_payment_date, credit)
+        return self.balances.keys()
+
+    def allocate(self, detail_id, amount, today):
+        """Ripartisce il pagamento sui periodi del membro; ritorna i periodi coperti"""
+        subscription_id = self.subscription_of[detail_id]
+        renew_period = self.renew_periods[subscription_id]
+        last_payment_date, credit = self.balances[detail_id]
+        available = amount + credit
+        periods, used = payments.allocate(
+            last_payment_date, renew_period, self.schedules.get(subscription_id, billing.PriceSchedule([])),
+            self.user_counts[subscription_id], available, today,
+        )
+        self.balances[detail_id] = (billing.period_end(last_payment_date, renew_period, periods), available - used)
+        self.updated.add(detail_id)
+        return periods
+
+    def updated_balances(self):
+        """Data dell'ultimo pagamento e credito dei membri con almeno un pagamento importato"""
+        return {pk: self.balances[pk] for pk in self.updated}
+
+    def subscription_id(self, value):
+        """La sottoscrizione può essere indicata con l'id o con il nome"""
+        if value.isdigit():
+            return int(value)
+        ids = self.subscriptions_by_name.get(value, ())
+        if len(ids) > 1:
+            raise ValueError("ambiguous subscription name")
+        if not ids:
+            raise ValueError("unknown subscription")
+        return next(iter(ids))
+
+    def detail_id(self, username, subscription):
+        detail_id = self.details.get((username, self.subscription_id(subscription)))
+        if detail_id is None:
+            raise ValueError("user is not a member of the subscription")
+        return detail_id
+
+
+def _parse_row(lookup, row):
+    username = (row.get("username") or "").strip()
+    subscription = (row.get("subscription") or "").strip()
+    detail_id = lookup.detail_id(username, subscription)
+    try:
+        amount = payments.to_money(row.get("amount") or "")
+    except ValueError:
+        raise ValueError("invalid amount")
+    if amount <= 0:
+        raise ValueError("invalid amount")
+    try:
+        payment_date = date.fromisoformat((row.get("date") or "").strip())
+    except ValueError:
+        raise ValueError("invalid date")
+    return detail_id, amount, payment_date
+
+
+def import_payments(lines, batch_size=1000, on_reject=None, today=None):
+    """
+    Importa i pagamenti da un iterabile di righe CSV con intestazione
+    username,subscription,amount,date. Le righe non abbinabili vengono passate
+    a ``on_reject`` con il numero di riga e il motivo.
+    Tutta l'importazione avviene in un'unica transazione.
+    """
+    today = today or date.today()
+    reader = csv.DictReader(lines)
+    missing = [field for field in FIELDS if field not in (reader.fieldnames or [])]
+    if missing:
+        raise ValueError(f"Missing CSV columns: {', '.join(missing)}")
+
+    result = ImportResult()
+
+    def reject(line, row, reason):
+        result.rejected += 1
+        if on_reject:
+            on_reject({"line": line, **{f: row.get(f) for f in FIELDS}, "reason": reason})
+
+    def write(batch):
+        locked = lookup.lock(detail_id for _, _, detail_id, _, _ in batch)
+        created = []
+        for line, row, detail_id, amount, payment_date in batch:
+            if detail_id not in locked:
+                # Membro eliminato dopo il caricamento delle tabelle
+                reject(line, row, "user is not a member of the subscription")
+                continue
+            created.append(Payment(
+                subscription_detail_id=detail_id, amount=amount, payment_date=payment_date,
+                periods_covered=lookup.allocate(detail_id, amount, today),
+            ))
+        Payment.objects.bulk_create(created)
+        rollups.record(created)
+        result.created += len(created)
+
+    with transaction.atomic():
+        lookup = PaymentLookup()
+        batch = []
+        for row in reader:
+            try:
+                detail_id, amount, payment_date = _parse_row(lookup, row)
+            except ValueError as e:
+                reject(reader.line_num, row, str(e))
+                continue
+            batch.append((reader.line_num, row, detail_id, amount, payment_date))
+            if len(batch) >= batch_size:
+                write(batch)
+                batch = []
+
+        if batch:
+            write(batch)
+
+        updated = lookup.updated_balances()
+        SubscriptionDetail.objects.bulk_update(
+            [
+                SubscriptionDetail(id=pk, last_payment_date=last_payment_date, credit=credit)
+                for pk, (last_payment_date, credit) in updated.items()
+            ],
+            ["last_payment_date", "credit"],
+            batch_size=batch_size,
+        )
+        result.updated_details = len(updated)
+
+    for subscription_id in {lookup.subscription_of[pk] for pk in updated}:
+        fragments.bump_revision(subscription_id)
+    return result
+
+
+def reject_writer(stream):
+    """Ritorna una callback che scrive il report degli scarti in CSV"""
+    writer = csv.DictWriter(stream, fieldnames=REJECT_FIELDS)
+    writer.writeheader()
+    return writer.writerow
@@ -0,0 +1,131 @@
+"""
+Registrazione dei pagamenti.
+
+Ogni pagamento viene registrato in una transazione con il lock sulla riga
+del membro (``select_for_update``): pagamenti concorrenti dello stesso membro
+vengono serializzati, quelli di membri diversi non si bloccano a vicenda.
+L'importo viene ripartito sui periodi a partire dall'ultimo pagato, ognuno al
+prezzo valido in quel periodo, e ``last_payment_date`` avanza dei periodi
+interamente coperti. Quello che avanza resta come credito del membro
+(``SubscriptionDetail.credit``) e si somma al pagamento successivo.
+Una chiave di idempotenza rende innocui i doppi invii.
+
+Gli importi sono calcolati come ``Decimal`` arrotondati al centesimo.
+"""
+from collections import namedtuple
+from datetime import date
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
+from django.db import IntegrityError, transaction
+
+from . import billing, prices, rollups
+from .models import Payment, SubscriptionDetail
+
+# Limite di sicurezza ai periodi coperti da un singolo pagamento
+MAX_PERIODS = 1200
+
+CENT = Decimal("0.01")
+ZERO = Decimal("0.00")
+
+PaymentResult = namedtuple("PaymentResult", ["payment", "periods", "created"])
+
+
+class PaymentConflict(ValueError):
+    pass
+
+
+def to_money(value):
+    """Importo in euro come Decimal al centesimo; ValueError se non è un numero finito"""
+    try:
+        amount = Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError("Amount must be a number.")
+    if not amount.is_finite():
+        raise ValueError("Amount must be a finite number.")
+    return amount.quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def allocate(last_payment_date, renew_period, schedule, user_count, amount, today=None):
+    """
+    Periodi interamente pagati da ``amount`` a partire da ``last_payment_date``.
+    I periodi senza prezzo (o a costo zero) sono coperti solo se già scaduti.
+    Ritorna (periodi, importo usato).
+    """
+    today = today or date.today()
+    remaining = to_money(amount)
+    used = ZERO
+    start = last_payment_date
+    periods = 0
+    while periods < MAX_PERIODS:
+        end = billing.period_end(last_payment_date, renew_period, periods + 1)
+        price = schedule.price_for_period(start, end)
+        share = to_money(billing.price_per_user(price.price, user_count)) if price is not None else ZERO
+        if share <= 0 and end > today:
+            break
+        if share > remaining:
+            break
+        remaining -= share
+        used += share
+        periods += 1
+        start = end
+    return periods, used
+
+
+def _existing(idempotency_key, detail_id, amount):
+    payment = Payment.objects.filter(idempotency_key=idempotency_key).first()
+    if payment is None:
+        return None
+    if payment.subscription_detail_id != detail_id or to_money(payment.amount) != amount:
+        raise PaymentConflict("Idempotency key already used for a different payment.")
+    return PaymentResult(payment, payment.periods_covered, False)
+
+
+def register_payment(detail_id, amount, payment_date, idempotency_key=None, today=None):
+    """
+    Registra un pagamento e avanza ``last_payment_date`` dei periodi coperti.
+    Con una chiave già usata ritorna il pagamento esistente senza modifiche.
+    """
+    amount = to_money(amount)
+    if amount < 0:
+        raise ValueError("Amount must not be negative.")
+    if isinstance(payment_date, str):
+        payment_date = date.fromisoformat(payment_date)
+    idempotency_key = idempotency_key or None
+
+    if idempotency_key:
+        result = _existing(idempotency_key, detail_id, amount)
+        if result is not None:
+            return result
+
+    try:
+        with transaction.atomic():
+            detail = SubscriptionDetail.objects.select_for_update().get(pk=detail_id)
+            if idempotency_key:
+                # Un doppio invio concorrente aspetta il lock e trova il primo pagamento
+                result = _existing(idempotency_key, detail_id, amount)
+                if result is not None:
+                    return result
+            subscription = detail.subscription
+            user_count = SubscriptionDetail.objects.filter(subscription_id=subscription.pk).count()
+            available = amount + detail.credit
+            periods, used = allocate(
+                detail.last_payment_date, subscription.renew_period, prices.get_schedule(subscription.pk, subscription.revision),
+                user_count, available, today,
+            )
+            payment = Payment.objects.create(
+                subscription_detail=detail, amount=amount, payment_date=payment_date,
+                idempotency_key=idempotency_key, periods_covered=periods,
+            )
+            rollups.record([payment])
+            SubscriptionDetail.objects.filter(pk=detail.pk).update(
+                last_payment_date=billing.period_end(detail.last_payment_date, subscription.renew_period, periods),
+                credit=available - used,
+            )
+    except IntegrityError:
+        # Stessa chiave usata in parallelo su un altro membro
+        result = _existing(idempotency_key, detail_id, amount) if idempotency_key else None
+        if result is None:
+            raise
+        return result
+    # La revisione della sottoscrizione viene incrementata dal segnale post_save di Payment
+    return PaymentResult(payment, periods, True)
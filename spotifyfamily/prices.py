@@ -0,0 +1,132 @@
+"""
+Storico prezzi come insieme di intervalli senza sovrapposizioni.
+
+Un prezzo vale da ``valid_from`` (incluso) a ``valid_to`` (escluso, come lo
+scrive da sempre ``add_price``: il prezzo chiuso termina il giorno in cui
+inizia il nuovo); ``valid_to`` nullo indica il prezzo corrente.
+L'indice ordinato di ogni sottoscrizione resta in cache sotto una chiave con
+la revisione della sottoscrizione (``Subscription.revision``): ogni modifica
+a un prezzo la incrementa nel database, così nessun processo legge più
+l'indice precedente, che scade dopo ``PRICE_SCHEDULE_TIMEOUT`` secondi.
+"""
+from collections import defaultdict, namedtuple
+from datetime import date
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+
+from . import billing, fragments
+from .models import Subscription, SubscriptionPrice
+
+SCHEDULE_KEY = "price-schedule:{}:{}"
+
+PriceInterval = namedtuple("PriceInterval", ["id", "price", "valid_from", "valid_to"])
+
+
+class PriceOverlapError(ValueError):
+    pass
+
+
+def overlapping(subscription_id, valid_from, valid_to=None, exclude=None):
+    """Prezzi della sottoscrizione che si sovrappongono all'intervallo indicato"""
+    queryset = SubscriptionPrice.objects.filter(subscription_id=subscription_id).filter(
+        Q(valid_to__isnull=True) | Q(valid_to__gt=valid_from)
+    )
+    if valid_to is not None:
+        queryset = queryset.filter(valid_from__lt=valid_to)
+    if exclude is not None:
+        queryset = queryset.exclude(pk=exclude)
+    return queryset
+
+
+def invalidate(subscription_id):
+    """
+    Incrementa la revisione della sottoscrizione. Le letture concorrenti
+    vedono la nuova revisione solo dopo il commit, insieme ai nuovi prezzi.
+    """
+    fragments.bump_revision(subscription_id)
+
+
+def _timeout():
+    return getattr(settings, "PRICE_SCHEDULE_TIMEOUT", 300)
+
+
+def get_schedules(subscription_ids):
+    """
+    Indici dei prezzi delle sottoscrizioni indicate: una query per le
+    revisioni e una sola per i prezzi non in cache.
+    """
+    revisions = dict(Subscription.objects.filter(pk__in=subscription_ids).values_list("pk", "revision"))
+    keys = {pk: SCHEDULE_KEY.format(pk, revision) for pk, revision in revisions.items()}
+    cached = cache.get_many(keys.values())
+    intervals = {pk: cached[key] for pk, key in keys.items() if key in cached}
+    missing = [pk for pk in keys if pk not in intervals]
+    if missing:
+        loaded = defaultdict(list)
+        for row in SubscriptionPrice.objects.filter(subscription_id__in=missing).values_list(
+            "subscription_id", "id", "price", "valid_from", "valid_to",
+        ):
+            loaded[row[0]].append(PriceInterval(*row[1:]))
+        cache.set_many({keys[pk]: loaded[pk] for pk in missing}, timeout=_timeout())
+        intervals.update({pk: loaded[pk] for pk in missing})
+    return {pk: billing.PriceSchedule(rows) for pk, rows in intervals.items()}
+
+
+def get_schedule(subscription_id, revision=None):
+    """
+    Indice ordinato dei prezzi di una sottoscrizione (ricerca in O(log n)).
+    Senza ``revision`` la legge dal database.
+    """
+    if revision is None:
+        return get_schedules([subscription_id]).get(subscription_id, billing.PriceSchedule([]))
+    key = SCHEDULE_KEY.format(subscription_id, revision)
+    intervals = cache.get(key)
+    if intervals is None:
+        intervals = [
+            PriceInterval(*row)
+            for row in SubscriptionPrice.objects.filter(subscription_id=subscription_id).values_list(
+                "id", "price", "valid_from", "valid_to",
+            )
+        ]
+        cache.set(key, intervals, timeout=_timeout())
+    return billing.PriceSchedule(intervals)
+
+
+def price_on(subscription_id, day):
+    """Prezzo valido in una data, o None"""
+    return get_schedule(subscription_id).price_for_period(day, day)
+
+
+@transaction.atomic
+def add_price(subscription, price, valid_from):
+    """
+    Chiude il prezzo corrente alla data ``valid_from`` e apre il nuovo prezzo.
+    Solleva PriceOverlapError se il nuovo intervallo si sovrappone allo storico.
+    """
+    if isinstance(valid_from, str):
+        valid_from = date.fromisoformat(valid_from)
+    # Blocca la sottoscrizione: due aggiunte concorrenti vengono serializzate
+    Subscription.objects.select_for_update().filter(pk=subscription.pk).first()
+
+    conflicts = overlapping(subscription.pk, valid_from)
+    if conflicts.filter(Q(valid_to__isnull=False) | Q(valid_from__gte=valid_from)).exists():
+        raise PriceOverlapError("The new price overlaps an existing price period.")
+
+    subscription.prices.filter(valid_to__isnull=True).update(valid_to=valid_from)
+    new_price = SubscriptionPrice.objects.create(subscription=subscription, price=price, valid_from=valid_from)
+    invalidate(subscription.pk)
+    return new_price
+
+
+@transaction.atomic
+def update_price(price_obj, price):
+    """Modifica l'importo di un prezzo esistente"""
+    from . import ledger
+
+    SubscriptionPrice.objects.filter(pk=price_obj.pk).update(price=price)
+    price_obj.price = price
+    invalidate(price_obj.subscription_id)
+    ledger.reprice(price_obj.subscription_id, since=price_obj.valid_from)
+    return price_obj
@@ -0,0 +1,268 @@
+"""
+Profilazione su richiesta delle pagine, solo per lo staff.
+
+Una richiesta con il parametro ``?profile`` o l'header ``X-Profile`` fatta da
+un utente staff viene eseguita sotto cProfile e sotto un campionatore dello
+stack del thread; ogni query SQL viene registrata con durata e righe del
+progetto da cui parte. Il risultato finisce in ``PROFILE_DIR`` (al massimo
+``PROFILE_RETENTION`` profili, i più vecchi vengono eliminati) e si scarica da
+``/profiles/<id>.prof`` (pstats, per snakeviz o ``python -m pstats``) o
+``/profiles/<id>.collapsed`` (stack compressi per flamegraph.pl/speedscope).
+L'id è nell'header ``X-Profile-Id`` della risposta.
+
+Senza il parametro il costo è un controllo su query string e header, più
+la lettura di una variabile di contesto per ogni query.
+"""
+import cProfile
+import contextvars
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import FileResponse, Http404, JsonResponse
+from django.utils import timezone
+
+PARAM = "profile"
+HEADER = "HTTP_X_PROFILE"
+PROFILE_ID = re.compile(r"[0-9]{8}-[0-9]{6}-[0-9a-f]{8}")
+EXTENSIONS = {"prof": "application/octet-stream", "collapsed": "text/plain", "json": "application/json"}
+
+# Righe di stack del progetto conservate per ogni query
+ORIGIN_DEPTH = 5
+
+
+def profile_dir():
+    return getattr(settings, "PROFILE_DIR", None) or os.path.join(tempfile.gettempdir(), "spotifyfamily-profiles")
+
+
+class Sampler(threading.Thread):
+    """Campiona a intervalli regolari lo stack di un thread (formato collapsed)"""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+
+    def finish(self):
+        self._done.set()
+        self.join()
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def _origin():
+    # Solo i frame del progetto: Django e le librerie non dicono chi ha fatto la query
+    base = str(settings.BASE_DIR)
+    frames = [
+        frame for frame in traceback.extract_stack()[:-2]
+        if frame.filename.startswith(base) and "site-packages" not in frame.filename
+    ]
+    return [f"{os.path.relpath(frame.filename, base)}:{frame.lineno} in {frame.name}" for frame in frames[-ORIGIN_DEPTH:]]
+
+
+# Query della richiesta profilata corrente (None per tutte le altre)
+_current_queries = contextvars.ContextVar("profiled_queries", default=None)
+
+
+def _record_query(execute, sql, params, many, context):
+    queries = _current_queries.get()
+    if queries is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        queries.append({
+            "sql": sql,
+            "many": many,
+            "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+            "database": context["connection"].alias,
+            "origin": _origin(),
+        })
+
+
+def _install(connection, **kwargs):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+connection_created.connect(_install)
+
+
+def _requested(request):
+    return PARAM in request.GET or HEADER in request.META
+
+
+class Profile:
+    def __init__(self, request, user):
+        self.id = "{}-{}".format(time.strftime("%Y%m%d-%H%M%S"), uuid.uuid4().hex[:8])
+        self.request = request
+        self.user = user
+        self.queries = []
+        self.profiler = cProfile.Profile()
+        self.sampler = Sampler(threading.get_ident(), settings.PROFILE_SAMPLE_INTERVAL)
+
+    def start(self):
+        for connection in connections.all(initialized_only=True):
+            _install(connection)
+        self.token = _current_queries.set(self.queries)
+        self.started = time.perf_counter()
+        self.sampler.start()
+        try:
+            self.profiler.enable()
+        except ValueError:
+            # Un'altra richiesta è già sotto cProfile (Python >= 3.12): resta il campionatore
+            self.profiler = None
+
+    def end(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+        self.sampler.finish()
+        _current_queries.reset(self.token)
+        return time.perf_counter() - self.started
+
+    def stop(self, response):
+        save(self, response, self.end())
+        response["X-Profile-Id"] = self.id
+        return response
+
+
+def save(profile, response, duration):
+    """Scrive i file del profilo ed elimina i più vecchi oltre PROFILE_RETENTION"""
+    directory = profile_dir()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, profile.id)
+    if profile.profiler is not None:
+        profile.profiler.dump_stats(f"{path}.prof")
+    with open(f"{path}.collapsed", "w") as f:
+        f.write(profile.sampler.collapsed())
+    meta = {
+        "id": profile.id,
+        "created": timezone.now().isoformat(),
+        "method": profile.request.method,
+        "path": profile.request.get_full_path(),
+        "user": profile.user.get_username(),
+        "status": response.status_code,
+        "duration_ms": round(duration * 1000, 3),
+        "query_count": len(profile.queries),
+        "query_time_ms": round(sum(query["duration_ms"] for query in profile.queries), 3),
+        "queries": profile.queries,
+    }
+    with open(f"{path}.json", "w") as f:
+        json.dump(meta, f, indent=1)
+    prune(settings.PROFILE_RETENTION)
+
+
+def _profile_ids():
+    """Id dei profili salvati, dal più recente"""
+    try:
+        names = os.listdir(profile_dir())
+    except FileNotFoundError:
+        return []
+    return sorted({name.partition(".")[0] for name in names if PROFILE_ID.fullmatch(name.partition(".")[0])}, reverse=True)
+
+
+def prune(retention):
+    for profile_id in _profile_ids()[retention:]:
+        for extension in EXTENSIONS:
+            try:
+                os.remove(os.path.join(profile_dir(), f"{profile_id}.{extension}"))
+            except FileNotFoundError:
+                pass
+
+
+class ProfilingMiddleware:
+    """
+    Profila le richieste dello staff con ``?profile`` o ``X-Profile``. Va
+    messo dopo AuthenticationMiddleware.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not _requested(request) or not request.user.is_staff:
+            return self.get_response(request)
+        profile = Profile(request, request.user)
+        profile.start()
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            profile.end()
+            raise
+        return profile.stop(response)
+
+    async def __acall__(self, request):
+        if not _requested(request):
+            return await self.get_response(request)
+        user = await request.auser()
+        if not user.is_staff:
+            return await self.get_response(request)
+        profile = Profile(request, user)
+        profile.start()
+        try:
+            response = await self.get_response(request)
+        except BaseException:
+            profile.end()
+            raise
+        return profile.stop(response)
+
+
+@staff_member_required
+def profiles_view(request):
+    """Elenco dei profili salvati, senza l'elenco delle query"""
+    profiles = []
+    for profile_id in _profile_ids():
+        try:
+            with open(os.path.join(profile_dir(), f"{profile_id}.json")) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            continue
+        meta.pop("queries", None)
+        profiles.append(meta)
+    return JsonResponse({"profiles": profiles})
+
+
+@staff_member_required
+def profile_download(request, profile_id, extension):
+    if not PROFILE_ID.fullmatch(profile_id) or extension not in EXTENSIONS:
+        raise Http404
+    path = os.path.join(profile_dir(), f"{profile_id}.{extension}")
+    if not os.path.exists(path):
+        raise Http404
+    return FileResponse(
+        open(path, "rb"), as_attachment=True, filename=os.path.basename(path), content_type=EXTENSIONS[extension],
+    )
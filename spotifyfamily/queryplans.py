@@ -0,0 +1,150 @@
+"""
+Verifica dei piani di esecuzione delle query più frequenti dell'app.
+
+Ogni query viene eseguita con EXPLAIN (ANALYZE su PostgreSQL, QUERY PLAN su
+SQLite) e il piano viene analizzato alla ricerca di scansioni sequenziali e
+ordinamenti su più righe della soglia: sono il segno di un indice mancante.
+"""
+import re
+from dataclasses import dataclass
+from datetime import date
+
+from django.db import connections
+
+from . import billing, exports
+from .models import Subscription, SubscriptionDetail, SubscriptionPrice
+
+PG_NODE = re.compile(r"(?P<node>(?:Parallel )?Seq Scan|(?:Incremental )?Sort)(?: on (?P<table>\w+))?\s+\(")
+PG_ESTIMATED_ROWS = re.compile(r"\(cost=[\d.]+\.\.[\d.]+ rows=(\d+)")
+PG_ACTUAL_ROWS = re.compile(r"\(actual time=[\d.]+\.\.[\d.]+ rows=(\d+) loops=(\d+)\)")
+SQLITE_SCAN = re.compile(r"\bSCAN (?:TABLE )?(?P<table>\w+)")
+SQLITE_SORT = re.compile(r"USE TEMP B-TREE FOR (?P<what>[A-Z ]+)")
+
+# Query che per costruzione leggono tutte le righe di queste tabelle:
+# scansioni e ordinamenti sono scelte legittime del planner
+FULL_READS = {"dashboard_subscriptions": {"spotifyfamily_subscription", "spotifyfamily_user"}}
+
+
+@dataclass
+class Finding:
+    query: str
+    node: str
+    table: str
+    rows: int
+
+    @property
+    def detail(self):
+        table = f" on {self.table}" if self.table else ""
+        return f"{self.node}{table} ({self.rows} rows)"
+
+    def __str__(self):
+        return f"{self.query}: {self.detail}"
+
+
+def hot_queries(today=None):
+    """Nome -> queryset delle query eseguite dalle viste più usate"""
+    today = today or date.today()
+    subscription_ids = list(Subscription.objects.order_by("-start_date").values_list("id", flat=True)[:20])
+    subscription_id = subscription_ids[0] if subscription_ids else 0
+    return {
+        "dashboard_subscriptions": Subscription.objects.select_related("admin_user").order_by("-start_date"),
+        "dashboard_prices": SubscriptionPrice.objects.filter(subscription_id__in=subscription_ids)
+        .order_by("-valid_from"),
+        "dashboard_details": SubscriptionDetail.objects.filter(subscription_id__in=subscription_ids)
+        .select_related("user").order_by("pk"),
+        "current_price": SubscriptionPrice.objects.filter(subscription_id=subscription_id, valid_to__isnull=True),
+        "price_history": SubscriptionPrice.objects.filter(subscription_id=subscription_id)
+        .exclude(valid_to__isnull=True).order_by("-valid_from"),
+        "members_by_last_payment": SubscriptionDetail.objects.filter(subscription_id=subscription_id)
+        .order_by("last_payment_date"),
+        "overdue_members": SubscriptionDetail.objects.filter(
+            last_payment_date__lte=billing.shift_months(today, -12),
+        ),
+        "api_members_page": SubscriptionDetail.objects.order_by("id")[:101],
+        "export_payments_by_date": exports.payments_queryset(date_from=billing.shift_months(today, -1)),
+    }
+
+
+def explain(queryset, analyze=True):
+    """Piano di esecuzione in formato testo"""
+    if connections[queryset.db].vendor == "postgresql" and analyze:
+        return queryset.explain(analyze=True)
+    return queryset.explain()
+
+
+def _table_rows(alias, table, cache):
+    if table not in cache:
+        with connections[alias].cursor() as cursor:
+            cursor.execute(f"SELECT COUNT(*) FROM {connections[alias].ops.quote_name(table)}")
+            cache[table] = cursor.fetchone()[0]
+    return cache[table]
+
+
+def _expected(name, table):
+    return table in FULL_READS.get(name, ())
+
+
+def postgresql_findings(name, plan, threshold, main_table=None):
+    findings = []
+    for line in plan.splitlines():
+        match = PG_NODE.search(line)
+        if not match:
+            continue
+        # I nodi Sort non hanno tabella: vale la tabella principale della query
+        if _expected(name, match.group("table") or main_table):
+            continue
+        actual = PG_ACTUAL_ROWS.search(line)
+        if actual:
+            rows = int(actual.group(1)) * int(actual.group(2))
+        else:
+            estimated = PG_ESTIMATED_ROWS.search(line)
+            rows = int(estimated.group(1)) if estimated else 0
+        if rows > threshold:
+            findings.append(Finding(name, match.group("node"), match.group("table") or "", rows))
+    return findings
+
+
+def sqlite_findings(name, plan, threshold, queryset, table_rows):
+    """
+    SQLite non riporta il numero di righe: per le scansioni si usa la
+    dimensione della tabella (o il LIMIT, se la query non ordina a parte),
+    per gli ordinamenti il numero di righe restituite.
+    """
+    findings = []
+    sorts = SQLITE_SORT.findall(plan)
+    limit = queryset.query.high_mark if not sorts else None
+    for line in plan.splitlines():
+        scan = SQLITE_SCAN.search(line)
+        # Una scansione di un indice copre già filtro e ordinamento
+        if scan and "USING" not in line and not _expected(name, scan.group("table")):
+            rows = table_rows(scan.group("table"))
+            if limit is not None:
+                rows = min(rows, limit)
+            if rows > threshold:
+                findings.append(Finding(name, "SCAN", scan.group("table"), rows))
+        sort = SQLITE_SORT.search(line)
+        table = queryset.model._meta.db_table
+        if sort and not _expected(name, table):
+            rows = queryset.count()
+            if rows > threshold:
+                findings.append(Finding(name, f"TEMP B-TREE FOR {sort.group('what').strip()}", table, rows))
+    return findings
+
+
+def audit(threshold=10000, analyze=True, today=None):
+    """Ritorna {nome query: (piano, elenco dei problemi)}"""
+    results = {}
+    counts = {}
+    for name, queryset in hot_queries(today).items():
+        plan = explain(queryset, analyze)
+        vendor = connections[queryset.db].vendor
+        if vendor == "postgresql":
+            findings = postgresql_findings(name, plan, threshold, queryset.model._meta.db_table)
+        elif vendor == "sqlite":
+            findings = sqlite_findings(
+                name, plan, threshold, queryset, lambda table: _table_rows(queryset.db, table, counts),
+            )
+        else:
+            findings = []
+        results[name] = (plan, findings)
+    return results
@@ -0,0 +1,225 @@
+"""
+Promemoria per i membri con pagamenti scaduti.
+
+La ricerca è insiemistica: per ogni durata di rinnovo si calcola la data
+limite dell'ultimo pagamento oltre la quale almeno un periodo è scaduto, e
+una sola query (scorsa a blocchi con ``.iterator()``) trova tutti i membri in
+ritardo. Gli importi di ogni blocco possono essere calcolati in un pool di
+processi. I promemoria passano da una coda nel database (``OverdueReminder``,
+uno per utente per giorno), quindi il job si può rilanciare dopo un crash:
+i promemoria già in coda non vengono duplicati e quelli già inviati non
+vengono rispediti.
+"""
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+from itertools import groupby, islice
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from . import billing, prices
+from .models import OverdueReminder, Subscription, SubscriptionDetail, SubscriptionPrice
+
+CHUNK_SIZE = 2000
+
+
+def overdue_cutoff(renew_period, today):
+    """
+    Ultima data di pagamento con almeno un periodo scaduto a ``today``: la
+    prima scadenza (``shift_months(ultimo pagamento, renew_period)``) cresce
+    con la data di pagamento, quindi i membri in ritardo sono quelli con
+    ultimo pagamento <= limite.
+    """
+    cutoff = billing.shift_months(today, -renew_period)
+    # Fine mese: più giorni hanno la stessa prima scadenza troncata
+    while billing.shift_months(cutoff + timedelta(days=1), renew_period) <= today:
+        cutoff += timedelta(days=1)
+    return cutoff
+
+
+def overdue_details(today=None):
+    """Membri con almeno un periodo scaduto e un indirizzo email, ordinati per utente"""
+    today = today or date.today()
+    renew_periods = Subscription.objects.filter(renew_period__gt=0).values_list("renew_period", flat=True).distinct()
+    condition = Q(pk__in=[])
+    for renew_period in renew_periods:
+        condition |= Q(
+            subscription__renew_period=renew_period,
+            last_payment_date__lte=overdue_cutoff(renew_period, today),
+        )
+    return (
+        SubscriptionDetail.objects.filter(condition)
+        .exclude(user__email="")
+        .order_by("user_id", "id")
+        .values_list(
+            "user_id", "subscription_id", "subscription__name", "last_payment_date", "subscription__renew_period",
+            "credit",
+        )
+    )
+
+
+def _chunks(rows, size):
+    rows = iter(rows)
+    while chunk := list(islice(rows, size)):
+        yield chunk
+
+
+def compute_chunk(rows, schedules, user_counts, today):
+    """
+    Importi dovuti per ogni riga del blocco. Non usa il database, così può
+    girare in un processo separato.
+    """
+    result = []
+    for user_id, subscription_id, name, last_payment_date, renew_period, credit in rows:
+        periods = billing.count_unpaid_periods(last_payment_date, renew_period, today)
+        amount = billing.amount_to_pay(
+            last_payment_date, renew_period, schedules[subscription_id], user_counts.get(subscription_id, 0), today,
+            credit,
+        )
+        result.append((user_id, {"subscription": name, "periods": periods, "amount": amount}))
+    return result
+
+
+def _load_subscriptions(subscription_ids, schedules, user_counts):
+    """Carica storico prezzi e numero di membri delle sottoscrizioni non ancora viste"""
+    missing = [pk for pk in subscription_ids if pk not in schedules]
+    if not missing:
+        return
+    intervals = {pk: [] for pk in missing}
+    for row in SubscriptionPrice.objects.filter(subscription_id__in=missing).values_list(
+        "subscription_id", "id", "price", "valid_from", "valid_to",
+    ):
+        intervals[row[0]].append(prices.PriceInterval(*row[1:]))
+    for pk, rows in intervals.items():
+        schedules[pk] = billing.PriceSchedule(rows)
+    user_counts.update(
+        SubscriptionDetail.objects.filter(subscription_id__in=missing)
+        .values("subscription_id").annotate(n=Count("id")).values_list("subscription_id", "n")
+    )
+
+
+def _compute_job(job):
+    return compute_chunk(*job)
+
+
+def _bounded_map(executor, fn, items, window):
+    """Come executor.map, ma con al massimo ``window`` blocchi in memoria"""
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _reminders(results, run_date):
+    for user_id, group in groupby(results, key=lambda item: item[0]):
+        lines = [line for _, line in group if line["amount"] > 0]
+        if lines:
+            amount = round(sum(line["amount"] for line in lines), 2)
+            yield OverdueReminder(user_id=user_id, run_date=run_date, amount=amount, lines=lines)
+
+
+def queue_reminders(today=None, chunk_size=CHUNK_SIZE, workers=0):
+    """
+    Mette in coda un promemoria per ogni utente in ritardo; ritorna il numero
+    di promemoria creati (quelli già in coda per ``today`` non contano). Con ``workers`` > 0 gli importi sono calcolati in un
+    pool di processi.
+    """
+    today = today or date.today()
+    schedules, user_counts = {}, {}
+
+    def jobs():
+        for chunk in _chunks(overdue_details(today).iterator(chunk_size=chunk_size), chunk_size):
+            subscription_ids = {row[1] for row in chunk}
+            _load_subscriptions(subscription_ids, schedules, user_counts)
+            yield (
+                chunk,
+                {pk: schedules[pk] for pk in subscription_ids},
+                {pk: user_counts.get(pk, 0) for pk in subscription_ids},
+                today,
+            )
+
+    if workers:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = _bounded_map(executor, _compute_job, jobs(), window=workers * 2)
+    else:
+        executor = None
+        results = (compute_chunk(*job) for job in jobs())
+
+    queued = 0
+    # Le righe sono ordinate per utente: l'ultimo utente di un blocco può
+    # continuare nel blocco successivo e viene accodato con quello
+    carry = []
+    try:
+        for chunk_result in results:
+            rows = carry + chunk_result
+            last_user = rows[-1][0]
+            carry = [row for row in rows if row[0] == last_user]
+            complete = rows[:len(rows) - len(carry)]
+            queued += _queue(complete, today)
+        queued += _queue(carry, today)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return queued
+
+
+def _queue(results, run_date):
+    reminders = list(_reminders(results, run_date))
+    # I promemoria già in coda (job rilanciato) vengono ignorati e non contati
+    existing = set(
+        OverdueReminder.objects.filter(run_date=run_date, user_id__in=[reminder.user_id for reminder in reminders])
+        .values_list("user_id", flat=True)
+    )
+    reminders = [reminder for reminder in reminders if reminder.user_id not in existing]
+    # ignore_conflicts resta per un job concorrente che li accoda nel frattempo
+    OverdueReminder.objects.bulk_create(reminders, ignore_conflicts=True)
+    return len(reminders)
+
+
+def render(reminder):
+    lines = "\n".join(
+        f"- {line['subscription']}: {line['periods']} period(s), €{line['amount']:.2f}" for line in reminder.lines
+    )
+    return EmailMessage(
+        subject="Payment reminder",
+        body=(
+            f"Hi {reminder.user.username},\n\n"
+            f"you have €{reminder.amount:.2f} of overdue payments:\n\n{lines}\n"
+        ),
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[reminder.user.email],
+    )
+
+
+def send_pending(run_date=None, rate=None, connection=None, sleep=time.sleep):
+    """
+    Invia i promemoria in coda non ancora inviati, al massimo ``rate`` al
+    secondo. Ogni promemoria è segnato come inviato subito dopo l'invio.
+    """
+    run_date = run_date or date.today()
+    rate = settings.REMINDER_RATE if rate is None else rate
+    interval = 1 / rate if rate > 0 else 0
+    connection = connection or get_connection()
+    pending = (
+        OverdueReminder.objects.filter(run_date=run_date, sent_at__isnull=True)
+        .select_related("user").order_by("id")
+    )
+    sent = 0
+    next_at = time.monotonic()
+    with connection:
+        for reminder in pending.iterator(chunk_size=CHUNK_SIZE):
+            wait = next_at - time.monotonic()
+            if wait > 0:
+                sleep(wait)
+            next_at = max(next_at, time.monotonic()) + interval
+            connection.send_messages([render(reminder)])
+            OverdueReminder.objects.filter(pk=reminder.pk).update(sent_at=timezone.now())
+            sent += 1
+    return sent
@@ -0,0 +1,139 @@
+"""
+Totali mensili dei pagamenti per membro e archiviazione dei pagamenti vecchi.
+
+``PaymentMonthlyRollup`` contiene, per ogni membro e mese, somma e numero dei
+pagamenti, archiviati compresi: le domande del tipo "quanto ha pagato X
+quest'anno" leggono al massimo 12 righe per membro invece della tabella dei
+pagamenti. I totali sono aggiornati in modo incrementale (upsert che somma)
+da chi registra, modifica o elimina pagamenti; ``rebuild`` li ricalcola da zero.
+
+L'archiviazione sposta i pagamenti più vecchi del periodo di conservazione in
+``ArchivedPayment`` (stesso id) a blocchi, ognuno in una transazione: i
+totali non cambiano e il job si può rilanciare dopo un'interruzione.
+"""
+from collections import defaultdict
+from datetime import date
+
+from django.db import connection, transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncMonth
+
+from . import billing
+from .models import ArchivedPayment, Payment, PaymentMonthlyRollup
+
+BATCH_SIZE = 5000
+
+
+def month_of(day):
+    return day.replace(day=1)
+
+
+def _upsert_sql():
+    table = connection.ops.quote_name(PaymentMonthlyRollup._meta.db_table)
+    detail, month, total, count = (
+        connection.ops.quote_name(name) for name in ("subscription_detail_id", "month", "total", "payment_count")
+    )
+    # PostgreSQL e SQLite (>= 3.24) hanno la stessa sintassi di upsert
+    return (
+        f"INSERT INTO {table} ({detail}, {month}, {total}, {count}) VALUES (%s, %s, %s, %s) "
+        f"ON CONFLICT ({detail}, {month}) DO UPDATE SET "
+        f"{total} = {table}.{total} + excluded.{total}, {count} = {table}.{count} + excluded.{count}"
+    )
+
+
+def record(payments, sign=1):
+    """
+    Aggiunge ai totali mensili i pagamenti indicati (``sign=-1`` per toglierli).
+    Accetta oggetti con ``subscription_detail_id``, ``payment_date`` e ``amount``.
+    """
+    deltas = defaultdict(lambda: [0.0, 0])
+    for payment in payments:
+        delta = deltas[payment.subscription_detail_id, month_of(payment.payment_date)]
+        delta[0] += sign * float(payment.amount)
+        delta[1] += sign
+    if not deltas:
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(_upsert_sql(), [
+            (detail_id, month, round(total, 2), count) for (detail_id, month), (total, count) in deltas.items()
+        ])
+    if sign < 0:
+        # Mesi rimasti senza pagamenti
+        PaymentMonthlyRollup.objects.filter(
+            subscription_detail_id__in={detail_id for detail_id, _ in deltas}, payment_count__lte=0,
+        ).delete()
+
+
+def rebuild():
+    """Ricalcola tutti i totali da Payment e ArchivedPayment"""
+    totals = defaultdict(lambda: [0.0, 0])
+    for model in (Payment, ArchivedPayment):
+        rows = (
+            model.objects.annotate(month=TruncMonth("payment_date"))
+            .values_list("subscription_detail_id", "month")
+            .annotate(total=Sum("amount"), payment_count=Count("id"))
+            .order_by()
+        )
+        for detail_id, month, total, count in rows:
+            totals[detail_id, month][0] += total
+            totals[detail_id, month][1] += count
+    with transaction.atomic():
+        PaymentMonthlyRollup.objects.all().delete()
+        PaymentMonthlyRollup.objects.bulk_create(
+            [
+                PaymentMonthlyRollup(subscription_detail_id=detail_id, month=month, total=round(total, 2), payment_count=count)
+                for (detail_id, month), (total, count) in totals.items()
+            ],
+            batch_size=BATCH_SIZE,
+        )
+    return len(totals)
+
+
+def paid_by_month(year, subscription_detail=None, user=None, subscription=None):
+    """Totali per (membro, mese) di un anno, letti solo dai rollup"""
+    queryset = PaymentMonthlyRollup.objects.filter(month__gte=date(year, 1, 1), month__lt=date(year + 1, 1, 1))
+    if subscription_detail is not None:
+        queryset = queryset.filter(subscription_detail=subscription_detail)
+    if user is not None:
+        queryset = queryset.filter(subscription_detail__user=user)
+    if subscription is not None:
+        queryset = queryset.filter(subscription_detail__subscription=subscription)
+    return queryset.order_by("subscription_detail_id", "month")
+
+
+def paid_in_year(year, **filters):
+    """(totale, numero di pagamenti) di un anno"""
+    result = paid_by_month(year, **filters).aggregate(total=Sum("total"), payments=Sum("payment_count"))
+    return round(result["total"] or 0.0, 2), result["payments"] or 0
+
+
+def retention_cutoff(retention_months, today=None):
+    """Primo giorno del mese più vecchio da tenere nella tabella Payment"""
+    return month_of(billing.shift_months(today or date.today(), -retention_months))
+
+
+def archive_payments(before, batch_size=BATCH_SIZE):
+    """Sposta in ArchivedPayment i pagamenti con data < ``before``; ritorna quanti"""
+    moved = 0
+    while True:
+        with transaction.atomic():
+            rows = list(
+                Payment.objects.filter(payment_date__lt=before).order_by("id")
+                .values_list("id", "subscription_detail_id", "amount", "payment_date", "periods_covered")[:batch_size]
+            )
+            if not rows:
+                return moved
+            ArchivedPayment.objects.bulk_create(
+                [
+                    ArchivedPayment(
+                        id=pk, subscription_detail_id=detail_id, amount=amount, payment_date=payment_date,
+                        periods_covered=periods,
+                    )
+                    for pk, detail_id, amount, payment_date, periods in rows
+                ],
+                ignore_conflicts=True,
+            )
+            # Spostare un pagamento nell'archivio non cambia gli importi: niente segnali per riga
+            deleted = Payment.objects.filter(id__in=[row[0] for row in rows])
+            deleted._raw_delete(deleted.db)
+        moved += len(rows)
@@ -0,0 +1,176 @@
+"""
+Instradamento delle letture sulle repliche del database.
+
+Solo le richieste GET/HEAD/OPTIONS leggono da una replica; scritture,
+comandi di gestione e tutto ciò che avviene fuori da una richiesta usano il
+primario. Dopo una scrittura la stessa sessione browser resta sul primario
+per ``REPLICA_PIN_SECONDS`` (il ritardo massimo di replica atteso). Una
+replica che non risponde viene esclusa per ``REPLICA_HEALTH_TTL`` secondi.
+"""
+import contextvars
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+PIN_COOKIE = "db_primary"
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class _State:
+    def __init__(self, use_replica):
+        self.use_replica = use_replica
+        self.wrote = False
+        # Replica scelta alla prima lettura: tutta la richiesta legge dallo stesso database
+        self.alias = None
+
+
+# Stato della richiesta corrente (None fuori da una richiesta = primario)
+_state = contextvars.ContextVar("db_routing", default=None)
+
+_health = {}
+_health_lock = threading.Lock()
+
+
+def replica_aliases():
+    return list(getattr(settings, "REPLICA_DATABASES", []))
+
+
+def check_replica(alias):
+    """Prova una query sulla replica; ritorna False se non è raggiungibile"""
+    try:
+        with connections[alias].cursor() as cursor:
+            cursor.execute("SELECT 1")
+        return True
+    except Exception:
+        try:
+            connections[alias].close()
+        except Exception:
+            pass
+        return False
+
+
+def is_healthy(alias):
+    """Stato di salute della replica, ricontrollato al massimo ogni REPLICA_HEALTH_TTL secondi"""
+    now = time.monotonic()
+    with _health_lock:
+        healthy, checked_at = _health.get(alias, (None, 0.0))
+    if healthy is None or now - checked_at >= settings.REPLICA_HEALTH_TTL:
+        healthy = check_replica(alias)
+        with _health_lock:
+            _health[alias] = (healthy, now)
+    return healthy
+
+
+def mark_down(alias):
+    with _health_lock:
+        _health[alias] = (False, time.monotonic())
+
+
+def mark_up(alias):
+    with _health_lock:
+        _health[alias] = (True, time.monotonic())
+
+
+def reset_health():
+    with _health_lock:
+        _health.clear()
+
+
+def choose_replica():
+    """Una replica sana a caso, oppure il primario"""
+    healthy = [alias for alias in replica_aliases() if is_healthy(alias)]
+    return random.choice(healthy) if healthy else DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def use_primary():
+    """Forza le letture sul primario nel blocco"""
+    outer = _state.get()
+    inner = _State(use_replica=False)
+    token = _state.set(inner)
+    try:
+        yield
+    finally:
+        _state.reset(token)
+        if outer is not None:
+            outer.wrote = outer.wrote or inner.wrote
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or not state.use_replica or state.wrote:
+            return DEFAULT_DB_ALIAS
+        # Le sessioni appena create non sono ancora sulle repliche
+        if model._meta.app_label == "sessions":
+            return DEFAULT_DB_ALIAS
+        if state.alias is None:
+            state.alias = choose_replica()
+        return state.alias
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        # Il salvataggio della sessione non conta come scrittura dei dati
+        if state is not None and model._meta.app_label != "sessions":
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *replica_aliases()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaMiddleware:
+    """Sceglie primario o replica per ogni richiesta e fissa il primario dopo una scrittura"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _start(self, request):
+        use_replica = (
+            bool(replica_aliases())
+            and request.method in SAFE_METHODS
+            and PIN_COOKIE not in request.COOKIES
+        )
+        state = _State(use_replica)
+        return state, _state.set(state)
+
+    def _finish(self, response, state):
+        if state.wrote and replica_aliases():
+            response.set_cookie(
+                PIN_COOKIE, "1", max_age=settings.REPLICA_PIN_SECONDS, httponly=True, samesite="Lax",
+            )
+        return response
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state, token = self._start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        return self._finish(response, state)
+
+    async def __acall__(self, request):
+        state, token = self._start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _state.reset(token)
+        return self._finish(response, state)
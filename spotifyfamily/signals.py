@@ -0,0 +1,86 @@
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_out
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import authcache, fragments, ledger, prices
+from .models import Payment, Subscription, SubscriptionDetail, SubscriptionPrice
+
+
+@receiver(pre_save, sender=SubscriptionPrice)
+def remember_price_start(sender, instance, **kwargs):
+    """Data di inizio prima della modifica: anche i periodi dal vecchio inizio vanno ricalcolati"""
+    if instance.pk:
+        instance._previous_valid_from = (
+            SubscriptionPrice.objects.filter(pk=instance.pk).values_list("valid_from", flat=True).first()
+        )
+
+
+@receiver([post_save, post_delete], sender=SubscriptionPrice)
+def invalidate_price_schedule(sender, instance, **kwargs):
+    """Ogni modifica a un prezzo invalida l'indice in cache della sottoscrizione"""
+    prices.invalidate(instance.subscription_id)
+    since = min(filter(None, [instance.valid_from, getattr(instance, "_previous_valid_from", None)]))
+    ledger.reprice(instance.subscription_id, since=since)
+
+
+BILLING_FIELDS = ("renew_period", "start_date")
+
+
+def _billing_values(instance):
+    return tuple(Subscription._meta.get_field(name).to_python(getattr(instance, name)) for name in BILLING_FIELDS)
+
+
+@receiver(pre_save, sender=Subscription)
+def remember_billing_fields(sender, instance, **kwargs):
+    """Durata del rinnovo e data di inizio prima della modifica"""
+    if instance.pk:
+        instance._previous_billing = (
+            Subscription.objects.filter(pk=instance.pk).values_list(*BILLING_FIELDS).first()
+        )
+
+
+@receiver(post_save, sender=Subscription)
+def rebill_unpaid_charges(sender, instance, created, **kwargs):
+    """Con un'altra sequenza di periodi gli addebiti ancora da pagare vanno rigenerati"""
+    previous = getattr(instance, "_previous_billing", None)
+    if not created and previous is not None and previous != _billing_values(instance):
+        ledger.rebill(instance.pk)
+
+
+@receiver(post_save, sender=SubscriptionDetail)
+@receiver(post_delete, sender=SubscriptionDetail)
+def reprice_unpaid_charges(sender, instance, created=True, **kwargs):
+    """Con un membro in più o in meno cambia la quota dei periodi ancora da pagare"""
+    if created:
+        ledger.reprice(instance.subscription_id, unpaid_only=True)
+
+
+@receiver([post_save, post_delete], sender=SubscriptionDetail)
+@receiver([post_save, post_delete], sender=Payment)
+def bump_subscription_revision(sender, instance, origin=None, **kwargs):
+    """
+    Membri e pagamenti salvati o eliminati (anche dall'admin) cambiano le
+    pagine della sottoscrizione. Il prezzo passa già da prices.invalidate.
+    """
+    if sender is Payment and origin is not None and getattr(origin, "model", type(origin)) is not Payment:
+        # Pagamenti eliminati a cascata: ci pensa il segnale del membro o della sottoscrizione
+        return
+    detail = instance.subscription_detail if sender is Payment else instance
+    subscription_id = detail.subscription_id
+    # Dopo il commit: la riga della sottoscrizione non resta bloccata per tutta la transazione
+    transaction.on_commit(lambda: fragments.bump_revision(subscription_id))
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def invalidate_cached_user(sender, instance, **kwargs):
+    """Modifiche, cambio password e ultimo accesso passano tutti da save()"""
+    authcache.invalidate(instance.pk)
+
+
+@receiver(user_logged_out)
+def invalidate_cached_user_on_logout(sender, request, user, **kwargs):
+    if user is not None:
+        authcache.invalidate(user.pk)
@@ -1,3 +1,1833 @@
-from django.test import TestCase
+import io
+import json
+import os
+import pstats
+import random
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import unittest.mock
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+
+import numpy as np
+from dateutil.relativedelta import relativedelta
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.hashers import check_password as django_check_password
+from django.contrib.sessions.models import Session
+from django.core import mail
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.models import F
+from django.http import HttpResponse
+from django.test import (
+    AsyncRequestFactory, LiveServerTestCase, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from . import (
+    authcache, benchmarks, billing, billing_db, exports, forecast, fragments, ledger, load, memberships, metrics,
+    pagination, payments, prices, queryplans, reminders, rollups, routers, synthetic, throttle,
+)
+from .dashboard import build_subscriptions_data
+from .management.commands.loadtest import parse_mix
+from .payment_import import import_payments
+from .models import (
+    ArchivedPayment, Charge, OverdueReminder, Payment, PaymentMonthlyRollup, Subscription, SubscriptionDetail,
+    SubscriptionPrice, User,
+)
 
 # Create your tests here.
+
+
+def reference_months_unpaid(last_payment_date, renew_period, today):
+    """Vecchio ciclo di SubscriptionDetail.get_months_unpaid"""
+    next_payment_date = last_payment_date + relativedelta(months=renew_period)
+    months_count = 0
+    while next_payment_date <= today:
+        months_count += 1
+        next_payment_date += relativedelta(months=renew_period)
+    return months_count
+
+
+def reference_amount_to_pay(last_payment_date, renew_period, prices_cache, user_count, today):
+    """Vecchio ciclo di views.calculate_amount_to_pay (prezzi ordinati per -valid_from)"""
+    next_payment_date = last_payment_date + relativedelta(months=renew_period)
+    total_amount = 0.0
+    while next_payment_date <= today:
+        period_start = next_payment_date - relativedelta(months=renew_period)
+        period_price = None
+        for price_obj in prices_cache:
+            if price_obj.valid_from <= next_payment_date:
+                if price_obj.valid_to is None or price_obj.valid_to >= period_start:
+                    period_price = price_obj
+                    break
+        if period_price:
+            total_amount += round(period_price.price / user_count, 2) if user_count > 0 else period_price.price
+        next_payment_date += relativedelta(months=renew_period)
+    return round(total_amount, 2)
+
+
+def random_price_history(rng, start, changes):
+    prices = []
+    valid_from = start
+    for i in range(changes + 1):
+        valid_to = None
+        if i < changes:
+            valid_to = valid_from + timedelta(days=rng.randint(20, 700))
+        prices.append(SimpleNamespace(
+            id=i + 1, price=round(rng.uniform(5, 30), 2), valid_from=valid_from, valid_to=valid_to,
+        ))
+        if valid_to:
+            valid_from = valid_to
+    return prices
+
+
+class BillingTests(SimpleTestCase):
+    def test_end_of_month_clamping_is_cumulative(self):
+        self.assertEqual(billing.period_end(date(2023, 1, 31), 1, 1), date(2023, 2, 28))
+        self.assertEqual(billing.period_end(date(2023, 1, 31), 1, 2), date(2023, 3, 28))
+        self.assertEqual(billing.period_end(date(2024, 1, 31), 1, 1), date(2024, 2, 29))
+        self.assertEqual(billing.period_end(date(2024, 1, 31), 3, 1), date(2024, 4, 30))
+        self.assertEqual(billing.period_end(date(2024, 2, 29), 48, 19), date(2100, 2, 28))
+        self.assertEqual(billing.period_end(date(2024, 2, 29), 48, 18), date(2096, 2, 29))
+
+    def test_period_end_matches_repeated_relativedelta(self):
+        rng = random.Random(1)
+        for _ in range(500):
+            start = date(2000, 1, 1) + timedelta(days=rng.randint(0, 9000))
+            renew_period = rng.choice([1, 2, 3, 5, 6, 7, 12, 24])
+            expected = start
+            for period in range(1, 60):
+                expected += relativedelta(months=renew_period)
+                self.assertEqual(billing.period_end(start, renew_period, period), expected)
+
+    def test_count_unpaid_periods_matches_reference(self):
+        rng = random.Random(2)
+        for _ in range(3000):
+            start = date(2015, 1, 1) + timedelta(days=rng.randint(0, 3650))
+            today = start + timedelta(days=rng.randint(-40, 3650))
+            renew_period = rng.choice([1, 2, 3, 6, 12])
+            self.assertEqual(
+                billing.count_unpaid_periods(start, renew_period, today),
+                reference_months_unpaid(start, renew_period, today),
+                (start, renew_period, today),
+            )
+
+    def test_amount_to_pay_matches_reference(self):
+        rng = random.Random(3)
+        for _ in range(1000):
+            start = date(2018, 1, 1) + timedelta(days=rng.randint(0, 1500))
+            prices = random_price_history(rng, start - timedelta(days=rng.randint(0, 60)), rng.randint(0, 5))
+            last_payment_date = start + timedelta(days=rng.randint(0, 400))
+            today = last_payment_date + timedelta(days=rng.randint(0, 2000))
+            renew_period = rng.choice([1, 1, 3, 12])
+            user_count = rng.randint(0, 6)
+            prices_cache = sorted(prices, key=lambda p: p.valid_from, reverse=True)
+            self.assertEqual(
+                billing.amount_to_pay(
+                    last_payment_date, renew_period, billing.PriceSchedule(prices), user_count, today
+                ),
+                reference_amount_to_pay(last_payment_date, renew_period, prices_cache, user_count, today),
+            )
+
+    def test_price_for_period_without_matching_price(self):
+        schedule = billing.PriceSchedule([
+            SimpleNamespace(id=1, price=10.0, valid_from=date(2024, 1, 1), valid_to=date(2024, 2, 1)),
+        ])
+        self.assertIsNone(schedule.price_for_period(date(2023, 11, 1), date(2023, 12, 1)))
+        self.assertIsNone(schedule.price_for_period(date(2024, 3, 1), date(2024, 4, 1)))
+        self.assertEqual(schedule.price_for_period(date(2024, 1, 15), date(2024, 2, 15)).price, 10.0)
+
+
+def create_subscription(admin, name, members=(), start_date=date(2024, 1, 15), price=17.99, renew_period=1):
+    subscription = Subscription.objects.create(
+        name=name, start_date=start_date, admin_user=admin, renew_period=renew_period,
+    )
+    SubscriptionPrice.objects.create(subscription=subscription, price=price, valid_from=start_date)
+    for user in (admin, *members):
+        SubscriptionDetail.objects.create(subscription=subscription, user=user, last_payment_date=start_date)
+    return subscription
+
+
+class DashboardTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_user("admin", password="password")
+        self.members = [User.objects.create_user(f"member{i}", password="password") for i in range(3)]
+        self.client.force_login(self.admin)
+        # Sessione e utente in cache, come per ogni richiesta dopo la prima
+        self.client.get(reverse("home"))
+
+    def count_home_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("home"))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_subscriptions(self):
+        create_subscription(self.admin, "Spotify", self.members)
+        baseline = self.count_home_queries()
+        for i in range(5):
+            subscription = create_subscription(self.admin, f"Netflix {i}", self.members[:i])
+            SubscriptionPrice.objects.filter(subscription=subscription).update(valid_to=date(2024, 6, 1))
+            SubscriptionPrice.objects.create(subscription=subscription, price=20, valid_from=date(2024, 6, 1))
+        self.assertEqual(self.count_home_queries(), baseline)
+
+    def test_payment_rows_match_model_methods(self):
+        subscription = create_subscription(self.admin, "Spotify", self.members)
+        response = self.client.get(reverse("home"))
+        (sub_data,) = response.context["subscriptions_data"]
+        self.assertEqual(len(sub_data["user_payments"]), 4)
+        for row, detail in zip(sub_data["user_payments"], subscription.subscriptiondetail_set.order_by("pk")):
+            self.assertEqual(row["user"], detail.user)
+            self.assertEqual(row["months_unpaid"], detail.get_months_unpaid())
+            self.assertEqual(row["amount_to_pay"], detail.get_amount_to_pay())
+
+
+@override_settings(REPLICA_DATABASES=["replica1", "replica2"])
+class ReplicaRoutingTests(SimpleTestCase):
+    databases = {"default"}
+
+    def setUp(self):
+        routers.reset_health()
+        self.addCleanup(routers.reset_health)
+        routers.mark_up("replica1")
+        routers.mark_down("replica2")
+        self.router = routers.ReplicaRouter()
+
+    def route(self, method="get", cookies=None, write=False):
+        """Esegue una richiesta tramite il middleware e ritorna (database letti, risposta)"""
+        reads = []
+
+        def view(request):
+            reads.append(self.router.db_for_read(User))
+            if write:
+                self.router.db_for_write(Payment)
+            reads.append(self.router.db_for_read(User))
+            return HttpResponse()
+
+        request = getattr(RequestFactory(), method)("/")
+        request.COOKIES.update(cookies or {})
+        response = routers.ReplicaMiddleware(view)(request)
+        return reads, response
+
+    def test_safe_requests_read_from_healthy_replica(self):
+        reads, response = self.route()
+        self.assertEqual(reads, ["replica1", "replica1"])
+        self.assertNotIn(routers.PIN_COOKIE, response.cookies)
+
+    def test_writes_use_primary(self):
+        reads, response = self.route("post", write=True)
+        self.assertEqual(reads, ["default", "default"])
+        self.assertIn(routers.PIN_COOKIE, response.cookies)
+
+    def test_read_after_write_sticks_to_primary(self):
+        reads, response = self.route(write=True)
+        self.assertEqual(reads, ["replica1", "default"])
+        pin = response.cookies[routers.PIN_COOKIE]
+        self.assertEqual(pin["max-age"], settings.REPLICA_PIN_SECONDS)
+        reads, _ = self.route(cookies={routers.PIN_COOKIE: pin.value})
+        self.assertEqual(reads, ["default", "default"])
+
+    def test_sessions_stay_on_primary(self):
+        reads = []
+
+        def view(request):
+            reads.append(self.router.db_for_read(Session))
+            self.router.db_for_write(Session)
+            return HttpResponse()
+
+        response = routers.ReplicaMiddleware(view)(RequestFactory().get("/"))
+        self.assertNotIn(routers.PIN_COOKIE, response.cookies)
+        # Le sessioni si leggono sempre dal primario
+        self.assertEqual(reads, ["default"])
+
+    def test_falls_back_to_primary_when_replicas_are_down(self):
+        routers.mark_down("replica1")
+        reads, _ = self.route()
+        self.assertEqual(reads, ["default", "default"])
+
+    def test_health_check(self):
+        self.assertFalse(routers.check_replica("missing"))
+        self.assertTrue(routers.check_replica("default"))
+
+    def test_primary_outside_requests(self):
+        self.assertEqual(self.router.db_for_read(User), "default")
+        with routers.use_primary():
+            self.assertEqual(self.router.db_for_read(User), "default")
+        self.assertTrue(self.router.allow_migrate("default", "spotifyfamily"))
+        self.assertFalse(self.router.allow_migrate("replica1", "spotifyfamily"))
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_user("admin", password="password")
+        self.member = User.objects.create_user("member", password="password")
+        self.subscription = create_subscription(self.admin, "Spotify", [self.member])
+        self.client.force_login(self.admin)
+        self.edit_url = reverse("edit_subscription", args=[self.subscription.pk])
+
+    def revalidate(self, url, response):
+        return self.client.get(url, headers={"if-none-match": response["ETag"]})
+
+    def test_unchanged_pages_return_304_without_billing_work(self):
+        for url in (reverse("home"), self.edit_url):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("no-cache", response["Cache-Control"])
+            with CaptureQueriesContext(connection) as queries:
+                again = self.revalidate(url, response)
+            self.assertEqual(again.status_code, 304)
+            # Resta la query dei validatori, più sessione e utente senza una cache condivisa
+            self.assertEqual(len(queries), 1 if settings.SHARED_CACHE else 3)
+            self.assertEqual(
+                self.client.get(url, headers={"if-modified-since": response["Last-Modified"]}).status_code, 304,
+            )
+
+    def test_changes_invalidate_validators(self):
+        home = self.client.get(reverse("home"))
+        edit = self.client.get(self.edit_url)
+        self.client.post(
+            reverse("register_payment", args=[self.subscription.pk, self.member.pk]),
+            {"amount_paid": "9", "payment_date": "2024-06-20"},
+        )
+        # Il messaggio di conferma va mostrato: niente 304 finché è in attesa
+        self.assertEqual(self.revalidate(reverse("home"), home).status_code, 200)
+        self.assertEqual(self.revalidate(reverse("home"), home).status_code, 200)
+        self.assertEqual(self.revalidate(self.edit_url, edit).status_code, 200)
+
+        edit = self.client.get(self.edit_url)
+        self.client.post(self.edit_url, {"action": "add_price", "new_price": "20", "price_valid_from": "2024-06-01"})
+        self.client.get(self.edit_url)  # mostra il messaggio
+        self.assertEqual(self.revalidate(self.edit_url, edit).status_code, 200)
+
+    def test_etag_depends_on_day_and_user(self):
+        etag = self.client.get(reverse("home"))["ETag"]
+        self.client.force_login(self.member)
+        self.assertNotEqual(self.client.get(reverse("home"))["ETag"], etag)
+        with unittest.mock.patch("spotifyfamily.conditional.date") as mock_date:
+            mock_date.today.return_value = date.today() + timedelta(days=1)
+            self.client.force_login(self.admin)
+            self.assertNotEqual(self.client.get(reverse("home"))["ETag"], etag)
+
+    def test_non_admin_edit_is_not_conditional(self):
+        self.client.force_login(self.member)
+        response = self.client.get(self.edit_url)
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(response.has_header("ETag"))
+
+
+class FragmentCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        fragments.reset_stats()
+        self.admin = User.objects.create_user("admin", password="password")
+        self.member = User.objects.create_user("member", password="password")
+        self.subscription = create_subscription(self.admin, "Spotify", [self.member])
+        self.client.force_login(self.admin)
+
+    def test_blocks_are_served_from_cache(self):
+        with self.assertNumQueries(3):
+            build_subscriptions_data()
+        with self.assertNumQueries(1):
+            data = build_subscriptions_data()
+        self.assertEqual(len(data[0]["user_payments"]), 2)
+        self.assertEqual(fragments.stats(), {"hits": 1, "misses": 1})
+
+    def test_register_payment_bumps_revision(self):
+        build_subscriptions_data()
+        # L'importo copre tutti i periodi scaduti
+        outstanding = SubscriptionDetail.objects.get(user=self.member).get_amount_to_pay()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                reverse("register_payment", args=[self.subscription.pk, self.member.pk]),
+                {"amount_paid": str(outstanding), "payment_date": date.today().isoformat()},
+            )
+        (sub_data,) = build_subscriptions_data()
+        self.assertEqual(fragments.stats()["misses"], 2)
+        row = next(row for row in sub_data["user_payments"] if row["user"] == self.member)
+        self.assertEqual(row["months_unpaid"], 0)
+
+    def test_edit_subscription_bumps_revision(self):
+        build_subscriptions_data()
+        self.client.post(
+            reverse("edit_subscription", args=[self.subscription.pk]),
+            {"action": "add_price", "new_price": "20", "price_valid_from": "2024-06-01"},
+        )
+        (sub_data,) = build_subscriptions_data()
+        self.assertEqual(len(sub_data["prices"]), 2)
+
+    def test_model_changes_bump_revision(self):
+        """Modifiche fatte dall'admin o con save()/delete(), senza passare dalle viste"""
+        detail = SubscriptionDetail.objects.get(user=self.member)
+        revision = self.subscription.revision
+        changes = [
+            lambda: Payment.objects.create(subscription_detail=detail, amount=5, payment_date=date(2024, 2, 1)),
+            lambda: Payment.objects.get().delete(),
+            lambda: SubscriptionDetail.objects.filter(pk=detail.pk).first().save(),
+            lambda: SubscriptionPrice.objects.filter(subscription=self.subscription).first().save(),
+            lambda: detail.delete(),
+        ]
+        for change in changes:
+            with self.captureOnCommitCallbacks(execute=True):
+                change()
+            self.subscription.refresh_from_db()
+            self.assertGreater(self.subscription.revision, revision)
+            revision = self.subscription.revision
+
+    def test_revision_comes_from_database(self):
+        build_subscriptions_data()
+        # Modifica fatta da un altro processo: la cache locale non sa niente
+        Subscription.objects.filter(pk=self.subscription.pk).update(revision=F("revision") + 1)
+        build_subscriptions_data()
+        self.assertEqual(fragments.stats(), {"hits": 0, "misses": 2})
+
+    def test_new_day_misses_cache(self):
+        build_subscriptions_data(today=date(2025, 1, 1))
+        build_subscriptions_data(today=date(2025, 1, 2))
+        self.assertEqual(fragments.stats(), {"hits": 0, "misses": 2})
+
+
+class MembershipTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_user("admin", password="password")
+        self.members = [User.objects.create_user(f"member{i}", password="password") for i in range(3)]
+        self.others = [User.objects.create_user(f"other{i}", password="password") for i in range(12)]
+        self.subscription = create_subscription(self.admin, "Spotify", self.members[:1])
+        self.client.force_login(self.admin)
+
+    def test_current_cycle_start(self):
+        self.assertEqual(billing.current_cycle_start(date(2024, 1, 31), 1, date(2024, 3, 15)), date(2024, 2, 29))
+        self.assertEqual(billing.current_cycle_start(date(2024, 1, 31), 1, date(2024, 3, 31)), date(2024, 3, 29))
+        self.assertEqual(billing.current_cycle_start(date(2024, 1, 15), 3, date(2024, 4, 14)), date(2024, 1, 15))
+        self.assertEqual(billing.current_cycle_start(date(2024, 1, 15), 1, date(2023, 12, 1)), date(2024, 1, 15))
+
+    def test_search_users_by_prefix(self):
+        response = self.client.get(reverse("search_users"), {"q": "other", "subscription": self.subscription.pk})
+        results = response.json()["results"]
+        self.assertEqual(len(results), memberships.SEARCH_LIMIT)
+        self.assertEqual(results[0], {"id": self.others[0].pk, "username": "other0"})
+        response = self.client.get(reverse("search_users"), {"q": "member", "subscription": self.subscription.pk})
+        self.assertEqual([u["username"] for u in response.json()["results"]], ["member1", "member2"])
+        self.assertEqual(self.client.get(reverse("search_users"), {"q": ""}).json(), {"results": []})
+
+    def test_search_requires_login(self):
+        self.client.logout()
+        response = self.client.get(reverse("search_users"), {"q": "other"})
+        self.assertEqual(response.status_code, 302)
+
+    def test_update_members_in_one_transaction(self):
+        payment = Payment.objects.create(
+            subscription_detail=self.subscription.subscriptiondetail_set.get(user=self.members[0]),
+            amount=5, payment_date=date(2024, 2, 15),
+        )
+        revision = fragments.get_revisions(Subscription.objects.filter(pk=self.subscription.pk))
+        response = self.client.post(reverse("edit_subscription", args=[self.subscription.pk]), {
+            "action": "update_members",
+            "add_user_ids": [self.members[1].pk, self.members[2].pk, self.members[0].pk],
+            "remove_user_ids": [self.members[0].pk, self.admin.pk],
+        })
+        self.assertEqual(response.status_code, 302)
+        members = set(self.subscription.subscriptiondetail_set.values_list("user__username", flat=True))
+        self.assertEqual(members, {"admin", "member1", "member2"})
+        self.assertFalse(Payment.objects.filter(pk=payment.pk).exists())
+        self.assertNotEqual(fragments.get_revisions(Subscription.objects.filter(pk=self.subscription.pk)), revision)
+
+    def test_new_members_start_from_current_cycle(self):
+        added, removed = memberships.update_members(
+            self.subscription, add=[self.members[1].pk, self.members[1].pk], today=date(2024, 5, 20),
+        )
+        self.assertEqual((added, removed), (1, 0))
+        detail = SubscriptionDetail.objects.get(subscription=self.subscription, user=self.members[1])
+        self.assertEqual(detail.last_payment_date, date(2024, 5, 15))
+        self.assertEqual(memberships.update_members(self.subscription, add=[self.members[1].pk]), (0, 0))
+
+    def test_edit_page_does_not_load_all_users(self):
+        response = self.client.get(reverse("edit_subscription", args=[self.subscription.pk]))
+        self.assertNotIn("all_users", response.context)
+        self.assertNotContains(response, "other0")
+        self.assertContains(response, 'value="update_members"')
+
+
+class OverdueReminderTests(TestCase):
+    today = date(2024, 6, 20)
+
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_user("admin", email="admin@example.com", password="password")
+        self.members = [
+            User.objects.create_user(f"member{i}", email=f"member{i}@example.com", password="password")
+            for i in range(4)
+        ]
+        self.no_email = User.objects.create_user("noemail", password="password")
+        self.monthly = create_subscription(self.admin, "Spotify", [*self.members[:3], self.no_email])
+        self.quarterly = create_subscription(
+            self.members[0], "Netflix", self.members[1:], start_date=date(2024, 1, 31), price=20, renew_period=3,
+        )
+        SubscriptionDetail.objects.filter(user=self.members[2]).update(last_payment_date=date(2024, 5, 31))
+        SubscriptionDetail.objects.filter(user=self.members[3]).update(last_payment_date=date(2024, 4, 1))
+
+    def expected(self):
+        totals = {}
+        for detail in SubscriptionDetail.objects.select_related("subscription", "user").exclude(user__email=""):
+            amount = billing.amount_to_pay(
+                detail.last_payment_date, detail.subscription.renew_period,
+                prices.get_schedule(detail.subscription_id), detail.subscription.users.count(), self.today,
+            )
+            if amount:
+                totals[detail.user.username] = round(totals.get(detail.user.username, 0) + amount, 2)
+        return totals
+
+    def queued(self):
+        return dict(OverdueReminder.objects.filter(run_date=self.today).values_list("user__username", "amount"))
+
+    def test_overdue_cutoff_matches_unpaid_periods(self):
+        for renew_period in (1, 2, 3, 12):
+            for today in (date(2024, 2, 29), date(2024, 3, 31), date(2023, 4, 30), date(2024, 6, 20)):
+                cutoff = reminders.overdue_cutoff(renew_period, today)
+                for offset in range(-5, 6):
+                    day = cutoff + timedelta(days=offset)
+                    self.assertEqual(
+                        billing.count_unpaid_periods(day, renew_period, today) > 0, day <= cutoff,
+                        (renew_period, today, day),
+                    )
+
+    def test_queue_matches_billing(self):
+        for chunk_size in (1, 2, 1000):
+            OverdueReminder.objects.all().delete()
+            reminders.queue_reminders(self.today, chunk_size=chunk_size)
+            self.assertEqual(self.queued(), self.expected())
+        self.assertNotIn("noemail", self.queued())
+        self.assertNotIn("member2", self.queued())
+
+    def test_queue_with_process_pool(self):
+        reminders.queue_reminders(self.today, chunk_size=2, workers=2)
+        self.assertEqual(self.queued(), self.expected())
+
+    def test_rerun_does_not_duplicate(self):
+        self.assertEqual(reminders.queue_reminders(self.today), len(self.expected()))
+        first = reminders.send_pending(self.today, rate=0)
+        self.assertEqual(reminders.queue_reminders(self.today, chunk_size=2), 0)
+        self.assertEqual(reminders.send_pending(self.today, rate=0), 0)
+        self.assertEqual(len(mail.outbox), first)
+        self.assertEqual(OverdueReminder.objects.filter(sent_at__isnull=True).count(), 0)
+
+    def test_count_excludes_reminders_already_queued(self):
+        reminders.queue_reminders(self.today)
+        OverdueReminder.objects.filter(pk=OverdueReminder.objects.earliest("pk").pk).delete()
+        self.assertEqual(reminders.queue_reminders(self.today), 1)
+        self.assertEqual(self.queued(), self.expected())
+
+    def test_send_is_rate_limited(self):
+        reminders.queue_reminders(self.today)
+        waits = []
+        sent = reminders.send_pending(self.today, rate=2, sleep=waits.append)
+        self.assertEqual(sent, len(self.expected()))
+        self.assertEqual(len(waits), sent - 1)
+        # sleep finto: il tempo non avanza, le attese seguono il calendario a 2 email/s
+        for i, wait in enumerate(waits, start=1):
+            self.assertAlmostEqual(wait, i * 0.5, delta=0.1)
+        message = mail.outbox[0]
+        self.assertEqual(message.subject, "Payment reminder")
+        self.assertIn("Spotify", message.body)
+
+    def test_command_resumes_pending_reminders(self):
+        call_command("send_overdue_reminders", "--date", self.today.isoformat(), "--queue-only", stdout=io.StringIO())
+        self.assertEqual(len(mail.outbox), 0)
+        out = io.StringIO()
+        call_command("send_overdue_reminders", "--date", self.today.isoformat(), "--rate", "0", stdout=out)
+        self.assertIn(f"{len(self.expected())} reminder(s) sent", out.getvalue())
+
+
+class PaymentServiceTests(TestCase):
+    today = date(2024, 6, 20)
+
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_user("admin", password="password")
+        self.member = User.objects.create_user("member", password="password")
+        # Quota per membro: 10.00, poi 12.50 dal periodo che scade il 15/05
+        self.subscription = create_subscription(self.admin, "Spotify", [self.member], price=20)
+        prices.add_price(self.subscription, 25, "2024-05-15")
+        self.detail = SubscriptionDetail.objects.get(user=self.member)
+
+    def test_allocate_uses_period_prices(self):
+        schedule = prices.get_schedule(self.subscription.pk)
+        allocate = lambda amount: payments.allocate(date(2024, 1, 15), 1, schedule, 2, amount, self.today)
+        self.assertEqual(allocate(9.99), (0, 0.0))
+        self.assertEqual(allocate(30), (3, 30.0))
+        self.assertEqual(allocate(42.5), (4, 42.5))
+        self.assertEqual(allocate(60), (5, 55.0))
+
+    def test_rejects_non_finite_amounts(self):
+        for amount in ("inf", "-inf", "nan", "abc", float("inf"), -5):
+            with self.assertRaises(ValueError):
+                payments.register_payment(self.detail.pk, amount, "2024-06-20", today=self.today)
+        self.assertFalse(Payment.objects.exists())
+        self.detail.refresh_from_db()
+        self.assertEqual(self.detail.last_payment_date, date(2024, 1, 15))
+
+    def test_amounts_are_exact_cents(self):
+        self.assertEqual(payments.to_money("10.005"), Decimal("10.01"))
+        self.assertEqual(payments.to_money(0.1 + 0.2), Decimal("0.30"))
+        # 3 x 10.00 pagati in tre volte da 10.00 coprono tre periodi
+        for _ in range(3):
+            payments.register_payment(self.detail.pk, "10.00", "2024-06-20", today=self.today)
+        self.detail.refresh_from_db()
+        self.assertEqual(self.detail.last_payment_date, date(2024, 4, 15))
+
+    def test_leftover_is_kept_as_credit(self):
+        schedule = prices.get_schedule(self.subscription.pk)
+        due = lambda: billing.amount_to_pay(
+            self.detail.last_payment_date, 1, schedule, 2, self.today, self.detail.credit,
+        )
+        result = payments.register_payment(self.detail.pk, "6.00", "2024-06-20", today=self.today)
+        self.assertEqual(result.periods, 0)
+        self.detail.refresh_from_db()
+        self.assertEqual(self.detail.credit, Decimal("6.00"))
+        self.assertEqual(due(), 49.0)
+        # 6.00 di credito + 6.00 coprono il periodo da 10.00, restano 2.00
+        result = payments.register_payment(self.detail.pk, "6.00", "2024-06-20", today=self.today)
+        self.assertEqual(result.periods, 1)
+        self.detail.refresh_from_db()
+        self.assertEqual((self.detail.last_payment_date, self.detail.credit), (date(2024, 2, 15), Decimal("2.00")))
+        self.assertEqual(due(), 43.0)
+        self.assertEqual(self.detail.get_amount_to_pay(), billing.net_of_credit(
+            billing.amount_to_pay(self.detail.last_payment_date, 1, schedule, 2), Decimal("2.00"),
+        ))
+
+    def test_register_payment_advances_covered_periods(self):
+        result = payments.register_payment(self.detail.pk, 55, "2024-06-20", today=self.today)
+        self.assertEqual((result.periods, result.created), (5, True))
+        self.detail.refresh_from_db()
+        self.assertEqual(self.detail.last_payment_date, date(2024, 6, 15))
+        self.assertEqual(result.payment.periods_covered, 5)
+        # Pagamento anticipato: copre anche i periodi futuri
+        payments.register_payment(self.detail.pk, 25, "2024-06-20", today=self.today)
+        self.detail.refresh_from_db()
+        self.assertEqual(self.detail.last_payment_date, date(2024, 8, 15))
+
+    def test_idempotency_key(self):
+        first = payments.register_payment(self.detail.pk, 20, "2024-06-20", idempotency_key="abc", today=self.today)
+        again = payments.register_payment(self.detail.pk, 20, "2024-06-20", idempotency_key="abc", today=self.today)
+        self.assertEqual(again, first._replace(created=False))
+        self.assertEqual(Payment.objects.count(), 1)
+        with self.assertRaises(payments.PaymentConflict):
+            payments.register_payment(self.detail.pk, 30, "2024-06-20", idempotency_key="abc")
+
+    def test_view_double_submit(self):
+        self.client.force_login(self.admin)
+        url = reverse("register_payment", args=[self.subscription.pk, self.member.pk])
+        data = {"amount_paid": "20", "payment_date": "2024-06-20", "idempotency_key": "form-1"}
+        self.client.post(url, data)
+        self.client.post(url, data)
+        self.assertEqual(Payment.objects.filter(subscription_detail=self.detail).count(), 1)
+        self.detail.refresh_from_db()
+        self.assertEqual(self.detail.last_payment_date, date(2024, 3, 15))
+
+
+@unittest.skipUnless(connection.vendor == "postgresql", "row locks require PostgreSQL")
+class PaymentConcurrencyTests(TransactionTestCase):
+    """Stress test: molti pagamenti concorrenti, anche duplicati, sugli stessi membri"""
+
+    def test_concurrent_payments(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        admin = User.objects.create_user("admin", password="password")
+        members = [User.objects.create_user(f"member{i}", password="password") for i in range(3)]
+        subscription = create_subscription(admin, "Spotify", members, price=40)
+        details = list(SubscriptionDetail.objects.filter(subscription=subscription).order_by("pk"))
+        # 10.00 a periodo: ogni pagamento copre un periodo, ogni chiave è inviata tre volte
+        jobs = [(detail.pk, f"{detail.pk}-{i}") for detail in details for i in range(20)] * 3
+        random.Random(0).shuffle(jobs)
+
+        def pay(job):
+            try:
+                return payments.register_payment(job[0], 10, "2024-06-20", idempotency_key=job[1]).created
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            created = list(executor.map(pay, jobs))
+
+        self.assertEqual(sum(created), len(details) * 20)
+        self.assertEqual(Payment.objects.count(), len(details) * 20)
+        for detail in SubscriptionDetail.objects.filter(pk__in=[d.pk for d in details]):
+            self.assertEqual(detail.last_payment_date, billing.period_end(date(2024, 1, 15), 1, 20))
+
+
+class PriceIntervalMigrationTests(TransactionTestCase):
+    """La migrazione 0003 ripara lo storico prezzi esistente prima di aggiungere i vincoli"""
+
+    def test_existing_intervals_are_repaired(self):
+        from django.db.migrations.executor import MigrationExecutor
+
+        executor = MigrationExecutor(connection)
+        executor.migrate([("spotifyfamily", "0002_billing_functions")])
+        old_apps = executor.loader.project_state([("spotifyfamily", "0002_billing_functions")]).apps
+        OldUser = old_apps.get_model("spotifyfamily", "User")
+        OldSubscription = old_apps.get_model("spotifyfamily", "Subscription")
+        OldPrice = old_apps.get_model("spotifyfamily", "SubscriptionPrice")
+        admin = OldUser.objects.create(username="admin")
+        subscription = OldSubscription.objects.create(
+            name="Spotify", start_date=date(2023, 1, 1), admin_user=admin, renew_period=1,
+        )
+        rows = [
+            (10, date(2023, 1, 1), None),  # aperto, poi sostituito senza chiuderlo
+            (12, date(2023, 6, 1), date(2024, 3, 1)),  # sovrapposto al successivo
+            (15, date(2024, 1, 1), None),
+            (99, date(2023, 3, 1), date(2023, 2, 1)),  # valid_to prima di valid_from
+        ]
+        for price, valid_from, valid_to in rows:
+            OldPrice.objects.create(subscription=subscription, price=price, valid_from=valid_from, valid_to=valid_to)
+
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(executor.loader.graph.leaf_nodes())
+        history = list(
+            SubscriptionPrice.objects.filter(subscription_id=subscription.pk)
+            .order_by("valid_from", "id").values_list("price", "valid_from", "valid_to")
+        )
+        self.assertEqual(history, [
+            (10.0, date(2023, 1, 1), date(2023, 3, 1)),
+            (99.0, date(2023, 3, 1), date(2023, 3, 1)),
+            (12.0, date(2023, 6, 1), date(2024, 1, 1)),
+            (15.0, date(2024, 1, 1), None),
+        ])
+
+
+class PriceIntervalTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_user("admin", password="password")
+        self.subscription = create_subscription(self.admin, "Spotify")
+
+    def test_add_price_closes_current_price(self):
+        prices.add_price(self.subscription, 20, "2024-06-01")
+        history = list(self.subscription.prices.order_by("valid_from").values_list("price", "valid_from", "valid_to"))
+        self.assertEqual(history, [
+            (17.99, date(2024, 1, 15), date(2024, 6, 1)),
+            (20.0, date(2024, 6, 1), None),
+        ])
+
+    def test_add_price_rejects_overlaps(self):
+        prices.add_price(self.subscription, 20, "2024-06-01")
+        for valid_from in ("2024-06-01", "2024-03-01", "2023-12-01"):
+            with self.assertRaises(prices.PriceOverlapError):
+                prices.add_price(self.subscription, 25, valid_from)
+        self.assertEqual(self.subscription.prices.count(), 2)
+
+    def test_clean_rejects_overlaps(self):
+        prices.add_price(self.subscription, 20, "2024-06-01")
+        overlapping = SubscriptionPrice(
+            subscription=self.subscription, price=1, valid_from=date(2024, 5, 1), valid_to=date(2024, 7, 1),
+        )
+        with self.assertRaises(ValidationError):
+            overlapping.full_clean()
+        adjacent = SubscriptionPrice(
+            subscription=self.subscription, price=1, valid_from=date(2023, 1, 1), valid_to=date(2024, 1, 15),
+        )
+        adjacent.full_clean()
+
+    def test_schedule_is_cached_and_invalidated(self):
+        with self.assertNumQueries(2):
+            prices.get_schedule(self.subscription.pk)
+        # Con la revisione già nota nessuna query, altrimenti solo quella della revisione
+        self.subscription.refresh_from_db()
+        with self.assertNumQueries(0):
+            prices.get_schedule(self.subscription.pk, self.subscription.revision)
+        with self.assertNumQueries(1):
+            self.assertEqual(prices.price_on(self.subscription.pk, date(2024, 7, 1)).price, 17.99)
+
+        prices.add_price(self.subscription, 20, "2024-06-01")
+        self.assertEqual(prices.price_on(self.subscription.pk, date(2024, 7, 1)).price, 20.0)
+        self.assertEqual(prices.price_on(self.subscription.pk, date(2024, 5, 31)).price, 17.99)
+        self.assertIsNone(prices.price_on(self.subscription.pk, date(2024, 1, 1)))
+
+        current = self.subscription.prices.get(valid_to__isnull=True)
+        prices.update_price(current, 21)
+        self.assertEqual(prices.price_on(self.subscription.pk, date(2024, 7, 1)).price, 21.0)
+        current.delete()
+        self.assertIsNone(prices.price_on(self.subscription.pk, date(2024, 7, 1)))
+
+    def test_schedule_follows_database_revision(self):
+        prices.get_schedule(self.subscription.pk)
+        # Modifica fatta da un altro processo: la cache locale non viene toccata
+        SubscriptionPrice.objects.filter(subscription=self.subscription).update(price=30)
+        self.assertEqual(prices.price_on(self.subscription.pk, date(2024, 7, 1)).price, 17.99)
+        fragments.bump_revision(self.subscription.pk)
+        self.assertEqual(prices.price_on(self.subscription.pk, date(2024, 7, 1)).price, 30)
+        schedules = prices.get_schedules([self.subscription.pk])
+        self.assertEqual(schedules[self.subscription.pk].price_for_period(date(2024, 7, 1), date(2024, 7, 1)).price, 30)
+
+    def test_update_current_price_is_scoped_to_subscription(self):
+        other = create_subscription(self.admin, "Netflix")
+        self.client.force_login(self.admin)
+        other_price = other.prices.get()
+        response = self.client.post(
+            reverse("edit_subscription", args=[self.subscription.pk]),
+            {"action": "update_current_price", "price_id": other_price.pk, "current_price": "1"},
+        )
+        self.assertEqual(response.status_code, 404)
+        other_price.refresh_from_db()
+        self.assertEqual(other_price.price, 17.99)
+
+    def test_single_open_price(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            SubscriptionPrice.objects.create(subscription=self.subscription, price=20, valid_from=date(2024, 6, 1))
+
+    @unittest.skipUnless(connection.vendor == "postgresql", "exclusion constraints require PostgreSQL")
+    def test_exclusion_constraint(self):
+        SubscriptionPrice.objects.create(
+            subscription=self.subscription, price=10, valid_from=date(2023, 1, 1), valid_to=date(2023, 6, 1),
+        )
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            SubscriptionPrice.objects.create(
+                subscription=self.subscription, price=10, valid_from=date(2023, 5, 1), valid_to=date(2023, 7, 1),
+            )
+
+
+@unittest.skipUnless(connection.vendor == "postgresql", "billing_db requires PostgreSQL")
+@override_settings(BILLING_BACKEND="database")
+class DatabaseBillingParityTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(4)
+        users = [User.objects.create_user(f"user{i}") for i in range(8)]
+        for i in range(30):
+            start = date(2019, 1, 1) + timedelta(days=rng.randint(0, 1200))
+            subscription = Subscription.objects.create(
+                name=f"Subscription {i}", start_date=start, admin_user=users[0],
+                renew_period=rng.choice([1, 1, 2, 3, 12]),
+            )
+            for price in random_price_history(rng, start, rng.randint(0, 6)):
+                SubscriptionPrice.objects.create(
+                    subscription=subscription, price=price.price,
+                    valid_from=price.valid_from, valid_to=price.valid_to,
+                )
+            for user in rng.sample(users, rng.randint(1, len(users))):
+                SubscriptionDetail.objects.create(
+                    subscription=subscription, user=user,
+                    last_payment_date=start + timedelta(days=rng.choice([0, 30, 31, 59, rng.randint(0, 900)])),
+                    credit=Decimal(rng.choice(["0", "0", "0.01", "3.35", "1000"])),
+                )
+
+    def test_database_amounts_match_python(self):
+        details = SubscriptionDetail.objects.all()
+        self.assertTrue(billing_db.is_enabled(details))
+        for today in (date(2024, 2, 29), date(2025, 1, 31), date(2026, 3, 1)):
+            for detail in billing_db.annotate_amounts(details.select_related("subscription"), today):
+                subscription = detail.subscription
+                schedule = billing.PriceSchedule(subscription.prices.all())
+                self.assertEqual(
+                    detail.months_unpaid,
+                    billing.count_unpaid_periods(detail.last_payment_date, subscription.renew_period, today),
+                )
+                self.assertEqual(
+                    detail.amount_to_pay,
+                    billing.amount_to_pay(
+                        detail.last_payment_date, subscription.renew_period, schedule,
+                        subscription.users.count(), today, detail.credit,
+                    ),
+                )
+
+    def test_round_cents_matches_python_round(self):
+        rng = random.Random(5)
+        values = [11.685, 2.725, 0.125, 0.375, 1.005, 0.0] + [
+            round(rng.uniform(0, 50), 2) / rng.randint(1, 7) for _ in range(2000)
+        ]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT spotifyfamily_round_cents(v) FROM unnest(%s::double precision[]) AS v", [values]
+            )
+            self.assertEqual([row[0] for row in cursor.fetchall()], [round(value, 2) for value in values])
+
+    def test_dashboard_uses_database_amounts(self):
+        today = date(2025, 1, 31)
+        for sub_data in build_subscriptions_data(today=today):
+            for row in sub_data["user_payments"]:
+                detail = SubscriptionDetail.objects.get(subscription=sub_data["subscription"], user=row["user"])
+                self.assertEqual(row["months_unpaid"], billing.count_unpaid_periods(
+                    detail.last_payment_date, detail.subscription.renew_period, today,
+                ))
+
+
+class AdminTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_superuser("admin", password="password")
+        self.members = [User.objects.create_user(f"member{i}", password="password") for i in range(3)]
+        self.subscription = create_subscription(self.admin, "Spotify", self.members)
+        self.client.force_login(self.admin)
+        self.client.get(reverse("admin:index"))
+
+    def add_payments(self, count):
+        details = list(SubscriptionDetail.objects.all())
+        Payment.objects.bulk_create(
+            Payment(subscription_detail=details[i % len(details)], amount=5, payment_date=date(2024, 2, 1))
+            for i in range(count)
+        )
+
+    def changelist_queries(self, name):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse(f"admin:spotifyfamily_{name}_changelist"))
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_changelists_do_not_query_per_row(self):
+        for name in ("payment", "subscriptiondetail", "subscriptionprice", "subscription"):
+            self.add_payments(3)
+            _, few = self.changelist_queries(name)
+            self.add_payments(40)
+            _, many = self.changelist_queries(name)
+            self.assertEqual(few, many, name)
+
+    def test_outstanding_balance_column(self):
+        self.add_payments(2)
+        response, _ = self.changelist_queries("subscriptiondetail")
+        detail = SubscriptionDetail.objects.get(user=self.members[0])
+        self.assertContains(response, f'<td class="field-outstanding">{detail.get_amount_to_pay()}</td>', html=True)
+
+    def test_autocomplete_members(self):
+        response = self.client.get(reverse("admin:autocomplete"), {
+            "app_label": "spotifyfamily", "model_name": "payment", "field_name": "subscription_detail", "term": "member1",
+        })
+        self.assertEqual([r["text"] for r in response.json()["results"]], ["member1 - Spotify"])
+
+    def test_paginator_uses_exact_count_for_small_or_filtered_tables(self):
+        self.add_payments(5)
+        self.assertEqual(pagination.EstimatedCountPaginator(Payment.objects.all(), 2).count, 5)
+        paginator = pagination.EstimatedCountPaginator(Payment.objects.filter(amount__gt=100), 2)
+        self.assertEqual(paginator.count, 0)
+
+    @unittest.skipUnless(connection.vendor == "postgresql", "estimates come from pg_class")
+    def test_paginator_uses_estimate_on_large_tables(self):
+        self.add_payments(50)
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {Payment._meta.db_table}")
+        paginator = pagination.EstimatedCountPaginator(Payment.objects.all(), 10)
+        paginator.threshold = 10
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(paginator.count, pagination.estimated_count(Payment.objects.all()))
+        self.assertNotIn("COUNT", queries[0]["sql"].upper())
+
+
+class PaymentRollupTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_superuser("admin", password="password")
+        self.member = User.objects.create_user("member", password="password")
+        self.subscription = create_subscription(self.admin, "Spotify", [self.member], price=20)
+        self.detail = SubscriptionDetail.objects.get(user=self.member)
+
+    def pay(self, amount, payment_date):
+        return payments.register_payment(self.detail.pk, amount, payment_date, today=date(2024, 1, 1)).payment
+
+    def rollup_rows(self):
+        return list(PaymentMonthlyRollup.objects.order_by("subscription_detail_id", "month").values_list(
+            "subscription_detail_id", "month", "total", "payment_count",
+        ))
+
+    def test_rollups_follow_registered_payments(self):
+        self.pay(10, "2023-03-05")
+        self.pay(2.5, "2023-03-20")
+        self.pay(10, "2024-01-10")
+        self.assertEqual(rollups.paid_in_year(2023, user=self.member), (12.5, 2))
+        self.assertEqual(rollups.paid_in_year(2024, subscription=self.subscription), (10.0, 1))
+        self.assertEqual(
+            list(rollups.paid_by_month(2023, subscription_detail=self.detail).values_list("month", "total")),
+            [(date(2023, 3, 1), 12.5)],
+        )
+        # Nessuna lettura della tabella Payment
+        with CaptureQueriesContext(connection) as queries:
+            rollups.paid_in_year(2023, user=self.member)
+        self.assertNotIn(f'"{Payment._meta.db_table}"', queries[0]["sql"])
+
+    def test_import_and_admin_keep_rollups_in_sync(self):
+        import_payments(io.StringIO("username,subscription,amount,date\nmember,Spotify,7,2023-05-02\n"))
+        payment = self.pay(3, "2023-05-09")
+        self.client.force_login(self.admin)
+        url = reverse("admin:spotifyfamily_payment_change", args=[payment.pk])
+        self.client.post(url, {"subscription_detail": self.detail.pk, "amount": "4", "payment_date": "2023-06-01", "periods_covered": 0})
+        self.client.post(reverse("admin:spotifyfamily_payment_delete", args=[payment.pk]), {"post": "yes"})
+        expected = self.rollup_rows()
+        rollups.rebuild()
+        self.assertEqual(self.rollup_rows(), expected)
+        self.assertEqual(rollups.paid_in_year(2023, user=self.member), (7.0, 1))
+
+    def test_archive_moves_old_payments_and_keeps_rollups(self):
+        for day in ("2021-02-01", "2021-11-30", "2023-06-01", "2024-05-01"):
+            self.pay(10, day)
+        before = rollups.retention_cutoff(24, today=date(2024, 6, 15))
+        self.assertEqual(before, date(2022, 6, 1))
+        totals = self.rollup_rows()
+        self.assertEqual(rollups.archive_payments(before, batch_size=1), 2)
+        self.assertEqual(Payment.objects.count(), 2)
+        self.assertEqual(
+            sorted(ArchivedPayment.objects.values_list("payment_date", flat=True)),
+            [date(2021, 2, 1), date(2021, 11, 30)],
+        )
+        self.assertEqual(self.rollup_rows(), totals)
+        rollups.rebuild()
+        self.assertEqual(self.rollup_rows(), totals)
+        self.assertEqual(rollups.archive_payments(before), 0)
+
+    def test_archive_command(self):
+        self.pay(10, "2001-01-01")
+        out = io.StringIO()
+        call_command("archive_payments", "--retention-months", "12", "--rebuild-rollups", stdout=out)
+        self.assertIn("1 payment(s)", out.getvalue())
+        self.assertEqual(ArchivedPayment.objects.count(), 1)
+
+
+class ChargeLedgerTests(TestCase):
+    today = date(2024, 6, 20)
+
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_user("admin", password="password")
+        self.members = [User.objects.create_user(f"member{i}", password="password") for i in range(3)]
+        self.monthly = create_subscription(self.admin, "Spotify", self.members[:2], price=18)
+        prices.add_price(self.monthly, 24, "2024-04-01")
+        self.quarterly = create_subscription(
+            self.members[0], "Netflix", self.members[1:], start_date=date(2023, 11, 30), price=30, renew_period=3,
+        )
+        SubscriptionDetail.objects.filter(user=self.members[1], subscription=self.monthly).update(
+            last_payment_date=date(2024, 3, 15),
+        )
+
+    def expected(self, today=None):
+        today = today or self.today
+        return {
+            detail.pk: (
+                billing.count_unpaid_periods(detail.last_payment_date, detail.subscription.renew_period, today),
+                billing.amount_to_pay(
+                    detail.last_payment_date, detail.subscription.renew_period,
+                    prices.get_schedule(detail.subscription_id), detail.subscription.users.count(), today,
+                    detail.credit,
+                ),
+            )
+            for detail in SubscriptionDetail.objects.select_related("subscription")
+        }
+
+    def ledger_amounts(self):
+        return {
+            pk: (months, amount)
+            for pk, months, amount in ledger.annotate_amounts(SubscriptionDetail.objects.all())
+            .values_list("pk", "months_unpaid", "amount_to_pay")
+        }
+
+    def test_ledger_matches_billing(self):
+        ledger.run_billing(self.today)
+        self.assertEqual(self.ledger_amounts(), self.expected())
+        self.assertEqual(ledger.outstanding(), round(sum(amount for _, amount in self.expected().values()), 2))
+
+    def test_run_is_incremental_and_idempotent(self):
+        first = ledger.run_billing(date(2024, 5, 20))
+        self.assertGreater(first["created"], 0)
+        self.assertEqual(ledger.run_billing(date(2024, 5, 20)), {"members": 0, "created": 0, "deleted": 0})
+        # Un mese dopo: solo i periodi scaduti nel frattempo
+        new_periods = sum(months for months, _ in self.expected().values()) - Charge.objects.count()
+        second = ledger.run_billing(self.today)
+        self.assertEqual((second["members"], second["created"]), (new_periods, new_periods))
+        self.assertEqual(self.ledger_amounts(), self.expected())
+
+    def test_payments_settle_charges(self):
+        ledger.run_billing(self.today)
+        detail = SubscriptionDetail.objects.get(user=self.members[1], subscription=self.monthly)
+        payments.register_payment(detail.pk, 16, "2024-06-20", today=self.today)
+        self.assertEqual(self.ledger_amounts(), self.expected())
+
+    def test_price_change_reprices_only_affected_charges(self):
+        ledger.run_billing(self.today)
+        untouched = set(Charge.objects.filter(period_end__lt=date(2024, 5, 15)).values_list("pk", "amount"))
+        with CaptureQueriesContext(connection) as queries:
+            prices.add_price(self.monthly, 30, "2024-05-15")
+        self.assertEqual(set(Charge.objects.filter(period_end__lt=date(2024, 5, 15)).values_list("pk", "amount")), untouched)
+        self.assertEqual(self.ledger_amounts(), self.expected())
+        self.assertEqual(sum("UPDATE" in q["sql"] and "charge" in q["sql"] for q in queries), 1)
+
+        price = SubscriptionPrice.objects.get(subscription=self.monthly, valid_to__isnull=True)
+        prices.update_price(price, 36)
+        self.assertEqual(self.ledger_amounts(), self.expected())
+        price.delete()
+        self.assertEqual(self.ledger_amounts(), self.expected())
+
+    def test_membership_change_reprices_unpaid_charges(self):
+        ledger.run_billing(self.today)
+        memberships.update_members(self.monthly, add=[self.members[2].pk], today=self.today)
+        self.assertEqual(self.ledger_amounts(), {**self.expected(), **{
+            # Il nuovo membro non ha ancora periodi addebitati
+            detail.pk: (0, 0.0) for detail in SubscriptionDetail.objects.filter(user=self.members[2], subscription=self.monthly)
+        }})
+        SubscriptionDetail.objects.get(user=self.members[0], subscription=self.monthly).delete()
+        ledger.run_billing(self.today)
+        self.assertEqual(self.ledger_amounts(), self.expected())
+
+    def test_manual_last_payment_change_is_reconciled(self):
+        ledger.run_billing(self.today)
+        SubscriptionDetail.objects.filter(user=self.members[1], subscription=self.monthly).update(
+            last_payment_date=date(2024, 3, 20),
+        )
+        result = ledger.run_billing(self.today, full=True)
+        self.assertGreater(result["deleted"], 0)
+        self.assertEqual(self.ledger_amounts(), self.expected())
+
+    def test_renew_period_change_rebills_unpaid_charges(self):
+        ledger.run_billing(date.today())
+        self.client.force_login(self.admin)
+        self.client.post(reverse("edit_subscription", args=[self.monthly.pk]), {
+            "action": "update_subscription", "name": "Spotify", "start_date": "2024-01-15", "renew_period": "3",
+        })
+        self.assertEqual(self.ledger_amounts(), self.expected(date.today()))
+        # Senza cambi di durata o data di inizio non si tocca il registro
+        with CaptureQueriesContext(connection) as queries:
+            Subscription.objects.get(pk=self.monthly.pk).save()
+        self.assertFalse(any("charge" in query["sql"] for query in queries))
+
+    @override_settings(BILLING_BACKEND="ledger")
+    def test_dashboard_reads_ledger(self):
+        call_command("run_billing", "--date", date.today().isoformat(), stdout=io.StringIO())
+        expected = self.expected(date.today())
+        for sub_data in build_subscriptions_data():
+            for row in sub_data["user_payments"]:
+                detail = SubscriptionDetail.objects.get(user=row["user"], subscription=sub_data["subscription"])
+                self.assertEqual((row["months_unpaid"], row["amount_to_pay"]), expected[detail.pk])
+
+
+class PaymentImportTests(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser("admin", password="password")
+        self.member = User.objects.create_user("member", password="password")
+        self.subscription = create_subscription(self.admin, "Spotify", [self.member])
+
+    def csv(self, *rows):
+        return io.StringIO("username,subscription,amount,date\n" + "".join(f"{row}\n" for row in rows))
+
+    def test_import_allocates_payments_like_register_payment(self):
+        rejects = []
+        # Quota per membro: 17.99 / 2 = 8.99
+        result = import_payments(self.csv(
+            "member,Spotify,9.00,2024-03-15",
+            f"member,{self.subscription.pk},9.00,2024-02-15",
+            "admin,Spotify,5.00,2023-01-01",
+            "ghost,Spotify,9.00,2024-03-15",
+            "member,Netflix,9.00,2024-03-15",
+            "member,Spotify,abc,2024-03-15",
+            "member,Spotify,9.00,15/03/2024",
+        ), batch_size=2, on_reject=rejects.append, today=date(2024, 6, 20))
+        self.assertEqual((result.created, result.rejected, result.updated_details), (3, 4, 2))
+        self.assertEqual([row["line"] for row in rejects], [5, 6, 7, 8])
+        self.assertEqual(
+            sorted(Payment.objects.values_list("subscription_detail__user__username", "periods_covered")),
+            [("admin", 0), ("member", 1), ("member", 1)],
+        )
+        member_detail = SubscriptionDetail.objects.get(user=self.member)
+        self.assertEqual((member_detail.last_payment_date, member_detail.credit), (date(2024, 3, 15), Decimal("0.02")))
+        # Meno di una quota: la data non avanza, l'importo resta come credito
+        admin_detail = SubscriptionDetail.objects.get(user=self.admin)
+        self.assertEqual((admin_detail.last_payment_date, admin_detail.credit), (date(2024, 1, 15), Decimal("5.00")))
+
+    def test_import_matches_register_payment(self):
+        import_payments(self.csv("member,Spotify,20.00,2024-03-15", "member,Spotify,7.50,2024-04-15"))
+        imported = SubscriptionDetail.objects.get(user=self.member)
+        for amount in ("20.00", "7.50"):
+            payments.register_payment(SubscriptionDetail.objects.get(user=self.admin).pk, amount, "2024-03-15")
+        registered = SubscriptionDetail.objects.get(user=self.admin)
+        self.assertEqual(
+            (imported.last_payment_date, imported.credit), (registered.last_payment_date, registered.credit),
+        )
+
+    def test_rejects_non_finite_amounts(self):
+        rejects = []
+        result = import_payments(
+            self.csv(*(f"member,Spotify,{amount},2024-03-15" for amount in ("nan", "inf", "-inf", "0", "-1"))),
+            on_reject=rejects.append,
+        )
+        self.assertEqual((result.created, result.rejected), (0, 5))
+        self.assertEqual({row["reason"] for row in rejects}, {"invalid amount"})
+
+    def test_query_count_does_not_depend_on_rows(self):
+        rows = [f"member,Spotify,1.00,2024-02-{day:02d}" for day in range(1, 29)]
+        with CaptureQueriesContext(connection) as few:
+            import_payments(self.csv(*rows[:2]), batch_size=100)
+        with CaptureQueriesContext(connection) as many:
+            import_payments(self.csv(*rows), batch_size=100)
+        self.assertEqual(len(many), len(few))
+
+    @unittest.skipUnless(connection.features.has_select_for_update, "SELECT ... FOR UPDATE not supported")
+    def test_locks_only_members_in_the_file(self):
+        create_subscription(self.admin, "Netflix", [User.objects.create_user("other", password="password")])
+        with CaptureQueriesContext(connection) as queries:
+            import_payments(self.csv("member,Spotify,9.00,2024-03-15", "admin,Spotify,9.00,2024-03-15"))
+        (lock,) = [query["sql"] for query in queries if "FOR UPDATE" in query["sql"]]
+        self.assertIn(" IN (", lock)
+        self.assertIn("ORDER BY", lock)
+        locked = SubscriptionDetail.objects.filter(subscription=self.subscription).values_list("pk", flat=True)
+        self.assertRegex(lock, r"IN \({}, {}\)".format(*sorted(locked)))
+
+    def test_missing_columns(self):
+        with self.assertRaises(ValueError):
+            import_payments(io.StringIO("username,amount\nmember,9\n"))
+
+    def test_management_command(self):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        path = self.make_file("member,Spotify,9.00,2024-03-15", "ghost,Spotify,9.00,2024-03-15")
+        call_command("import_payments", path, stdout=stdout, stderr=stderr)
+        self.assertIn("1 payments imported, 1 rows rejected", stdout.getvalue())
+        self.assertIn("ghost", stderr.getvalue())
+
+    def make_file(self, *rows):
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False) as f:
+            f.write(self.csv(*rows).getvalue())
+        self.addCleanup(os.remove, f.name)
+        return f.name
+
+    def test_admin_upload(self):
+        self.client.force_login(self.admin)
+        upload = SimpleUploadedFile("payments.csv", self.csv("member,Spotify,9.00,2024-03-15").getvalue().encode())
+        response = self.client.post(reverse("admin:spotifyfamily_payment_import"), {"csv_file": upload})
+        self.assertRedirects(response, reverse("admin:spotifyfamily_payment_changelist"))
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_admin_upload_shows_rejects(self):
+        self.client.force_login(self.admin)
+        upload = SimpleUploadedFile("payments.csv", self.csv("ghost,Spotify,9.00,2024-03-15").getvalue().encode())
+        response = self.client.post(reverse("admin:spotifyfamily_payment_import"), {"csv_file": upload})
+        self.assertContains(response, "user is not a member of the subscription")
+
+
+class ApiTests(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create_user("staff", password="password", is_staff=True)
+        self.members = [User.objects.create_user(f"member{i}", password="password") for i in range(4)]
+        self.subscriptions = [
+            create_subscription(self.staff, f"Spotify {i}", self.members[:i], start_date=date(2024, 1, 1 + i))
+            for i in range(5)
+        ]
+        self.client.force_login(self.staff)
+
+    def fetch_all(self, name, **params):
+        results, pages, cursor = [], 0, None
+        while True:
+            query = {**params, **({"cursor": cursor} if cursor else {})}
+            response = self.client.get(reverse(name), query)
+            self.assertEqual(response.status_code, 200)
+            payload = response.json()
+            results += payload["results"]
+            pages += 1
+            cursor = payload["next_cursor"]
+            if not cursor:
+                return results, pages
+
+    def test_subscriptions_keyset_pagination(self):
+        results, pages = self.fetch_all("api_subscriptions", limit=2)
+        self.assertEqual(pages, 3)
+        self.assertEqual([row["id"] for row in results], [s.pk for s in self.subscriptions])
+        self.assertEqual(results[0]["admin_username"], "staff")
+        self.assertEqual(results[0]["start_date"], "2024-01-01")
+
+    def test_field_selection(self):
+        response = self.client.get(reverse("api_members"), {"fields": "username,last_payment_date", "limit": 1})
+        self.assertEqual(response.json()["results"], [{"username": "staff", "last_payment_date": "2024-01-01"}])
+        response = self.client.get(reverse("api_members"), {"fields": "password"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_prices_filtered_by_subscription(self):
+        results, _ = self.fetch_all("api_prices", subscription=self.subscriptions[2].pk)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]["valid_to"], None)
+
+    def test_balances_match_model(self):
+        results, _ = self.fetch_all("api_balances", limit=3)
+        details = {detail.pk: detail for detail in SubscriptionDetail.objects.all()}
+        self.assertEqual(len(results), len(details))
+        for row in results:
+            self.assertEqual(row["months_unpaid"], details[row["id"]].get_months_unpaid())
+            self.assertEqual(row["amount_to_pay"], details[row["id"]].get_amount_to_pay())
+
+    def test_page_cost_does_not_depend_on_position(self):
+        first = self.client.get(reverse("api_balances"), {"limit": 2}).json()
+        with CaptureQueriesContext(connection) as first_page:
+            self.client.get(reverse("api_balances"), {"limit": 2})
+        with CaptureQueriesContext(connection) as later_page:
+            self.client.get(reverse("api_balances"), {"limit": 2, "cursor": first["next_cursor"]})
+        self.assertEqual(len(first_page), len(later_page))
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse("api_subscriptions"), {"cursor": "not-a-cursor"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_requires_staff(self):
+        self.client.force_login(self.members[0])
+        self.assertEqual(self.client.get(reverse("api_subscriptions")).status_code, 403)
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse("api_subscriptions")).status_code, 401)
+
+
+class ForecastTests(TestCase):
+    today = date(2025, 1, 31)
+
+    def setUp(self):
+        synthetic.generate(6, 3, 3, 2, seed=3, today=self.today)
+        # Scadenze a fine mese e negli anni bisestili
+        subscription = Subscription.objects.order_by("pk").first()
+        for i, last_payment_date in enumerate([date(2024, 1, 31), date(2024, 2, 29), date(2023, 8, 30)]):
+            user = User.objects.create(username=f"edge{i}")
+            SubscriptionDetail.objects.create(subscription=subscription, user=user, last_payment_date=last_payment_date)
+
+    def test_matches_amount_to_pay_at_each_horizon(self):
+        result = forecast.forecast((1, 3, 12), today=self.today)
+        details = SubscriptionDetail.objects.select_related("subscription")
+        self.assertEqual(len(result["members"]), details.count())
+        rows = {row["id"]: row for row in result["members"]}
+        for detail in details:
+            subscription = detail.subscription
+            schedule = billing.PriceSchedule(subscription.prices.all())
+            user_count = subscription.users.count()
+            row = rows[detail.pk]
+            self.assertEqual(row["outstanding"], billing.amount_to_pay(
+                detail.last_payment_date, subscription.renew_period, schedule, user_count, self.today,
+            ))
+            for horizon, day in result["horizons"].items():
+                self.assertEqual(row["due"][horizon], billing.amount_to_pay(
+                    detail.last_payment_date, subscription.renew_period, schedule, user_count, day,
+                ))
+
+    def test_totals(self):
+        result = forecast.forecast(today=self.today)
+        self.assertEqual(list(result["horizons"]), ["3", "6", "12"])
+        for horizon in result["horizons"]:
+            members = round(sum(row["due"][horizon] for row in result["members"]), 2)
+            subscriptions = round(sum(row["due"][horizon] for row in result["subscriptions"]), 2)
+            self.assertAlmostEqual(members, result["total"]["due"][horizon], places=6)
+            self.assertAlmostEqual(subscriptions, result["total"]["due"][horizon], places=6)
+
+    def test_overlapping_history_uses_schedule_rules(self):
+        legacy = [
+            (1, 1, 10.0, date(2024, 1, 1), date(2024, 12, 31)),
+            (2, 1, 20.0, date(2024, 3, 1), date(2024, 3, 31)),
+        ]
+        start = np.array([date(2024, 2, 1).toordinal(), date(2024, 5, 1).toordinal()])
+        end = np.array([date(2024, 3, 1).toordinal(), date(2024, 6, 1).toordinal()])
+        shares = forecast._period_shares(legacy, np.array([1, 1]), start, end, {1: 2})
+        self.assertEqual(shares.tolist(), [10.0, 5.0])
+
+    def test_endpoint(self):
+        staff = User.objects.create_user("staff", password="password", is_staff=True)
+        self.client.force_login(staff)
+        subscription = Subscription.objects.order_by("pk").first()
+        response = self.client.get(reverse("api_forecast"), {"horizons": "6", "subscription": subscription.pk})
+        self.assertEqual(response.status_code, 200)
+        payload = response.json()
+        self.assertEqual([row["subscription_id"] for row in payload["subscriptions"]], [subscription.pk])
+        self.assertEqual(set(payload["total"]["due"]), {"6"})
+        self.assertEqual(self.client.get(reverse("api_forecast"), {"horizons": "x"}).status_code, 400)
+
+
+class PaymentExportTests(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_user("admin", password="password")
+        self.other = User.objects.create_user("other", password="password")
+        self.subscription = create_subscription(self.admin, "Spotify", [self.other])
+        self.foreign = create_subscription(self.other, "Netflix")
+        for detail in SubscriptionDetail.objects.all():
+            for month in range(1, 4):
+                Payment.objects.create(subscription_detail=detail, amount=9.5, payment_date=date(2024, month, 10))
+        self.client.force_login(self.admin)
+
+    def export(self, **params):
+        response = self.client.get(reverse("export_payments"), params)
+        self.assertEqual(response.status_code, 200)
+        return b"".join(response.streaming_content).decode()
+
+    def test_csv_export_only_includes_administered_subscriptions(self):
+        lines = self.export().splitlines()
+        self.assertEqual(lines[0], "id,payment_date,amount,user_id,username,subscription_id,subscription,created_at")
+        self.assertEqual(len(lines), 1 + 6)
+        self.assertTrue(all(",Spotify," in line for line in lines[1:]))
+
+    def test_jsonl_export_with_filters(self):
+        rows = [json.loads(line) for line in self.export(
+            format="jsonl", user=self.other.pk, date_from="2024-02-01", date_to="2024-02-28",
+        ).splitlines()]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["username"], "other")
+        self.assertEqual(rows[0]["payment_date"], "2024-02-10")
+
+    def test_export_does_not_query_per_row(self):
+        # Una query per l'archivio e una per i pagamenti correnti
+        with self.assertNumQueries(2):
+            list(exports.export_lines(exports.export_querysets(), "csv", chunk_size=2))
+
+    def test_export_includes_archived_payments(self):
+        for payment in Payment.objects.filter(payment_date__month=1):
+            ArchivedPayment.objects.create(
+                id=payment.pk, subscription_detail_id=payment.subscription_detail_id, amount=payment.amount,
+                payment_date=payment.payment_date,
+            )
+            payment.delete()
+        rows = [json.loads(line) for line in self.export(format="jsonl").splitlines()]
+        self.assertEqual(len(rows), 6)
+        self.assertEqual({row["subscription"] for row in rows}, {"Spotify"})
+        archived = [row for row in rows if row["payment_date"] == "2024-01-10"]
+        self.assertEqual(len(archived), 2)
+        self.assertTrue(all(row["created_at"] is None for row in archived))
+        self.assertEqual(len(self.export(date_from="2024-01-01", date_to="2024-01-31").splitlines()), 1 + 2)
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.client.get(reverse("export_payments"), {"format": "xml"}).status_code, 400)
+        self.assertEqual(self.client.get(reverse("export_payments"), {"date_from": "yesterday"}).status_code, 400)
+
+    def test_management_command(self):
+        stdout = io.StringIO()
+        call_command("export_payments", "--format", "jsonl", "--subscription", str(self.foreign.pk), stdout=stdout)
+        self.assertEqual(len(stdout.getvalue().splitlines()), 3)
+
+
+class SyntheticDataTests(TestCase):
+    def test_generate_is_reproducible(self):
+        counts = synthetic.generate(3, 4, 2, 2, seed=7, today=date(2025, 6, 1))
+        self.assertEqual(counts["users"], 12)
+        self.assertEqual(counts["prices"], 9)
+        self.assertEqual(Payment.objects.count(), counts["payments"])
+        first = list(SubscriptionDetail.objects.order_by("pk").values_list("last_payment_date", flat=True))
+        Subscription.objects.all().delete()
+        User.objects.all().delete()
+        synthetic.generate(3, 4, 2, 2, seed=7, today=date(2025, 6, 1))
+        self.assertEqual(
+            list(SubscriptionDetail.objects.order_by("pk").values_list("last_payment_date", flat=True)), first,
+        )
+
+    def test_price_history_does_not_overlap(self):
+        synthetic.generate(2, 2, 4, 3, seed=1)
+        for subscription in Subscription.objects.all():
+            prices = list(subscription.prices.order_by("valid_from"))
+            for previous, current in zip(prices, prices[1:]):
+                self.assertEqual(previous.valid_to, current.valid_from)
+            self.assertIsNone(prices[-1].valid_to)
+
+
+class BenchmarkTests(TestCase):
+    def test_benchmark_command_and_regressions(self):
+        stdout = io.StringIO()
+        call_command("benchmark", "--sizes", "2,4", "--repeat", "1", "--years", "1", stdout=stdout)
+        results = json.loads(stdout.getvalue())
+        self.assertEqual(set(results["sizes"]), {"2", "4"})
+        self.assertEqual(results["sizes"]["2"]["index"]["queries"], results["sizes"]["4"]["index"]["queries"])
+        self.assertFalse(Subscription.objects.exists())
+
+        baseline = json.loads(json.dumps(results))
+        baseline["sizes"]["2"]["index"]["queries"] -= 1
+        baseline["sizes"]["4"]["get_amount_to_pay"]["median_ms"] /= 10
+        self.assertEqual(len(benchmarks.regressions(results, baseline)), 2)
+        self.assertEqual(benchmarks.regressions(results, results), [])
+
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump(baseline, f)
+        self.addCleanup(os.remove, f.name)
+        with self.assertRaises(CommandError):
+            call_command("benchmark", "--sizes", "2", "--repeat", "1", "--years", "1",
+                         "--baseline", f.name, "--latency-tolerance", "1000", stdout=io.StringIO())
+
+
+PG_PLAN = """
+Sort  (cost=1645.79..1649.21 rows=1371 width=36) (actual time=2.793..2.875 rows=1315 loops=1)
+  Sort Key: id
+  ->  Bitmap Heap Scan on spotifyfamily_payment  (cost=18.92..1574.35 rows=1371 width=36)
+        ->  Bitmap Index Scan on payment_date_idx  (cost=0.00..18.58 rows=1371 width=0)
+Hash Join  (cost=66.00..342.00 rows=2000 width=166)
+  ->  Seq Scan on spotifyfamily_user  (cost=0.00..226.00 rows=8000 width=115) (actual time=0.004..1.151 rows=400 loops=20)
+  ->  Seq Scan on spotifyfamily_subscription  (cost=0.00..41.00 rows=200 width=51)
+"""
+
+
+class QueryPlanTests(TestCase):
+    def test_postgresql_findings(self):
+        findings = queryplans.postgresql_findings("q", PG_PLAN, 1000)
+        self.assertEqual([(f.node, f.table, f.rows) for f in findings], [
+            ("Sort", "", 1315),
+            ("Seq Scan", "spotifyfamily_user", 8000),
+        ])
+        # La home legge per costruzione tutte le sottoscrizioni e i loro amministratori
+        findings = queryplans.postgresql_findings("dashboard_subscriptions", PG_PLAN, 100, "spotifyfamily_subscription")
+        self.assertEqual(findings, [])
+
+    @unittest.skipUnless(connection.vendor == "sqlite", "plan shapes checked on SQLite")
+    def test_hot_queries_use_indexes(self):
+        synthetic.generate(5, 3, 2, 1, seed=1)
+        results = queryplans.audit(threshold=0)
+        self.assertIn("one_open_price_per_subscription", results["current_price"][0])
+        self.assertIn("detail_last_payment_idx", results["overdue_members"][0])
+        self.assertIn("detail_subscription_paid_idx", results["members_by_last_payment"][0])
+        self.assertEqual(results["members_by_last_payment"][1], [])
+        # Pagina dell'API: la scansione si ferma al LIMIT
+        self.assertEqual(results["api_members_page"][1][0].rows, 15)
+
+    def test_command(self):
+        synthetic.generate(3, 2, 1, 1, seed=1)
+        stdout = io.StringIO()
+        call_command("explain_hot_queries", "--plans", stdout=stdout)
+        self.assertIn("current_price: ok", stdout.getvalue())
+        with self.assertRaises(CommandError):
+            call_command("explain_hot_queries", "--fail", "--threshold", "-1", stdout=io.StringIO())
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.metrics_dir)
+        override = override_settings(METRICS_DIR=self.metrics_dir)
+        override.enable()
+        self.addCleanup(override.disable)
+        metrics.registry.views.clear()
+        metrics.registry.counters.clear()
+
+        self.staff = User.objects.create_user("staff", password="password", is_staff=True)
+        create_subscription(self.staff, "Spotify")
+        self.client.force_login(self.staff)
+
+    def test_records_requests_and_queries_per_view(self):
+        for _ in range(3):
+            self.client.get(reverse("home"))
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('spotifyfamily_requests_total{view="home",status="200"} 3', body)
+        self.assertIn('spotifyfamily_request_duration_seconds_count{view="home"} 3', body)
+        self.assertIn('spotifyfamily_db_queries_bucket{view="home",le="+Inf"} 3', body)
+        self.assertIn('spotifyfamily_db_duration_seconds_total{view="home"}', body)
+        self.assertIn("spotifyfamily_fragment_cache_misses_total", body)
+        queries = metrics.registry.views["home"]["queries_sum"]
+        self.assertGreaterEqual(queries, 3)
+
+    def test_aggregates_snapshots_of_other_workers(self):
+        self.client.get(reverse("home"))
+        other = metrics.Registry()
+        other.process_id = f"{os.getpid()}-1"
+        other.observe("home", 200, 0.2, 4, 0.01)
+        other.inc("custom")
+        other.flush(force=True)
+        view_stats, counters = metrics.collect()
+        self.assertEqual(view_stats["home"]["count"], 2)
+        self.assertEqual(view_stats["home"]["requests"]["200"], 2)
+        self.assertEqual(counters["custom"], 1)
+
+    def test_snapshots_of_dead_workers_are_merged(self):
+        dead_pid = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True).stdout
+        for started in (1, 2):
+            dead = metrics.Registry()
+            dead.process_id = f"{int(dead_pid)}-{started}"
+            dead.observe("home", 200, 0.2, 4, 0.01)
+            dead.inc("custom")
+            dead.flush(force=True)
+        for _ in range(2):
+            view_stats, counters = metrics.collect()
+            self.assertEqual(view_stats["home"]["count"], 2)
+            self.assertEqual(counters["custom"], 2)
+        self.assertEqual(
+            sorted(name for name in os.listdir(self.metrics_dir) if name.endswith(".json")),
+            [f"metrics-{metrics.registry.process_id}.json", metrics.RETIRED_NAME],
+        )
+
+    def test_staff_only(self):
+        self.client.force_login(User.objects.create_user("member", password="password"))
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 302)
+
+    async def test_counts_async_queries(self):
+        async def view(request):
+            [user async for user in User.objects.all()]
+            [subscription async for subscription in Subscription.objects.all()]
+            return HttpResponse()
+
+        response = await metrics.MetricsMiddleware(view)(AsyncRequestFactory().get("/"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(metrics.registry.views["unmatched"]["queries_sum"], 2)
+
+
+# Nei test la cache in memoria locale è condivisa: c'è un solo processo
+@override_settings(
+    AUTH_USER_CACHE_TIMEOUT=300, SESSION_ENGINE="django.contrib.sessions.backends.cached_db",
+)
+class AuthCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("admin", password="password")
+        create_subscription(self.user, "Spotify")
+        self.client.force_login(self.user)
+
+    def auth_queries(self, queries):
+        user_table = connection.ops.quote_name(User._meta.db_table)
+        return [
+            query["sql"] for query in queries
+            if Session._meta.db_table in query["sql"] or f"FROM {user_table} WHERE {user_table}." in query["sql"]
+        ]
+
+    def test_warm_request_does_no_session_or_user_query(self):
+        self.client.get(reverse("home"))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("home"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.wsgi_request.user, self.user)
+        self.assertEqual(self.auth_queries(queries), [])
+
+    def test_cold_cache_falls_back_to_database(self):
+        self.client.get(reverse("home"))
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("home"))
+        self.assertEqual(response.wsgi_request.user, self.user)
+        self.assertEqual(len(self.auth_queries(queries)), 2)
+
+    def test_user_edit_invalidates_cache(self):
+        self.client.get(reverse("home"))
+        self.user.first_name = "Mario"
+        self.user.save()
+        self.assertEqual(self.client.get(reverse("home")).wsgi_request.user.first_name, "Mario")
+
+    def test_password_change_logs_out_other_sessions(self):
+        self.client.get(reverse("home"))
+        self.user.set_password("another password")
+        self.user.save()
+        response = self.client.get(reverse("home"))
+        self.assertFalse(response.wsgi_request.user.is_authenticated)
+
+    def test_logout_clears_cached_user(self):
+        self.client.get(reverse("home"))
+        self.assertIsNotNone(cache.get(authcache.USER_KEY.format(self.user.pk), version=settings.AUTH_USER_CACHE_VERSION))
+        self.client.get(reverse("logout"))
+        self.assertIsNone(cache.get(authcache.USER_KEY.format(self.user.pk), version=settings.AUTH_USER_CACHE_VERSION))
+
+    @override_settings(AUTH_USER_CACHE_TIMEOUT=0)
+    def test_disabled_cache_reads_database(self):
+        backend = authcache.CachedModelBackend()
+        backend.get_user(self.user.pk)
+        with self.assertNumQueries(1):
+            backend.get_user(self.user.pk)
+
+    async def test_async_lookup_uses_cache(self):
+        backend = authcache.CachedModelBackend()
+        self.assertEqual(await backend.aget_user(self.user.pk), self.user)
+        with unittest.mock.patch.object(ModelBackend, "aget_user", side_effect=AssertionError):
+            self.assertEqual(await backend.aget_user(self.user.pk), self.user)
+
+    def test_sessions_and_users_cached_only_with_shared_cache(self):
+        path = os.path.join(settings.BASE_DIR, "spotifyfamily-project", "settings.py")
+        environment = {"AUTH_USER_CACHE_TIMEOUT": "300"}
+        for backend, shared in (
+            ("django.core.cache.backends.locmem.LocMemCache", False),
+            ("django.core.cache.backends.redis.RedisCache", True),
+        ):
+            with unittest.mock.patch.dict(os.environ, environment, CACHE_BACKEND=backend):
+                os.environ.pop("SESSION_ENGINE", None)
+                values = runpy.run_path(path)
+            self.assertEqual(values["SHARED_CACHE"], shared)
+            self.assertEqual(values["AUTH_USER_CACHE_TIMEOUT"], 300 if shared else 0)
+            self.assertEqual(values["SESSION_ENGINE"].rpartition(".")[2], "cached_db" if shared else "db")
+
+
+@override_settings(
+    LOGIN_THROTTLE_IP_BURST=4, LOGIN_THROTTLE_IP_PER_MINUTE=1,
+    LOGIN_THROTTLE_USERNAME_BURST=2, LOGIN_THROTTLE_USERNAME_PER_MINUTE=1,
+)
+class LoginThrottleTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.registry.counters.clear()
+        self.user = User.objects.create_user("admin", password="password")
+        self.hashes = unittest.mock.patch(
+            "django.contrib.auth.base_user.check_password", wraps=django_check_password,
+        ).start()
+        self.addCleanup(unittest.mock.patch.stopall)
+
+    def login(self, username="admin", password="password", ip="10.0.0.1"):
+        return self.client.post(reverse("login"), {"username": username, "password": password}, REMOTE_ADDR=ip)
+
+    def test_successful_login_hashes_once(self):
+        response = self.login()
+        self.assertRedirects(response, reverse("home"), fetch_redirect_response=False)
+        self.assertEqual(self.hashes.call_count, 1)
+
+    def test_username_throttled_before_hashing(self):
+        for _ in range(2):
+            self.assertEqual(self.login(password="wrong").status_code, 200)
+        self.hashes.reset_mock()
+        # Anche da un altro IP e con la password giusta
+        response = self.login(ip="10.0.0.2")
+        self.assertEqual(response.status_code, 429)
+        # Finestra di 120 secondi (2 tentativi, 1 al minuto)
+        self.assertIn(int(response["Retry-After"]), range(1, 121))
+        self.hashes.assert_not_called()
+        self.assertEqual(metrics.registry.counters["login_throttled"], 1)
+        self.assertEqual(metrics.registry.counters["login_throttled_username"], 1)
+
+    def test_ip_throttled_across_usernames(self):
+        for i in range(4):
+            self.assertEqual(self.login(username=f"user{i}").status_code, 200)
+        self.assertEqual(self.login().status_code, 429)
+        self.assertEqual(self.login(ip="10.0.0.2").status_code, 302)
+        self.assertEqual(metrics.registry.counters["login_throttled_ip"], 1)
+        self.assertEqual(metrics.registry.counters["login_attempts"], 6)
+
+    def test_window_resets(self):
+        # 2 tentativi ogni 20 secondi (6 al minuto)
+        self.assertEqual(throttle.take("test", "key", 2, 6, now=0), 0)
+        self.assertEqual(throttle.take("test", "key", 2, 6, now=0), 0)
+        self.assertAlmostEqual(throttle.take("test", "key", 2, 6, now=1), 19)
+        self.assertEqual(throttle.take("test", "key", 2, 6, now=20), 0)
+        self.assertEqual(throttle.take("test", "key", 2, 6, now=21), 0)
+        self.assertGreater(throttle.take("test", "key", 2, 6, now=21), 0)
+        # Una finestra a cui non si chiede niente non accumula tentativi
+        self.assertEqual(throttle.take("test", "key", 2, 6, now=1000), 0)
+        self.assertEqual(throttle.take("test", "key", 2, 6, now=1000), 0)
+        self.assertGreater(throttle.take("test", "key", 2, 6, now=1000), 0)
+
+    def test_concurrent_attempts_are_all_counted(self):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            waits = list(executor.map(lambda _: throttle.take("test", "key", 5, 1, now=0), range(40)))
+        self.assertEqual(waits.count(0), 5)
+
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profile_dir)
+        override = override_settings(PROFILE_DIR=self.profile_dir, PROFILE_RETENTION=2, PROFILE_SAMPLE_INTERVAL=0.0005)
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.staff = User.objects.create_user("staff", password="password", is_staff=True)
+        create_subscription(self.staff, "Spotify", [User.objects.create_user("member", password="password")])
+        self.client.force_login(self.staff)
+
+    def download(self, profile_id, extension):
+        response = self.client.get(reverse("profile_download", args=[profile_id, extension]))
+        self.assertEqual(response.status_code, 200)
+        return b"".join(response.streaming_content)
+
+    def test_staff_request_is_profiled(self):
+        response = self.client.get(reverse("home") + "?profile")
+        self.assertEqual(response.status_code, 200)
+        profile_id = response["X-Profile-Id"]
+
+        path = os.path.join(self.profile_dir, "download.prof")
+        with open(path, "wb") as f:
+            f.write(self.download(profile_id, "prof"))
+        functions = {name for _, _, name in pstats.Stats(path).stats}
+        self.assertIn("build_subscriptions_data", functions)
+
+        for line in self.download(profile_id, "collapsed").decode().splitlines():
+            self.assertRegex(line, r"^\S.* \d+$")
+
+        meta = json.loads(self.download(profile_id, "json"))
+        self.assertEqual((meta["path"], meta["user"], meta["status"]), ("/?profile", "staff", 200))
+        self.assertEqual(meta["query_count"], len(meta["queries"]))
+        self.assertGreater(meta["query_count"], 0)
+        origins = [line for query in meta["queries"] for line in query["origin"]]
+        self.assertTrue(any(line.startswith("spotifyfamily/dashboard.py:") for line in origins))
+
+    def test_header_switch_and_listing(self):
+        response = self.client.get(reverse("home"), headers={"x-profile": "1"})
+        listing = self.client.get(reverse("profiles")).json()["profiles"]
+        self.assertEqual([profile["id"] for profile in listing], [response["X-Profile-Id"]])
+        self.assertNotIn("queries", listing[0])
+
+    def test_only_staff_and_only_on_request(self):
+        self.assertNotIn("X-Profile-Id", self.client.get(reverse("home")))
+        self.client.force_login(User.objects.get(username="member"))
+        self.assertNotIn("X-Profile-Id", self.client.get(reverse("home") + "?profile"))
+        self.assertEqual(self.client.get(reverse("profiles")).status_code, 302)
+        self.assertEqual(os.listdir(self.profile_dir), [])
+
+    def test_retention(self):
+        ids = [self.client.get(reverse("home") + "?profile")["X-Profile-Id"] for _ in range(3)]
+        kept = {name.partition(".")[0] for name in os.listdir(self.profile_dir)}
+        self.assertEqual(kept, set(sorted(ids)[1:]))
+
+    def test_download_rejects_unknown_profiles(self):
+        self.assertEqual(self.client.get(reverse("profile_download", args=["settings", "py"])).status_code, 404)
+        self.assertEqual(
+            self.client.get(reverse("profile_download", args=["20240101-000000-00000000", "prof"])).status_code, 404,
+        )
+
+    async def test_async_request_is_profiled(self):
+        await self.async_client.aforce_login(self.staff)
+        response = await self.async_client.get(reverse("home") + "?profile")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(os.path.exists(os.path.join(self.profile_dir, response["X-Profile-Id"] + ".json")))
+
+
+@override_settings(LOGIN_THROTTLE_IP_BURST=0, LOGIN_THROTTLE_USERNAME_BURST=0)
+class LoadHarnessTests(LiveServerTestCase):
+    def setUp(self):
+        cache.clear()
+        synthetic.generate(3, 3, 1, 1, password="password", prefix="loadtest")
+
+    def test_mixed_scenario_against_live_server(self):
+        households = load.households("loadtest")
+        self.assertEqual(len(households), 3)
+        payments_before = Payment.objects.count()
+        # Con SQLite in memoria i thread del live server condividono una sola
+        # connessione: richieste concorrenti si rompono le transazioni a vicenda
+        clients = 1 if connection.vendor == "sqlite" else 3
+        results = load.run_mix(
+            self.live_server_url, households, "password", clients=clients, duration=1,
+            mix={"login": 1, "dashboard": 1, "edit": 1, "payment": 3},
+        )
+        self.assertGreaterEqual(results["login"]["requests"], clients)
+        self.assertEqual(results["total"]["requests"], sum(
+            results[name]["requests"] for name in load.ACTIONS if name in results
+        ))
+        # Solo i pagamenti riusciti per l'harness sono nel database
+        payment = results.get("payment", {"requests": 0, "errors": 0})
+        self.assertEqual(Payment.objects.count() - payments_before, payment["requests"] - payment["errors"])
+        self.assertEqual(results["total"]["errors"], 0)
+        for key in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms", "error_rate"):
+            self.assertIn(key, results["total"])
+
+    def test_failed_payment_counts_as_error(self):
+        # Il membro non è nella sottoscrizione: la vista rimanda alla home con un errore
+        outsider = User.objects.create_user("outsider", password="password")
+        households = [household._replace(member_ids=[outsider.pk]) for household in load.households("loadtest")]
+        payments_before = Payment.objects.count()
+        results = load.run_mix(self.live_server_url, households, "password", clients=1, duration=0.5, mix={"payment": 1})
+        self.assertGreater(results["payment"]["requests"], 0)
+        self.assertEqual(results["payment"]["errors"], results["payment"]["requests"])
+        self.assertEqual(Payment.objects.count(), payments_before)
+
+    def test_wrong_password_counts_as_error(self):
+        results = load.run_mix(self.live_server_url, load.households("loadtest"), "wrong", clients=1, duration=0)
+        self.assertEqual((results["login"]["errors"], results["total"]["error_rate"]), (1, 1.0))
+
+    def test_parse_mix(self):
+        self.assertEqual(parse_mix("dashboard=3, payment=1"), {"dashboard": 3.0, "payment": 1.0})
+        for value in ("shopping=1", "dashboard=x", "dashboard=0"):
+            with self.assertRaises(CommandError):
+                parse_mix(value)
+
+    def test_default_database_is_temporary(self):
+        with unittest.mock.patch(
+            "spotifyfamily.management.commands.loadtest.Command._rerun", autospec=True,
+        ) as rerun:
+            call_command("loadtest", "--duration", "0")
+        options = rerun.call_args.args[1]
+        self.assertEqual(options["database_engine"], "sqlite3")
+        self.assertTrue(options["database_name"].startswith(tempfile.gettempdir()))
+        self.assertFalse(os.path.exists(os.path.dirname(options["database_name"])))
+        with self.assertRaises(CommandError):
+            call_command("loadtest", "--database-engine", "postgresql")
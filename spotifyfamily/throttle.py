@@ -0,0 +1,72 @@
+"""
+Limite ai tentativi di login (contatori a finestra fissa nella cache di Django).
+
+Ogni tentativo incrementa il contatore del suo IP e quello dello username
+nella finestra corrente; una finestra dura il tempo in cui ``*_PER_MINUTE``
+tentativi al minuto arrivano a ``*_BURST``, quindi il ritmo medio concesso è
+``*_PER_MINUTE``. A cavallo di due finestre passano al massimo ``2 * *_BURST``
+tentativi. Il controllo avviene prima di calcolare l'hash della password,
+quindi un tentativo respinto non costa CPU al worker.
+
+I contatori usano ``cache.add`` e ``cache.incr``, atomici con Redis e
+memcached. Con la cache in memoria locale ogni worker ha i suoi contatori:
+i limiti valgono per worker (vedi ``settings.py``).
+"""
+import hashlib
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics
+
+COUNTER_KEY = "login-throttle:{}:{}:{}"
+
+
+def take(scope, identifier, burst, per_minute, now=None):
+    """
+    Conta un tentativo; ritorna 0 se è nel limite, altrimenti i secondi
+    all'inizio della prossima finestra.
+    """
+    if burst <= 0 or per_minute <= 0:
+        return 0
+    now = time.time() if now is None else now
+    digest = hashlib.blake2b(str(identifier).encode(), digest_size=16).hexdigest()
+    length = burst * 60 / per_minute
+    window = math.floor(now / length)
+    key = COUNTER_KEY.format(scope, digest, window)
+    timeout = math.ceil(length) + 1
+    if cache.add(key, 1, timeout=timeout):
+        count = 1
+    else:
+        try:
+            count = cache.incr(key)
+        except ValueError:
+            # Scaduto tra add e incr: il tentativo apre un nuovo contatore
+            cache.add(key, 1, timeout=timeout)
+            count = 1
+    if count <= burst:
+        return 0
+    return (window + 1) * length - now
+
+
+def check_login(request):
+    """
+    Registra un tentativo di login; ritorna 0 se può procedere, altrimenti i
+    secondi dopo cui riprovare.
+    """
+    metrics.inc("login_attempts")
+    limits = [
+        ("ip", request.META.get("REMOTE_ADDR", ""), settings.LOGIN_THROTTLE_IP_BURST,
+         settings.LOGIN_THROTTLE_IP_PER_MINUTE),
+        ("username", request.POST.get("username", "").strip().lower(), settings.LOGIN_THROTTLE_USERNAME_BURST,
+         settings.LOGIN_THROTTLE_USERNAME_PER_MINUTE),
+    ]
+    for scope, identifier, burst, per_minute in limits:
+        wait = take(scope, identifier, burst, per_minute)
+        if wait:
+            metrics.inc("login_throttled")
+            metrics.inc(f"login_throttled_{scope}")
+            return wait
+    return 0
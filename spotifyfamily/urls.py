@@ -2,7 +2,7 @@ from django.urls import path
 from django.views.generic.base import TemplateView
 
 
-from . import views
+from . import api, metrics, profiling, views
 from django.urls import include
 
 urlpatterns = [
@@ -13,5 +13,15 @@ urlpatterns = [
     path("subscription/<int:pk>/edit/", views.edit_subscription, name="edit_subscription"),
     path("subscription/<int:pk>/delete/", views.delete_subscription, name="delete_subscription"),
     path("subscription/<int:subscription_id>/user/<int:user_id>/payment/", views.register_payment, name="register_payment"),
+    path("users/search/", views.search_users, name="search_users"),
+    path("payments/export/", views.export_payments, name="export_payments"),
+    path("metrics/", metrics.metrics_view, name="metrics"),
+    path("profiles/", profiling.profiles_view, name="profiles"),
+    path("profiles/<str:profile_id>.<str:extension>", profiling.profile_download, name="profile_download"),
+    path("api/subscriptions/", api.subscriptions, name="api_subscriptions"),
+    path("api/members/", api.members, name="api_members"),
+    path("api/prices/", api.prices, name="api_prices"),
+    path("api/balances/", api.balances, name="api_balances"),
+    path("api/forecast/", api.forecast, name="api_forecast"),
     #path("accounts/", include("django.contrib.auth.urls")),
 ]
\ No newline at end of file
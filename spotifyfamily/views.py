@@ -1,17 +1,18 @@
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
 from django.template import loader
-from django.contrib.auth import authenticate, login
+from django.contrib.auth import login
 from django.shortcuts import redirect, render
-from .models import Subscription, SubscriptionDetail, SubscriptionPrice, User, Payment
+from .models import Subscription, SubscriptionDetail, SubscriptionPrice, User
+from . import billing, exports, fragments, memberships, payments, prices, throttle
+from .conditional import conditional_page, dashboard_validators, subscription_validators
+from .dashboard import build_subscriptions_data
 from django.contrib import messages
 from django.contrib.auth.forms import AuthenticationForm
 from django.contrib.auth import logout
 from django.views.decorators.http import require_POST
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import get_object_or_404
-from dateutil.relativedelta import relativedelta
-from datetime import date
-from django.db.models import Q, Prefetch
+import math
 
 # Create your views here.
 def calculate_amount_to_pay(detail, user_count, prices_cache):
@@ -19,73 +20,15 @@ def calculate_amount_to_pay(detail, user_count, prices_cache):
     Calcola l'importo totale da pagare considerando lo storico dei prezzi.
     Versione ottimizzata con cache dei prezzi.
     """
-    today = date.today()
-    next_payment_date = detail.last_payment_date + relativedelta(months=detail.subscription.renew_period)
-    
-    total_amount = 0.0
-    
-    # Per ogni periodo non pagato
-    while next_payment_date <= today:
-        period_start = next_payment_date - relativedelta(months=detail.subscription.renew_period)
-        
-        # Trova il prezzo valido per questo periodo dalla cache
-        period_price = None
-        for price_obj in prices_cache:
-            if price_obj.valid_from <= next_payment_date:
-                if price_obj.valid_to is None or price_obj.valid_to >= period_start:
-                    period_price = price_obj
-                    break
-        
-        if period_price:
-            price_per_user = round(period_price.price / user_count, 2) if user_count > 0 else period_price.price
-            total_amount += price_per_user
-        
-        next_payment_date += relativedelta(months=detail.subscription.renew_period)
-    
-    return round(total_amount, 2)
+    schedule = prices_cache if isinstance(prices_cache, billing.PriceSchedule) else billing.PriceSchedule(prices_cache)
+    return billing.amount_to_pay(
+        detail.last_payment_date, detail.subscription.renew_period, schedule, user_count, credit=detail.credit
+    )
 
+@conditional_page(dashboard_validators)
 def index(request):
-    # Usa prefetch_related per ottimizzare le query
-    subscriptions = Subscription.objects.prefetch_related(
-        Prefetch('prices', queryset=SubscriptionPrice.objects.order_by('-valid_from')),
-        Prefetch('users'),
-        'admin_user'
-    ).order_by("-start_date")
-    
-    # Prepara i dati con le informazioni di pagamento
-    subscriptions_with_payment = []
-    for subscription in subscriptions:
-        # Cache dei prezzi per questa subscription (già ordinati)
-        prices_cache = list(subscription.prices.all())
-        user_count = subscription.users.count()
-        
-        payment_info = {
-            'subscription': subscription,
-            'user_payments': []
-        }
-        
-        # Ottieni i dettagli di pagamento per ogni utente
-        details = SubscriptionDetail.objects.filter(subscription=subscription).select_related('user')
-        for detail in details:
-            today = date.today()
-            next_payment_date = detail.last_payment_date + relativedelta(months=subscription.renew_period)
-            
-            # Calcola periodi non pagati
-            months_count = 0
-            temp_date = next_payment_date
-            while temp_date <= today:
-                months_count += 1
-                temp_date += relativedelta(months=subscription.renew_period)
-            
-            payment_info['user_payments'].append({
-                'user': detail.user,
-                'last_paid_month': detail.last_payment_date.strftime("%B %Y"),
-                'amount_to_pay': calculate_amount_to_pay(detail, user_count, prices_cache),
-                'months_unpaid': months_count,
-                'is_overdue': months_count > 0
-            })
-        
-        subscriptions_with_payment.append(payment_info)
+    # Tutti i dati vengono caricati in blocco, senza query per sottoscrizione
+    subscriptions_with_payment = build_subscriptions_data()
     
     template = loader.get_template("home.html")
     context = {"subscriptions_data": subscriptions_with_payment}
@@ -123,6 +66,7 @@ def create_subscription(request):
     return render(request, "home.html")
 
 @login_required
+@conditional_page(subscription_validators)
 def edit_subscription(request, pk):
     subscription = get_object_or_404(Subscription, pk=pk)
     if request.user != subscription.admin_user:
@@ -148,19 +92,12 @@ def edit_subscription(request, pk):
             price = request.POST.get("new_price")
             valid_from = request.POST.get("price_valid_from")
             if price and valid_from:
-                # Chiudi il prezzo corrente se esiste
-                current_prices = subscription.prices.filter(valid_to__isnull=True)
-                for current_price in current_prices:
-                    current_price.valid_to = valid_from
-                    current_price.save()
-                
-                # Crea il nuovo prezzo
-                SubscriptionPrice.objects.create(
-                    subscription=subscription,
-                    price=price,
-                    valid_from=valid_from,
-                )
-                messages.success(request, "New price added successfully.")
+                # Chiude il prezzo corrente e crea il nuovo in un'unica transazione
+                try:
+                    prices.add_price(subscription, price, valid_from)
+                    messages.success(request, "New price added successfully.")
+                except ValueError as e:
+                    messages.error(request, str(e))
             else:
                 messages.error(request, "Price and valid from date are required.")
         
@@ -168,13 +105,26 @@ def edit_subscription(request, pk):
             price_id = request.POST.get("price_id")
             new_price_value = request.POST.get("current_price")
             if price_id and new_price_value:
-                price_obj = get_object_or_404(SubscriptionPrice, pk=price_id)
-                price_obj.price = new_price_value
-                price_obj.save()
+                price_obj = get_object_or_404(SubscriptionPrice, pk=price_id, subscription=subscription)
+                prices.update_price(price_obj, new_price_value)
                 messages.success(request, "Price updated successfully.")
             else:
                 messages.error(request, "Price value is required.")
         
+        elif action == "update_members":
+            # Aggiunte e rimozioni multiple in un'unica transazione
+            try:
+                added, removed = memberships.update_members(
+                    subscription,
+                    add=request.POST.getlist("add_user_ids"),
+                    remove=request.POST.getlist("remove_user_ids"),
+                )
+                messages.success(request, f"{added} user(s) added, {removed} user(s) removed.")
+            except ValueError:
+                messages.error(request, "Invalid user ID.")
+            # update_members aggiorna già la revisione se qualcosa è cambiato
+            return redirect("edit_subscription", pk=pk)
+
         elif action == "remove_user":
             user_id = request.POST.get("user_id")
             if user_id:
@@ -194,23 +144,36 @@ def edit_subscription(request, pk):
             else:
                 messages.error(request, "User ID is required.")
         
+        fragments.bump_revision(subscription.pk)
         return redirect("edit_subscription", pk=pk)
     
-    # GET request
-    all_users = User.objects.exclude(id=subscription.admin_user.id)
+    # GET request: gli utenti da aggiungere si cercano con search_users
     subscription_users = subscription.users.all()
     current_price = subscription.prices.filter(valid_to__isnull=True).first()
     price_history = subscription.prices.exclude(valid_to__isnull=True).order_by('-valid_from')
     
     context = {
         "subscription": subscription,
-        "all_users": all_users,
         "subscription_users": subscription_users,
         "current_price": current_price,
         "price_history": price_history,
     }
     return render(request, "edit_subscription.html", context)
 
+
+@login_required
+def search_users(request):
+    """Ricerca per prefisso dello username, per aggiungere membri a una sottoscrizione"""
+    prefix = request.GET.get("q", "").strip()
+    subscription_id = request.GET.get("subscription")
+    if subscription_id:
+        try:
+            subscription_id = int(subscription_id)
+        except ValueError:
+            return JsonResponse({"error": "Invalid subscription."}, status=400)
+    results = memberships.search_users(prefix, exclude_subscription=subscription_id or None)
+    return JsonResponse({"results": results})
+
 @login_required
 @require_POST
 def delete_subscription(request, pk):
@@ -219,22 +182,25 @@ def delete_subscription(request, pk):
         messages.error(request, "You are not authorized to delete this subscription.")
         return redirect("home")
     subscription.delete()
+    fragments.bump_revision(pk)
     messages.success(request, "Subscription deleted successfully.")
     return redirect("home")
 
 
 def login_view(request):
     if request.method == "POST":
+        # Prima di calcolare l'hash della password
+        wait = throttle.check_login(request)
+        if wait:
+            messages.error(request, "Too many login attempts. Please try again later.")
+            response = render(request, "registration/login.html", {"form": AuthenticationForm()}, status=429)
+            response["Retry-After"] = str(math.ceil(wait))
+            return response
         form = AuthenticationForm(request, data=request.POST)
         if form.is_valid():
-            username = form.cleaned_data.get("username")
-            password = form.cleaned_data.get("password")
-            user = authenticate(request, username=username, password=password)
-            if user is not None:
-                login(request, user)
-                return redirect("home")
-            else:
-                return render(request, "registration/login.html", {"form": form})
+            # is_valid() ha già autenticato l'utente: un solo hash per tentativo
+            login(request, form.get_user())
+            return redirect("home")
         else:
             for _, errors in form.errors.items():
                 for error in errors:
@@ -268,28 +234,51 @@ def register_payment(request, subscription_id, user_id):
         return redirect("home")
     
     try:
-        amount_paid = float(amount_paid)
-        
-        # Trova il SubscriptionDetail
         detail = SubscriptionDetail.objects.get(subscription=subscription, user=user_to_update)
-        
-        # Crea il record del pagamento
-        Payment.objects.create(
-            subscription_detail=detail,
-            amount=amount_paid,
-            payment_date=payment_date
+        # Transazione con lock sul membro; l'importo avanza i periodi che copre
+        result = payments.register_payment(
+            detail.pk, amount_paid, payment_date, idempotency_key=request.POST.get("idempotency_key"),
         )
-        
-        # Aggiorna la data dell'ultimo pagamento
-        detail.last_payment_date = payment_date
-        detail.save()
-        
-        messages.success(request, f"Pagamento di €{amount_paid} registrato per {user_to_update.username}.")
+        if result.created:
+            messages.success(
+                request,
+                f"Pagamento di €{result.payment.amount} registrato per {user_to_update.username} "
+                f"(periodi coperti: {result.periods}).",
+            )
+        else:
+            messages.info(request, "Pagamento già registrato.")
     except SubscriptionDetail.DoesNotExist:
         messages.error(request, "Dettaglio sottoscrizione non trovato.")
+    except payments.PaymentConflict:
+        messages.error(request, "Chiave di pagamento già usata per un altro pagamento.")
     except ValueError:
-        messages.error(request, "Importo non valido.")
+        messages.error(request, "Importo o data non validi.")
     except Exception as e:
         messages.error(request, f"Errore nella registrazione del pagamento: {str(e)}")
     
-    return redirect("home")
\ No newline at end of file
+    return redirect("home")
+
+@login_required
+def export_payments(request):
+    """Esporta i pagamenti in streaming (CSV o JSON Lines)"""
+    export_format = request.GET.get("format", "csv")
+    if export_format not in exports.FORMATS:
+        return HttpResponseBadRequest("Unknown format.")
+    try:
+        querysets = exports.export_querysets(
+            subscription=request.GET.get("subscription") or None,
+            user=request.GET.get("user") or None,
+            date_from=exports.parse_date(request.GET.get("date_from")),
+            date_to=exports.parse_date(request.GET.get("date_to")),
+            # Chi non è staff vede solo i pagamenti delle sottoscrizioni che amministra
+            admin_user=None if request.user.is_staff else request.user,
+        )
+    except ValueError:
+        return HttpResponseBadRequest("Invalid filters.")
+    
+    response = StreamingHttpResponse(
+        exports.export_lines(querysets, export_format),
+        content_type=exports.FORMATS[export_format],
+    )
+    response["Content-Disposition"] = f'attachment; filename="payments.{export_format}"'
+    return response